@@ -0,0 +1,60 @@
+"""
+Startup budget for inference workers.
+
+Imports `cadrres_sc.model` in a fresh interpreter and checks that it stays
+under a wall-time and peak-RSS budget and does not pull in the training or
+plotting stack.
+
+    python benchmarks/bench_import.py [--max-seconds 1.5] [--max-rss-mb 200]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROBE = r'''
+import json, resource, sys, time
+start = time.perf_counter()
+import cadrres_sc.model
+from cadrres_sc.model import load_model, predict_from_model
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_mb = rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+heavy = [m for m in ('tensorflow', 'sklearn', 'matplotlib', 'seaborn') if m in sys.modules]
+print(json.dumps({'seconds': elapsed, 'peak_rss_mb': rss_mb, 'heavy_modules': heavy}))
+'''
+
+
+def measure(repeats=3):
+    """Best of `repeats` cold imports, each in its own interpreter."""
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=package_root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True, capture_output=True, text=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda r: r['seconds'])
+    best['peak_rss_mb'] = min(r['peak_rss_mb'] for r in runs)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-seconds', type=float, default=1.5)
+    parser.add_argument('--max-rss-mb', type=float, default=200.0)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    result = measure(args.repeats)
+    print(json.dumps(result, indent=2))
+
+    assert not result['heavy_modules'], f"import cadrres_sc.model loaded {result['heavy_modules']}"
+    assert result['seconds'] <= args.max_seconds, \
+        f"import took {result['seconds']:.2f}s (budget {args.max_seconds:.2f}s)"
+    assert result['peak_rss_mb'] <= args.max_rss_mb, \
+        f"peak RSS {result['peak_rss_mb']:.0f} MB (budget {args.max_rss_mb:.0f} MB)"
+
+
+if __name__ == '__main__':
+    main()
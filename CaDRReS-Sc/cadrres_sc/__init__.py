@@ -0,0 +1,14 @@
+"""Submodules are imported on first attribute access (PEP 562)."""
+import importlib
+
+__all__ = ['analysis', 'evaluation', 'model', 'pp', 'utility']
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
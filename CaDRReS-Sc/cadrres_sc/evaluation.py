@@ -1,45 +1,115 @@
+import numpy as np
 import pandas as pd
 from scipy import stats
 
+def _masked_spearman(obs_mat, pred_mats, axis):
+    """Spearman correlation of obs_mat against every matrix in pred_mats along axis (1: per row, 0: per column).
+    Only pairs observed in both matrices are used; each vector is ranked once and correlated as a matrix.
+    Returns (scor, pval, n_pairs) arrays of shape (n_pred, n_vectors).
+    """
+
+    pred_mats = np.asarray(pred_mats, dtype='float')
+    mask = ~np.isnan(obs_mat)[None] & ~np.isnan(pred_mats)
+
+    x = np.where(mask, obs_mat[None], np.nan)
+    y = np.where(mask, pred_mats, np.nan)
+    x = stats.rankdata(x, axis=axis + 1, nan_policy='omit')
+    y = stats.rankdata(y, axis=axis + 1, nan_policy='omit')
+
+    n = mask.sum(axis=axis + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = x - np.nansum(x, axis=axis + 1, keepdims=True) / np.expand_dims(n, axis + 1)
+        y = y - np.nansum(y, axis=axis + 1, keepdims=True) / np.expand_dims(n, axis + 1)
+        scor = np.nansum(x * y, axis=axis + 1) / np.sqrt(np.nansum(x * x, axis=axis + 1) * np.nansum(y * y, axis=axis + 1))
+        scor = np.where(n > 1, np.clip(scor, -1, 1), np.nan)
+
+        dof = n - 2
+        t = scor * np.sqrt(dof / ((scor + 1.0) * (1.0 - scor)))
+        pval = np.where(dof > 0, 2 * stats.t.sf(np.abs(t), np.maximum(dof, 1)), np.nan)
+
+    return scor, pval, n
+
 def calculate_spearman(obs_df, pred_df, sample_list, drug_list, prefix=''):
 
-    obs_df = obs_df.loc[sample_list, drug_list]
-    pred_df = pred_df.loc[sample_list, drug_list]
-    
-    results = []
-    for s in sample_list:
-        x = obs_df.loc[s].values
-        y = pred_df.loc[s].values
-        scor, pval = stats.spearmanr(x, y)
-        results += [[s, scor, pval]]
-    per_sample_df = pd.DataFrame(results, columns=['sample', '{}scor'.format(prefix), '{}pval'.format(prefix)]).set_index('sample')
-    
-    results = []
-    for d in drug_list:
-        x = obs_df[d].values
-        y = pred_df[d].values
-        scor, pval = stats.spearmanr(x, y)
-        results += [[d, scor, pval]]
-    per_drug_df = pd.DataFrame(results, columns=['drug', '{}scor'.format(prefix), '{}pval'.format(prefix)]).set_index('drug')
-    
+    per_sample_df, per_drug_df = calculate_spearman_multi_pred(obs_df, {prefix: pred_df}, sample_list, drug_list, name_format='{}')
+
     return per_sample_df, per_drug_df
 
-def calculate_spearman_multi_pred(obs_df, pred_df_dict, sample_list, drug_list):
-    
-    per_sample_df_list = []
-    per_drug_df_list = []
-    
-    for (pred_name, pred_df) in pred_df_dict.items():
-        per_sample_df, per_drug_df = calculate_spearman(obs_df, pred_df, sample_list, drug_list, prefix="{}_".format(pred_name))
-        per_sample_df_list += [per_sample_df]
-        per_drug_df_list += [per_drug_df]
-        
-    all_per_sample_df = pd.concat(per_sample_df_list, axis=1)
-    all_per_drug_df = pd.concat(per_drug_df_list, axis=1)
-    
+def calculate_spearman_multi_pred(obs_df, pred_df_dict, sample_list, drug_list, name_format='{}_'):
+    """Per-sample and per-drug Spearman correlations for every prediction in pred_df_dict, computed in one pass.
+    Missing observations (NaN) are masked out instead of turning the whole correlation into NaN.
+    """
+
+    obs_mat = np.array(obs_df.loc[sample_list, drug_list], dtype='float')
+    pred_mats = [np.array(pred_df.loc[sample_list, drug_list], dtype='float') for pred_df in pred_df_dict.values()]
+
+    sample_scor, sample_pval, _ = _masked_spearman(obs_mat, pred_mats, axis=1)
+    drug_scor, drug_pval, _ = _masked_spearman(obs_mat, pred_mats, axis=0)
+
+    sample_cols = {}
+    drug_cols = {}
+    for i, pred_name in enumerate(pred_df_dict.keys()):
+        prefix = name_format.format(pred_name)
+        sample_cols['{}scor'.format(prefix)] = sample_scor[i]
+        sample_cols['{}pval'.format(prefix)] = sample_pval[i]
+        drug_cols['{}scor'.format(prefix)] = drug_scor[i]
+        drug_cols['{}pval'.format(prefix)] = drug_pval[i]
+
+    all_per_sample_df = pd.DataFrame(sample_cols, index=pd.Index(sample_list, name='sample'))
+    all_per_drug_df = pd.DataFrame(drug_cols, index=pd.Index(drug_list, name='drug'))
+
     return all_per_sample_df, all_per_drug_df
 
-# TODO: other evaluation scores
-# def cal_ndcg(obs_df, pred_df):
-# 	sample_ndcg_df = pd.DataFrame([None])
-# 	return sample_ndcg_df
\ No newline at end of file
+def _rank_positions(mat):
+    """Position of each entry when its row is sorted in ascending order (NaN last)
+    """
+
+    order = np.argsort(np.where(np.isnan(mat), np.inf, mat), axis=1, kind='stable')
+    positions = np.empty_like(order)
+    np.put_along_axis(positions, order, np.arange(mat.shape[1])[None], axis=1)
+    return positions
+
+def calculate_ndcg(obs_df, pred_df, sample_list, drug_list, k=None, prefix=''):
+    """Per-sample NDCG of the drug ranking by predicted IC50 (most sensitive first).
+    The relevance of a drug is its observed sensitivity relative to the least sensitive observed drug of the sample.
+    Drugs without an observation are ignored. If k is given, only the top-k predicted drugs are scored.
+    """
+
+    obs_mat = np.array(obs_df.loc[sample_list, drug_list], dtype='float')
+    pred_mat = np.array(pred_df.loc[sample_list, drug_list], dtype='float')
+    mask = ~np.isnan(obs_mat) & ~np.isnan(pred_mat)
+
+    row_max = np.where(mask, obs_mat, -np.inf).max(axis=1, keepdims=True)
+    relevance = np.where(mask, row_max - obs_mat, 0)
+
+    n_drugs = len(drug_list)
+    k = n_drugs if k is None else min(k, n_drugs)
+    discount = 1.0 / np.log2(np.arange(2, n_drugs + 2))
+    discount[k:] = 0
+
+    pred_order = np.argsort(np.where(mask, pred_mat, np.inf), axis=1, kind='stable')
+    dcg = (np.take_along_axis(relevance, pred_order, axis=1) * discount).sum(axis=1)
+    idcg = (-np.sort(-relevance, axis=1) * discount).sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ndcg = np.where(idcg > 0, dcg / idcg, np.nan)
+
+    return pd.DataFrame({'{}ndcg'.format(prefix): ndcg}, index=pd.Index(sample_list, name='sample'))
+
+def calculate_precision_at_k(obs_df, pred_df, sample_list, drug_list, k=10, prefix=''):
+    """Per-sample fraction of the k drugs with the lowest predicted IC50 that are among the k lowest observed IC50.
+    Drugs without an observation are ignored; samples with fewer than k observed drugs use all of them.
+    """
+
+    obs_mat = np.array(obs_df.loc[sample_list, drug_list], dtype='float')
+    pred_mat = np.array(pred_df.loc[sample_list, drug_list], dtype='float')
+    mask = ~np.isnan(obs_mat) & ~np.isnan(pred_mat)
+
+    k_eff = np.minimum(k, mask.sum(axis=1))[:, None]
+    top_obs = _rank_positions(np.where(mask, obs_mat, np.nan)) < k_eff
+    top_pred = _rank_positions(np.where(mask, pred_mat, np.nan)) < k_eff
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = (top_obs & top_pred).sum(axis=1) / k_eff[:, 0]
+
+    return pd.DataFrame({'{}precision@{}'.format(prefix, k): precision}, index=pd.Index(sample_list, name='sample'))
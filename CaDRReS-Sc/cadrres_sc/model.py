@@ -10,10 +10,23 @@ import pandas as pd
 import numpy as np
 import os, pickle, time
 
-import tensorflow as tf
-from tensorflow.python.framework import ops
-import tensorflow.python.util.deprecation as deprecation
-deprecation._PRINT_DEPRECATION_WARNINGS = False
+# TensorFlow is only needed for training; it is imported on first use so that
+# loading a model and predicting does not pay for it.
+tf = None
+ops = None
+
+def _import_tensorflow():
+
+    """Import TensorFlow into the module namespace on first use
+    """
+
+    global tf, ops
+    if tf is None:
+        import tensorflow
+        from tensorflow.python.framework import ops as tf_ops
+        import tensorflow.python.util.deprecation as deprecation
+        deprecation._PRINT_DEPRECATION_WARNINGS = False
+        tf, ops = tensorflow, tf_ops
 
 def load_model(model_fname):
 
@@ -95,6 +108,8 @@ def create_placeholders(n_x_features, n_y_features, sample_weight=False):
     Create placeholders for model inputs
     """
 
+    _import_tensorflow()
+
     # gene expression
     X = tf.placeholder(tf.float32, [None, n_x_features])
     # drug response
@@ -115,6 +130,8 @@ def initialize_parameters(n_samples, n_drugs, n_x_features, n_y_features, n_dime
     Depending on the objective function, b_P might not be used in the later step.
     """
 
+    _import_tensorflow()
+
     parameters = {}
 
     parameters['W_P'] = tf.Variable(tf.truncated_normal([n_x_features, n_dimensions], stddev=0.2, mean=0, seed=seed), name="W_P")
@@ -130,6 +147,8 @@ def inward_propagation(X, Y, parameters, n_samples, n_drugs, model_spec_name):
     Define base objective function
     """
 
+    _import_tensorflow()
+
     W_P = parameters['W_P']
     W_Q = parameters['W_Q']
     P = tf.matmul(X, W_P)
@@ -156,6 +175,8 @@ def get_latent_vectors(X, Y, parameters):
     Get latent vectors of cell line (P) and drug (Q) on the pharmacogenomic space
     """
 
+    _import_tensorflow()
+
     W_P = parameters['W_P']
     W_Q = parameters['W_Q']
     P = tf.matmul(X, W_P)
@@ -238,6 +259,8 @@ def train_model(train_resp_df, train_feature_df, test_resp_df, test_feature_df,
 
     """
 
+    _import_tensorflow()
+
     print ('Initializing the model ...')
 
     # Reset TensorFlow graph
@@ -445,6 +468,8 @@ def train_model_logistic_weight(train_resp_df, train_feature_df, test_resp_df, t
 
     """
 
+    _import_tensorflow()
+
     print ('Getting data ...')
 
     ################################
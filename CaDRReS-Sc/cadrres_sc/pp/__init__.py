@@ -1,7 +1,14 @@
-import pkgutil
+"""Submodules are imported on first attribute access (PEP 562)."""
+import importlib
 
-__all__ = []
-for loader, module_name, is_pkg in  pkgutil.walk_packages(__path__):
-    __all__.append(module_name)
-    _module = loader.find_module(module_name).load_module(module_name)
-    globals()[module_name] = _module
\ No newline at end of file
+__all__ = ['gexp', 'scgexp']
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -8,8 +8,6 @@
 
 import pandas as pd
 import numpy as np
-from scipy import stats
-import time
 
 def log2_exp(exp_df):
     """Calculate log2 gene expression
@@ -39,31 +37,55 @@ def normalize_L1000_suite():
     """
     """
 
-# TODO: make this run in parallel
-def calculate_kernel_feature(log2_median_fc_exp_df, ref_log2_median_fc_exp_df, gene_list):
-    common_genes = [g for g in gene_list if (g in log2_median_fc_exp_df.index) and (g in ref_log2_median_fc_exp_df.index)]
-    
-    print ('Calculating kernel features based on', len(common_genes), 'common genes')
+def prepare_kernel_reference(ref_log2_median_fc_exp_df, gene_list):
+    """Standardize reference profiles once so that many samples can be scored against them.
 
-    print (log2_median_fc_exp_df.shape, ref_log2_median_fc_exp_df.shape)
-    
-    sample_list = list(log2_median_fc_exp_df.columns)
-    ref_sample_list = list(ref_log2_median_fc_exp_df.columns)
+    :param ref_log2_median_fc_exp_df: reference fold-change profiles (row:gene, col:reference sample)
+    :param gene_list: genes used for the kernel; genes missing from the reference are dropped
+    :returns: dict with the genes used, the reference sample names and the standardized (gene x sample) matrix
+
+    """
 
-    exp_mat = np.array(log2_median_fc_exp_df.loc[common_genes], dtype='float')
+    common_genes = [g for g in gene_list if g in ref_log2_median_fc_exp_df.index]
     ref_exp_mat = np.array(ref_log2_median_fc_exp_df.loc[common_genes], dtype='float')
 
-    sim_mat = np.zeros((len(sample_list), len(ref_sample_list)))
+    return {
+        'gene_list': common_genes,
+        'ref_sample_list': list(ref_log2_median_fc_exp_df.columns),
+        'ref_mat': _standardize_columns(ref_exp_mat),
+    }
+
+def calculate_kernel_feature_from_reference(log2_median_fc_exp_df, kernel_ref):
+    """Calculate kernel features (Pearson correlation to every reference sample) from a prepared reference.
+    """
 
-    start = time.time()
-    for i in range(len(sample_list)):
-        if (i+1)%100 == 0:
-            print ("{} of {} ({:.2f})s".format(i+1, len(sample_list), time.time()-start))
-            start = time.time()
-        for j in range(len(ref_sample_list)):
-            p_cor, _ = stats.pearsonr(exp_mat[:,i], ref_exp_mat[:,j])
-            sim_mat[i, j] = p_cor
+    common_genes = [g for g in kernel_ref['gene_list'] if g in log2_median_fc_exp_df.index]
+    ref_mat = kernel_ref['ref_mat']
+    if len(common_genes) != len(kernel_ref['gene_list']):
+        gene_idx = {g: i for i, g in enumerate(kernel_ref['gene_list'])}
+        ref_mat = _standardize_columns(ref_mat[[gene_idx[g] for g in common_genes]])
+
+    print ('Calculating kernel features based on', len(common_genes), 'common genes')
 
-    return pd.DataFrame(sim_mat, columns=ref_sample_list, index=sample_list)
+    exp_mat = _standardize_columns(np.array(log2_median_fc_exp_df.loc[common_genes], dtype='float'))
+    sim_mat = np.matmul(exp_mat.T, ref_mat)
 
+    return pd.DataFrame(sim_mat, columns=kernel_ref['ref_sample_list'], index=list(log2_median_fc_exp_df.columns))
+
+def calculate_kernel_feature(log2_median_fc_exp_df, ref_log2_median_fc_exp_df, gene_list):
+    common_genes = [g for g in gene_list if (g in log2_median_fc_exp_df.index) and (g in ref_log2_median_fc_exp_df.index)]
+
+    print (log2_median_fc_exp_df.shape, ref_log2_median_fc_exp_df.shape)
+
+    kernel_ref = prepare_kernel_reference(ref_log2_median_fc_exp_df, common_genes)
+
+    return calculate_kernel_feature_from_reference(log2_median_fc_exp_df, kernel_ref)
+
+def _standardize_columns(mat):
+    """Center each column and scale it to unit norm, so that a matrix product gives Pearson correlations.
+    Constant columns become NaN, as with stats.pearsonr.
+    """
 
+    centered = mat - mat.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return centered / np.sqrt(np.square(centered).sum(axis=0))
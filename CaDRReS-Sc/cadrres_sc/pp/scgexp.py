@@ -7,20 +7,59 @@
 """
 
 import pandas as pd
+import numpy as np
+from scipy import sparse
+from scipy.special import xlogy
 
-# TODO: functions for preprocessing scRNA-seq data
+def count_sample_cluster(sample_labels, cluster_labels):
+    """Count cells of each cluster in each sample with categorical codes and a single np.bincount
 
-def get_sample_cluster_percent(sample_cell_df, cutoff=0.05):
+    :param sample_labels: sample of each cell
+    :param cluster_labels: cluster of each cell
+    :returns:  DataFrame of cell counts (row:sample, col:cluster); cells with a missing label are ignored
+
+    """
+
+    samples = pd.Categorical(sample_labels).remove_unused_categories()
+    clusters = pd.Categorical(cluster_labels).remove_unused_categories()
+    keep = (samples.codes >= 0) & (clusters.codes >= 0)
+    samples = samples[keep].remove_unused_categories()
+    clusters = clusters[keep].remove_unused_categories()
+
+    n_samples = len(samples.categories)
+    n_clusters = len(clusters.categories)
+    flat_codes = samples.codes.astype(np.int64) * n_clusters + clusters.codes
+    counts = np.bincount(flat_codes, minlength=n_samples * n_clusters).reshape(n_samples, n_clusters)
+
+    return pd.DataFrame(counts, index=pd.Index(samples.categories), columns=pd.Index(clusters.categories))
+
+def get_sample_cluster_percent(sample_cell_df, cutoff=0.05, sample_col_name='sample_id', cluster_col_name='cluster_id'):
     """Calculate proportion of each cell cluster in each sample
 
-    :param cell_cluster_df: Two columns for cell_id and cluster_id
-    :type cell_cluster_df: DataFrame
+    :param sample_cell_df: One row per cell with columns for sample_id and cluster_id
+    :type sample_cell_df: DataFrame
     :param cutoff: If a cluster presented in less than the cutoff, then set its percentage to 0
     :type cutoff: float
     :returns:  DataFrame (cell_cluster_proportion_df) of proportion of cell clusters (row:sample, col:cluster)
 
     """
-    # return pd.DataFrame([None])
+
+    cnt_df = count_sample_cluster(sample_cell_df[sample_col_name].values, sample_cell_df[cluster_col_name].values)
+    frac = cnt_df.values / cnt_df.values.sum(axis=1, keepdims=True)
+    frac[frac <= cutoff] = 0
+
+    cnt_df.index.name = sample_col_name
+    cnt_df.columns.name = cluster_col_name
+
+    return pd.DataFrame(frac, index=cnt_df.index, columns=cnt_df.columns)
+
+def calculate_entropy(cell_cluster_proportion_df):
+    """Entropy of each row of a proportion matrix, in one vectorized call
+    """
+
+    frac = np.array(cell_cluster_proportion_df, dtype='float')
+
+    return -xlogy(frac, frac).sum(axis=1)
 
 def calculate_het_score(cell_cluster_proportion_df):
     """Calculate intra-sample heterogeneity score using entropy (with renormalization)
@@ -29,11 +68,35 @@ def calculate_het_score(cell_cluster_proportion_df):
     :type cell_cluster_df: DataFrame
     :returns:  DataFrame of heterogeneity score
 
-    """    
+    """
+
+    frac = np.array(cell_cluster_proportion_df, dtype='float')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = frac / frac.sum(axis=1, keepdims=True)
+
+    return pd.DataFrame({'het_score': calculate_entropy(frac)}, index=cell_cluster_proportion_df.index)
 
-def calculate_cluster_prof(sc_log2_exp_df, sc_info_df):
+def calculate_cluster_prof(sc_log2_exp_df, sc_info_df, cluster_col_name='Cluster'):
     """Calculate gene expression profile for each cell cluster
+
+    :param sc_log2_exp_df: log2 expression (row:gene, col:cell)
+    :param sc_info_df: cell information with a cluster column (row:cell)
+    :returns:  DataFrame of mean expression (row:gene, col:cluster)
+
     """
-    # exp_with_info_df = pd.merge(sc_log2_exp_df.T, sc_info_df[['Cluster']], left_index=True, right_index=True)
-    # return exp_with_info_df.groupby('Cluster').median().T
 
+    cell_list = [c for c in sc_log2_exp_df.columns if c in sc_info_df.index]
+    clusters = pd.Categorical(sc_info_df.loc[cell_list, cluster_col_name]).remove_unused_categories()
+    keep = clusters.codes >= 0
+    cell_idx = np.flatnonzero(keep)
+
+    # (cluster x cell) indicator scaled by 1/cluster size, so that a single product gives cluster means
+    sizes = np.bincount(clusters.codes[keep], minlength=len(clusters.categories))
+    indicator = sparse.csr_matrix(
+        (1.0 / sizes[clusters.codes[keep]], (clusters.codes[keep], np.arange(len(cell_idx)))),
+        shape=(len(clusters.categories), len(cell_idx)))
+
+    exp_mat = sc_log2_exp_df[[cell_list[i] for i in cell_idx]].values
+    prof_mat = (indicator @ exp_mat.T).T
+
+    return pd.DataFrame(prof_mat, index=sc_log2_exp_df.index, columns=pd.Index(clusters.categories, name=cluster_col_name))
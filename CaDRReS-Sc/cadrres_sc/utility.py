@@ -10,19 +10,17 @@ import sys, os
 
 import pandas as pd
 import numpy as np
-from scipy import stats
-from scipy.special import xlogy
+from scipy import stats, sparse
 
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
-
-import matplotlib.pyplot as plt
-import seaborn as sns
+from .pp.gexp import _standardize_columns
+from .pp.scgexp import get_sample_cluster_percent, calculate_entropy
 
 
 
 def get_pca(data_df):
 
+    from sklearn.decomposition import PCA
+
     X = np.array(data_df)
     X_embedded = PCA(n_components=2).fit_transform(X)
     
@@ -30,6 +28,8 @@ def get_pca(data_df):
 
 def get_tsne(data_df, metric='euclidean'):
 
+    from sklearn.manifold import TSNE
+
     np.random.seed(1)
 
     X = np.array(data_df)
@@ -39,6 +39,9 @@ def get_tsne(data_df, metric='euclidean'):
 
 def plot_tsne(data_df, x, y, hue, hue_order=None, style=None, markers=None, s=10, palette=None):
     
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(8,6))
 
     sns.scatterplot(data=data_df, x=x, y=y, hue=hue, hue_order=hue_order, style=style, markers=markers, s=s, alpha=0.75, linewidth=0, palette=palette)
@@ -51,6 +54,9 @@ def plot_tsne(data_df, x, y, hue, hue_order=None, style=None, markers=None, s=10
 
 def plot_scatter(data_df, x, y, hue, hue_order=None, style=None, markers=None, s=10, palette=None):
     
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(8,6))
 
     sns.scatterplot(data=data_df, x=x, y=y, hue=hue, hue_order=hue_order, style=style, markers=markers, s=s, alpha=0.75, linewidth=0, palette=palette)
@@ -65,30 +71,16 @@ def get_gene_list(gene_list_fname):
     return list(pd.read_csv(gene_list_fname, header=None)[0].values)
 
 def calculate_cluster_fraction(sample_cluster_info_df, sample_col_name, cell_cluster_col_name, min_fraction=0.05):
-    sample_cluster_info_df.index.name = 'index'
-    
-    cnt_df = sample_cluster_info_df[[sample_col_name]].reset_index().groupby(sample_col_name).count()
-    cluster_cnt_df = sample_cluster_info_df[[sample_col_name, cell_cluster_col_name]].reset_index().groupby([sample_col_name, cell_cluster_col_name]).count()
-    
-    cluster_frac_df = cluster_cnt_df.copy()
-
-    for s, data in cnt_df.iterrows():
-        s_cnt = data['index']
-        s_cluster_list = list(cluster_cnt_df.loc[s].index)
-        cluster_frac_df.loc[[(s, c) for c in s_cluster_list], 'index'] = (cluster_cnt_df.loc[s] / s_cnt).values
-        
-    cluster_frac_df = cluster_frac_df.reset_index().pivot(index=sample_col_name, columns=cell_cluster_col_name, values='index')
-    cluster_frac_df = cluster_frac_df[cluster_frac_df > min_fraction]
-    cluster_frac_df = cluster_frac_df.fillna(0)
+    """Fraction of each cluster in each sample (row:sample, col:cluster); fractions not above min_fraction are set to 0
+    """
 
-    return cluster_frac_df
+    return get_sample_cluster_percent(sample_cluster_info_df, cutoff=min_fraction, sample_col_name=sample_col_name, cluster_col_name=cell_cluster_col_name)
 
 def calculate_sample_het_entropy(cluster_frac_df, sample_type_name='sample'):
-    results = []
-    for s, data in cluster_frac_df.iterrows():
-        results += [[s, -xlogy(data.values, data.values).sum()]]
-    
-    return pd.DataFrame(results, columns=[sample_type_name, 'het_entropy']).set_index(sample_type_name)
+    het_df = pd.DataFrame({'het_entropy': calculate_entropy(cluster_frac_df)}, index=cluster_frac_df.index)
+    het_df.index.name = sample_type_name
+
+    return het_df
 
 ############################################
 ##### For gene set enrichment analysis #####
@@ -104,41 +96,55 @@ def get_gs_dict(gs_fname):
         
     return gs_gene_dict
 
-def calculate_pathway_activity(gs_gene_dict, log2_fc_exp_df):
-    results = []
+def get_gs_membership(gs_gene_dict, gene_list):
+    """Build a sparse (gene set x gene) membership matrix over gene_list
+    """
+
+    gene_idx = {g: i for i, g in enumerate(gene_list)}
+
+    rows, cols = [], []
+    for gs_i, genes in enumerate(gs_gene_dict.values()):
+        g_idx = {gene_idx[g] for g in genes if g in gene_idx}
+        rows += [gs_i] * len(g_idx)
+        cols += list(g_idx)
 
-    input_sample_list = list(log2_fc_exp_df.columns)
-    input_gene_list = set(log2_fc_exp_df.index)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(gs_gene_dict), len(gene_list)))
 
-    for gs_name, genes in gs_gene_dict.items():
+def calculate_pathway_activity(gs_gene_dict, log2_fc_exp_df):
+    """Sum of fold-changes over the genes of each gene set (row:sample, col:gene set)
+    """
 
-        common_genes = list(input_gene_list.intersection(genes))
-        results += [[gs_name] + list(log2_fc_exp_df.loc[common_genes].sum().values)]
+    membership = get_gs_membership(gs_gene_dict, list(log2_fc_exp_df.index))
+    activity = membership @ np.array(log2_fc_exp_df, dtype='float')
 
-    result_df = pd.DataFrame(results, columns = ['id'] + input_sample_list)
-    pathway_activity_df = result_df.set_index('id').T
+    pathway_activity_df = pd.DataFrame(activity.T, index=log2_fc_exp_df.columns, columns=pd.Index(list(gs_gene_dict.keys()), name='id'))
 
     return pathway_activity_df
 
-def calculate_drug_pathway_assoc(pathway_activity_df, response_df):
+def calculate_drug_pathway_assoc(pathway_activity_df, response_df, return_pval=False):
+    """Pearson correlation between every drug response and every pathway activity (row:drug, col:gene set).
+    If return_pval is True, two-sided p-values are returned as a second DataFrame.
+    """
 
     sample_list = [s for s in pathway_activity_df.index if s in response_df.index]
     gs_list = pathway_activity_df.columns
     drug_list = response_df.columns
 
-    r_mat = np.array(response_df.loc[sample_list])
-    a_mat = np.array(pathway_activity_df.loc[sample_list])
+    r_mat = np.array(response_df.loc[sample_list], dtype='float')
+    a_mat = np.array(pathway_activity_df.loc[sample_list], dtype='float')
 
-    assoc_mat = np.zeros((r_mat.shape[1], a_mat.shape[1]))
-    for d, d_name in enumerate(drug_list):
-        x = r_mat[:, d]
-        for gs, gs_name in enumerate(gs_list):
-            y = a_mat[:, gs]
+    assoc_mat = np.clip(np.matmul(_standardize_columns(r_mat).T, _standardize_columns(a_mat)), -1, 1)
+    assoc_df = pd.DataFrame(assoc_mat, index=drug_list, columns=gs_list)
 
-            pcor, pval = stats.pearsonr(x, y)
-            assoc_mat[d, gs] = pcor
-    
-    return pd.DataFrame(assoc_mat, index=drug_list, columns=gs_list)
+    if not return_pval:
+        return assoc_df
+
+    dof = len(sample_list) - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_mat = assoc_mat * np.sqrt(dof / ((1.0 - assoc_mat) * (1.0 + assoc_mat)))
+    pval_mat = 2 * stats.t.sf(np.abs(t_mat), dof)
+
+    return assoc_df, pd.DataFrame(pval_mat, index=drug_list, columns=gs_list)
 
 def calculate_pathway_activity_gsea(log2_median_fc_exp_df, pathway_db_name='Biocarta'):
     """Calculate pathway activity
@@ -286,4 +292,4 @@ def calculate_combined_ic50(cluster_pred_df, cl_cluster_frac_df):
 
     combined_ic50_df = pd.DataFrame(results, columns=['cell_line', 'drug', 'combined_ic50'])
 
-    return combined_ic50_df.pivot(index='cell_line', columns='drug', values='combined_ic50')
\ No newline at end of file
+    return combined_ic50_df.pivot(index='cell_line', columns='drug', values='combined_ic50')
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""
+Resource-aware admission control for the heavy pipeline endpoints.
+
+Every `/annotate`, `/cellphonedb` and `/inferCNV` request becomes a `Job`
+with an estimated memory footprint (from the shape of its input, read from
+the h5ad header without loading X) and a CPU request (from its parameters).
+Jobs run in FIFO order once both fit in the configured budgets; a job that
+could never fit, or one arriving while the queue is full, is rejected.
+
+Budgets come from the environment:
+
+    CELLPILOT_MEMORY_BUDGET_GB  default: 75% of physical memory
+    CELLPILOT_CPU_BUDGET        default: number of cores
+    CELLPILOT_MAX_QUEUE         default: 8 waiting jobs
+
+Each admitted job is handed a thread count.  Pipelines that take one
+(CellPhoneDB `threads`, inferCNV `cores`) receive it directly; numba's
+per-thread pool is set in the worker thread, and the process-wide
+BLAS/OpenMP pools are capped at the smallest allotment among running jobs,
+so the total number of compute threads never exceeds the CPU budget.
+"""
+import asyncio
+import itertools
+import os
+import time
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Peak working-set multipliers over the size of X, measured on the pipelines
+# as written: annotate keeps raw, normalized and residual copies plus a dense
+# scaled HVG matrix; CellPhoneDB densifies the counts it tests; inferCNV
+# smooths a dense cell x gene matrix per chromosome.
+X_COPIES = {'annotate': 3.0, 'annotate_preprocessed': 1.5, 'cellphonedb': 2.0, 'infercnv': 2.0}
+DENSE_COPIES = {'annotate': 0.0, 'annotate_preprocessed': 0.0, 'cellphonedb': 1.0, 'infercnv': 1.0}
+PROCESS_OVERHEAD = 512 * 2**20
+
+DEFAULT_CPUS = {'annotate': 4, 'cellphonedb': 10, 'infercnv': 4}
+
+
+def _physical_memory():
+    if psutil is not None:
+        return psutil.virtual_memory().total
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def memory_budget():
+    if os.environ.get('CELLPILOT_MEMORY_BUDGET_GB'):
+        return int(float(os.environ['CELLPILOT_MEMORY_BUDGET_GB']) * 2**30)
+    return int(_physical_memory() * 0.75)
+
+
+def cpu_budget():
+    if os.environ.get('CELLPILOT_CPU_BUDGET'):
+        return max(int(os.environ['CELLPILOT_CPU_BUDGET']), 1)
+    return os.cpu_count() or 1
+
+
+def max_queue():
+    return int(os.environ.get('CELLPILOT_MAX_QUEUE', 8))
+
+
+def input_shape(path):
+    """
+    (n_obs, n_vars, nnz, itemsize) of an input file without loading it.
+
+    h5ad files are read from their HDF5 header and Zarr stores from their
+    metadata; other formats fall back to the file size, treating every byte
+    as roughly one stored value.
+    """
+    from .store import is_zarr
+    if is_zarr(path):
+        import zarr
+        X = zarr.open_group(path, mode='r')['X']
+        if isinstance(X, zarr.Array):
+            return X.shape[0], X.shape[1], X.shape[0] * X.shape[1], X.dtype.itemsize
+        shape = X.attrs['shape']
+        return int(shape[0]), int(shape[1]), int(X['data'].shape[0]), X['data'].dtype.itemsize
+    if path.endswith('.h5ad'):
+        import h5py
+        from .output import delta_parent
+        parent = delta_parent(path)
+        if parent is not None:
+            return input_shape(parent)
+        with h5py.File(path, 'r') as f:
+            X = f['X']
+            if isinstance(X, h5py.Dataset):
+                n_obs, n_vars = X.shape
+                return n_obs, n_vars, n_obs * n_vars, X.dtype.itemsize
+            shape = X.attrs.get('shape', X.attrs.get('h5sparse_shape'))
+            return int(shape[0]), int(shape[1]), int(X['data'].shape[0]), X['data'].dtype.itemsize
+    size = os.path.getsize(path)
+    return 0, 0, size // 4, 4
+
+
+def estimate_memory(kind, path, n_hvgs=2000):
+    """Estimated peak bytes for running pipeline `kind` on `path`."""
+    n_obs, n_vars, nnz, itemsize = input_shape(path)
+    x_bytes = nnz * (itemsize + 4) + (n_obs + 1) * 8
+    dense_bytes = n_obs * n_vars * 4
+    estimate = X_COPIES[kind] * x_bytes + DENSE_COPIES[kind] * dense_bytes
+    if kind == 'annotate':
+        estimate += n_obs * min(n_hvgs, n_vars or n_hvgs) * 8
+    return int(estimate + PROCESS_OVERHEAD)
+
+
+class Job:
+    """One admitted (or waiting) pipeline run."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, name, input_path, memory, cpus):
+        self.id = next(self._ids)
+        self.kind = kind
+        self.name = name
+        self.input_path = input_path
+        self.memory = memory
+        self.cpus = cpus
+        self.threads = None
+        self.submitted = time.time()
+        self.started = None
+
+    def summary(self, position=None):
+        info = {
+            'id': self.id,
+            'kind': self.kind,
+            'name': self.name,
+            'input_path': self.input_path,
+            'memory_gb': round(self.memory / 2**30, 2),
+            'cpus': self.cpus,
+            'threads': self.threads,
+            'waited_seconds': round((self.started or time.time()) - self.submitted, 1),
+        }
+        if position is not None:
+            info['position'] = position
+        return info
+
+
+class AdmissionController:
+    def __init__(self):
+        self.queue = []
+        self.running = []
+        self._cond = None
+        self._blas_limit = None
+
+    @property
+    def cond(self):
+        # created lazily so it binds to the server's event loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def job(self, kind, name, input_path, cpus=None, n_hvgs=2000, memory_kind=None):
+        """Build a job, estimating its memory from the input's shape."""
+        if not os.path.exists(input_path):
+            raise HTTPException(status_code=404, detail=f"Input file not found: {input_path}")
+        memory = estimate_memory(memory_kind or kind, input_path, n_hvgs=n_hvgs)
+        cpus = min(cpus or DEFAULT_CPUS[kind], cpu_budget())
+        return Job(kind, name, input_path, memory, cpus)
+
+    def _free(self):
+        used_memory = sum(j.memory for j in self.running)
+        used_cpus = sum(j.cpus for j in self.running)
+        return memory_budget() - used_memory, cpu_budget() - used_cpus
+
+    def _fits(self, job):
+        free_memory, free_cpus = self._free()
+        # an idle server always takes the next job, so a job is never starved by its own size
+        return not self.running or (job.memory <= free_memory and job.cpus <= free_cpus)
+
+    def status(self):
+        _, free_cpus = self._free()
+        return {
+            'memory_budget_gb': round(memory_budget() / 2**30, 2),
+            'cpu_budget': cpu_budget(),
+            'free_cpus': free_cpus,
+            'blas_threads': self._blas_limit,
+            'running': [j.summary() for j in self.running],
+            'queued': [j.summary(position=i + 1) for i, j in enumerate(self.queue)],
+        }
+
+    async def acquire(self, job):
+        if job.memory > memory_budget():
+            raise HTTPException(
+                status_code=413,
+                detail=f"{job.kind} on {job.input_path} needs an estimated {job.memory / 2**30:.1f} GB, "
+                       f"more than the {memory_budget() / 2**30:.1f} GB memory budget")
+        async with self.cond:
+            if len(self.queue) >= max_queue():
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Job queue is full ({len(self.queue)} waiting, {len(self.running)} running)",
+                    headers={'Retry-After': '60'})
+            self.queue.append(job)
+            print(f"Queued {job.kind} job {job.id} at position {len(self.queue)}")
+            try:
+                await self.cond.wait_for(lambda: self.queue[0] is job and self._fits(job))
+            except BaseException:
+                # client went away while waiting: let the next job move up
+                self.queue.remove(job)
+                self.cond.notify_all()
+                raise
+            self.queue.remove(job)
+            job.started = time.time()
+            job.threads = job.cpus
+            self.running.append(job)
+            self._update_blas_limit()
+            self.cond.notify_all()
+
+    async def release(self, job):
+        async with self.cond:
+            self.running.remove(job)
+            self._update_blas_limit()
+            self.cond.notify_all()
+
+    def _update_blas_limit(self):
+        """Cap the process-wide BLAS/OpenMP pools at the smallest running allotment."""
+        limit = min((j.threads for j in self.running), default=cpu_budget())
+        if limit == self._blas_limit:
+            return
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=limit)
+        except ImportError:
+            pass
+        self._blas_limit = limit
+
+    async def run(self, job, func, *args, **kwargs):
+        """Wait for admission, then run `func` in the thread pool with the job's thread allotment."""
+        await self.acquire(job)
+        try:
+            return await run_in_threadpool(_call_with_threads, job.threads, func, *args, **kwargs)
+        finally:
+            await self.release(job)
+
+
+def _call_with_threads(threads, func, /, *args, **kwargs):
+    try:
+        import numba
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    except ImportError:
+        pass
+    return func(*args, **kwargs)
+
+
+admission = AdmissionController()
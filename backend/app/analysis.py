@@ -10,6 +10,12 @@ import infercnvpy as cnv
 import platform, multiprocessing as mp
 import sys, pathlib
 from .utils import summarize_h5ad
+from .instrumentation import adata_size, pipeline_run, stage
+from .cpdb_network import interaction_network, plot_interaction_heatmap, symmetrize
+from .cpdb_database import database_genes
+from .ingest import read_obs
+from .neighbors import neighbors_transformer
+from .output import read_h5ad, write_h5ad
 # macOS: avoid "The process has fork … YOU MUST exec()" spam
 if platform.system() == "Darwin":
     import os, sys
@@ -24,7 +30,7 @@ if platform.system() == "Darwin":
         pass
 
 #cellphondeb, openchord, P
-def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_name='cell_type', cpdb_file_path='db/cellphonedb.zip', name='', counts_min=10):
+def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_name='cell_type', cpdb_file_path='db/cellphonedb.zip', name='', counts_min=10, threads=10):
     """
     Run CellPhoneDB analysis on the given AnnData object.
     
@@ -35,6 +41,7 @@ def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_nam
     column_name (str): The column name in adata.obs that contains the cell type labels.
     cpdb_file_path (str): The path to the CellPhoneDB database zip file.
     name (str): Name prefix for output files.
+    threads (int): Worker threads for the statistical analysis.
     plot_column_names : list
         • ["All"] → plot every cell type  
         • []      → skip dot-plots  
@@ -44,6 +51,13 @@ def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_nam
     --------
     dict: The CellPhoneDB results dictionary.
     """
+    with pipeline_run('cellphonedb', output_dir, name) as run:
+        data = _run_cell_phone_db(input_file, output_dir, plot_column_names, column_name, cpdb_file_path, name, counts_min, threads)
+    data['timings'] = run.as_list()
+    data['total_timing'] = run.total
+    return data
+
+def _run_cell_phone_db(input_file, output_dir, plot_column_names, column_name, cpdb_file_path, name, counts_min, threads):
     import anndata as ad
     import ktplotspy as kpy
 
@@ -51,22 +65,35 @@ def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_nam
     print(f"Starting CellPhoneDB analysis for {name}...")
     os.makedirs(output_dir, exist_ok=True)
     ov.plot_set()
+    # check the label column from obs alone before loading the expression matrix
+    obs_columns = list(read_obs(input_file).columns)
+    if column_name not in obs_columns:
+        raise ValueError(f"Column '{column_name}' not found in adata.obs. Available columns: {obs_columns}")
     print(f"Loading data from {input_file}...")
-    adata = sc.read_h5ad(input_file)
-    if column_name not in adata.obs.columns:
-        raise ValueError(f"Column '{column_name}' not found in adata.obs. Available columns: {list(adata.obs.columns)}")
+    with stage('load'):
+        adata = read_h5ad(input_file)
     temp_dir = os.path.join(output_dir, 'temp')
     os.makedirs(temp_dir, exist_ok=True)
     print("Filtering cells and genes...")
-    sc.pp.filter_cells(adata, min_genes=200)
-    sc.pp.filter_genes(adata, min_cells=3)
-    adata1 = sc.AnnData(adata.X, 
+    with stage('filter', **adata_size(adata)):
+        sc.pp.filter_cells(adata, min_genes=200)
+        sc.pp.filter_genes(adata, min_cells=3)
+    with stage('load_database'):
+        genes = database_genes(cpdb_file_path)
+    # CellPhoneDB drops genes outside its database, so only those are handed over
+    in_database = adata.var_names.isin(genes)
+    if not in_database.any():
+        raise ValueError(f"None of the {adata.n_vars} genes are in the CellPhoneDB database {cpdb_file_path}; "
+                         f"the counts must use HGNC gene symbols")
+    print(f"{int(in_database.sum())} of {adata.n_vars} genes are in the CellPhoneDB database")
+    adata1 = sc.AnnData(adata.X[:, in_database],
                        obs=pd.DataFrame(index=adata.obs.index),
-                       var=pd.DataFrame(index=adata.var.index))
+                       var=pd.DataFrame(index=adata.var.index[in_database]))
     
     # Save normalized counts
     norm_log_path = os.path.join(temp_dir, 'norm_log.h5ad')
-    adata1.write_h5ad(norm_log_path, compression='gzip')
+    with stage('write_inputs', **adata_size(adata1)):
+        write_h5ad(adata1, norm_log_path)
     
     # Create metadata file
     print("Creating metadata file...")
@@ -87,57 +114,58 @@ def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_nam
     # Run CellPhoneDB analysis
     timestamp = datetime.now().strftime('%Y%m%d_%H%M')
     print("Running CellPhoneDB statistical analysis...")
-    try:
-        cpdb_results = cpdb_statistical_analysis_method.call(
-            cpdb_file_path=cpdb_file_path,
-            meta_file_path=meta_path,
-            counts_file_path=norm_log_path,
-            counts_data='hgnc_symbol',
-            active_tfs_file_path=None,
-            microenvs_file_path=None,
-            score_interactions=True,
-            iterations=1000,
-            threshold=0.1,
-            threads=10,
-            debug_seed=42,
-            result_precision=3,
-            pvalue=0.05,
-            subsampling=False,
-            subsampling_log=False,
-            subsampling_num_pc=100,
-            subsampling_num_cells=1000,
-            separator='|',
-            debug=False,
-            output_path=out_path,
-            output_suffix=timestamp
-        )
-    except Exception as e:
-        print(f"Error in CellPhoneDB analysis: {str(e)}")
-        raise
+    with stage('statistical_analysis', **adata_size(adata1), iterations=1000, threads=threads):
+        try:
+            cpdb_results = cpdb_statistical_analysis_method.call(
+                cpdb_file_path=cpdb_file_path,
+                meta_file_path=meta_path,
+                counts_file_path=norm_log_path,
+                counts_data='hgnc_symbol',
+                active_tfs_file_path=None,
+                microenvs_file_path=None,
+                score_interactions=True,
+                iterations=1000,
+                threshold=0.1,
+                threads=threads,
+                debug_seed=42,
+                result_precision=3,
+                pvalue=0.05,
+                subsampling=False,
+                subsampling_log=False,
+                subsampling_num_pc=100,
+                subsampling_num_cells=1000,
+                separator='|',
+                debug=False,
+                output_path=out_path,
+                output_suffix=timestamp
+            )
+        except Exception as e:
+            print(f"Error in CellPhoneDB analysis: {str(e)}")
+            raise
     
     # Save results
     results_path = os.path.join(output_dir, f'{name}_cpdb_results.pkl')
-    ov.utils.save(cpdb_results, results_path)
+    with stage('save_results'):
+        ov.utils.save(cpdb_results, results_path)
     data['files'].append((results_path, 'CellPhoneDB Results'))
     print(f"CellPhoneDB results saved to {results_path}")
     
     # Calculate network
     print("Calculating cell-cell interaction network...")
-    interaction = ov.single.cpdb_network_cal(
-        adata=adata,
-        pvals=cpdb_results['pvalues'],
-        celltype_key=column_name
-    )
-    
-    means = pd.read_csv(os.path.join(output_dir, f'{name}_cpdb_results/statistical_analysis_means_{timestamp}.txt'), sep="\t")
-    pvalues = pd.read_csv(os.path.join(output_dir, f'{name}_cpdb_results/statistical_analysis_pvalues_{timestamp}.txt'), sep="\t")
+    # the plots use the tables CellPhoneDB returned instead of re-reading the files it wrote
+    means = cpdb_results['means']
+    pvalues = cpdb_results['pvalues']
+    with stage('network', n_interactions=len(pvalues)):
+        interaction = interaction_network(pvalues)
     # deconvoluted = pd.read_csv(os.path.join(output_dir, f'{name}_cpdb_results/statistical_analysis_deconvoluted_{timestamp}.txt'), sep="\t")
     # interaction_scores = pd.read_csv(os.path.join(output_dir, f'{name}_cpdb_results/statistical_analysis_interaction_scores_{timestamp}.txt'), sep="\t")
 
     import ktplotspy as kpy
 
-    p = kpy.plot_cpdb_heatmap(pvals=pvalues, figsize=(5, 5), title="Sum of significant interactions")
-    p.savefig(os.path.join(output_dir, f'{name}_heatmap_{timestamp}.png'), dpi=300, bbox_inches='tight')
+    with stage('plot_heatmap'):
+        p = plot_interaction_heatmap(symmetrize(interaction['count_network']), figsize=(5, 5),
+                                     title="Sum of significant interactions")
+        p.savefig(os.path.join(output_dir, f'{name}_heatmap_{timestamp}.png'), dpi=300, bbox_inches='tight')
     data['figs'].append((os.path.join(output_dir, f'{name}_heatmap_{timestamp}.png'), 'Interaction Heatmap'))
     print(f"Heatmap saved to {os.path.join(output_dir, f'{name}_heatmap_{timestamp}.png')}")
     plot_column_names = [str(x).strip() for x in plot_column_names if str(x).strip()]
@@ -155,101 +183,127 @@ def run_cell_phone_db(input_file, output_dir, plot_column_names = [], column_nam
     print(f"Selected cell types: {selected_cell_types}")
     for cell_type1 in selected_cell_types:
         print(f"Generating dot plot for {cell_type1}...")
-        p = kpy.plot_cpdb(
-            adata=adata,
-            cell_type1=cell_type1,
-            cell_type2='.',
-            means=means,
-            pvals=pvalues,
-            celltype_key=column_name,
-            figsize=(13,20),
-            title=f"All Cell-Cell Interactions for {cell_type1}"
-        )
+        with stage('plot_dotplot', cell_type=str(cell_type1)):
+            p = kpy.plot_cpdb(
+                adata=adata,
+                cell_type1=cell_type1,
+                cell_type2='.',
+                means=means,
+                pvals=pvalues,
+                celltype_key=column_name,
+                figsize=(13,20),
+                title=f"All Cell-Cell Interactions for {cell_type1}"
+            )
 
-        p.save(os.path.join(output_dir, f'{name}_dotplot_{cell_type1}_{timestamp}.png'))
+            p.save(os.path.join(output_dir, f'{name}_dotplot_{cell_type1}_{timestamp}.png'))
         data['figs'].append((os.path.join(output_dir, f'{name}_dotplot_{cell_type1}_{timestamp}.png'), 'Detailed Dot Plots'))
         print(f"Dot plot saved to {os.path.join(output_dir, f'{name}_dotplot_{cell_type1}_{timestamp}.png')}")
     print("Generating network plot...")
-    fig, ax = plt.subplots(figsize=(8, 8))
-    ov.pl.cpdb_network(
-        adata,
-        interaction['interaction_edges'],
-        celltype_key=column_name,
-        counts_min=counts_min,
-        nodesize_scale=5,
-        ax=ax,
-    )
     network_path = os.path.join(output_dir, f'{name}_network_{timestamp}.png')
-    plt.savefig(network_path, dpi=300, bbox_inches='tight')
-    plt.close(fig)
-    data['figs'].append((os.path.join(output_dir, f'{name}_network_{timestamp}.png'), 'Network Plots'))
-    print(f"Network plot saved to {network_path}")
-    print("Generating detailed network plot...")
-    try:
-        ax = ov.single.cpdb_plot_network(
-            adata=adata,
-            interaction_edges=interaction['interaction_edges'],
+    with stage('plot_network'):
+        fig, ax = plt.subplots(figsize=(8, 8))
+        ov.pl.cpdb_network(
+            adata,
+            interaction['interaction_edges'],
             celltype_key=column_name,
-            nodecolor_dict=None,
-            title=name,
-            edgeswidth_scale=25,
-            nodesize_scale=10,
-            pos_scale=1,
-            pos_size=10,
-            figsize=(10, 10),
-            legend_ncol=3,
-            legend_bbox=(1.05, 0.5),
-            legend_fontsize=10,
+            counts_min=counts_min,
+            nodesize_scale=5,
+            ax=ax,
         )
-        fig = ax.figure
-        detailed_network_path = os.path.join(output_dir, f'{name}_detailed_network_{timestamp}.png')
-        data['figs'].append((os.path.join(output_dir, f'{name}_detailed_network_{timestamp}.png'), 'Network Plots'))
-        fig.savefig(detailed_network_path, dpi=300, bbox_inches='tight')
+        plt.savefig(network_path, dpi=300, bbox_inches='tight')
         plt.close(fig)
-        print(f"Detailed network plot saved to {detailed_network_path}")
-    except Exception as e:
-        print(f"Error generating detailed network plot: {str(e)}")
+    data['figs'].append((os.path.join(output_dir, f'{name}_network_{timestamp}.png'), 'Network Plots'))
+    print(f"Network plot saved to {network_path}")
+    print("Generating detailed network plot...")
+    with stage('plot_detailed_network'):
+        try:
+            ax = ov.single.cpdb_plot_network(
+                adata=adata,
+                interaction_edges=interaction['interaction_edges'],
+                celltype_key=column_name,
+                nodecolor_dict=None,
+                title=name,
+                edgeswidth_scale=25,
+                nodesize_scale=10,
+                pos_scale=1,
+                pos_size=10,
+                figsize=(10, 10),
+                legend_ncol=3,
+                legend_bbox=(1.05, 0.5),
+                legend_fontsize=10,
+            )
+            fig = ax.figure
+            detailed_network_path = os.path.join(output_dir, f'{name}_detailed_network_{timestamp}.png')
+            data['figs'].append((os.path.join(output_dir, f'{name}_detailed_network_{timestamp}.png'), 'Network Plots'))
+            fig.savefig(detailed_network_path, dpi=300, bbox_inches='tight')
+            plt.close(fig)
+            print(f"Detailed network plot saved to {detailed_network_path}")
+        except Exception as e:
+            print(f"Error generating detailed network plot: {str(e)}")
     
     print(f"CellPhoneDB analysis for {name} completed successfully!")
     data['timestamp'] = timestamp
     return data
 
-def run_inferncnv(input_file, output_dir, name, reference_key=None, gtf_path='db/gencode.v47.annotation.gtf.gz', reference_cat=None, cnv_threshold=0.03, cores=4,):
+def _neighbors_kwargs(backend, output_dir):
+    transformer = neighbors_transformer(backend, index_dir=os.path.join(output_dir, 'knn_index'))
+    return {} if transformer is None else {'transformer': transformer}
+
+def run_inferncnv(input_file, output_dir, name, reference_key=None, gtf_path='db/gencode.v47.annotation.gtf.gz', reference_cat=None, cnv_threshold=0.03, cores=4, neighbors_backend=None):
+    os.makedirs(output_dir, exist_ok=True)
+    with pipeline_run('infercnv', output_dir, name) as run:
+        data = _run_inferncnv(input_file, output_dir, name, reference_key, gtf_path, reference_cat, cnv_threshold, cores,
+                              neighbors_backend)
+    data['timings'] = run.as_list()
+    data['total_timing'] = run.total
+    return data
+
+def _run_inferncnv(input_file, output_dir, name, reference_key, gtf_path, reference_cat, cnv_threshold, cores,
+                   neighbors_backend):
     import infercnvpy as cnv
     data = {'figs': [], 'files': []}
     if reference_key == "": reference_key = None
     if reference_cat == "": reference_cat = None
     os.makedirs(output_dir, exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    adata = sc.read_h5ad(input_file)
-    ov.utils.get_gene_annotation(
-        adata, gtf=gtf_path,
-        gtf_by="gene_name"
-    )
+    with stage('load'):
+        adata = read_h5ad(input_file)
+    with stage('gene_annotation', n_vars=adata.n_vars):
+        ov.utils.get_gene_annotation(
+            adata, gtf=gtf_path,
+            gtf_by="gene_name"
+        )
     adata=adata[:,~adata.var['chrom'].isnull()]
     adata.var['chromosome']=adata.var['chrom']
     adata.var['start']=adata.var['chromStart']
     adata.var['end']=adata.var['chromEnd']
     adata.var['ensg']=adata.var['gene_id']
     adata.var.loc[:, ["ensg", "chromosome", "start", "end"]].head()
-    if reference_cat == None or reference_cat == "":
-        cnv.tl.infercnv(
-            adata,
-            reference_key=reference_key,
-            window_size=250,
-        )
-    else:
-        cnv.tl.infercnv(
-            adata,
-            reference_key=reference_key,
-            reference_cat=reference_cat,
-            window_size=250,
-        )
-    cnv.tl.pca(adata)
-    cnv.pp.neighbors(adata)
-    cnv.tl.leiden(adata)
-    cnv.tl.umap(adata)
-    cnv.tl.cnv_score(adata)
+    with stage('infercnv', **adata_size(adata), window_size=250):
+        if reference_cat == None or reference_cat == "":
+            cnv.tl.infercnv(
+                adata,
+                reference_key=reference_key,
+                window_size=250,
+            )
+        else:
+            cnv.tl.infercnv(
+                adata,
+                reference_key=reference_key,
+                reference_cat=reference_cat,
+                window_size=250,
+            )
+    with stage('cnv_pca', n_obs=adata.n_obs):
+        cnv.tl.pca(adata)
+    with stage('cnv_neighbors', n_obs=adata.n_obs, backend=neighbors_backend):
+        # infercnvpy forwards keyword arguments to sc.pp.neighbors
+        cnv.pp.neighbors(adata, **_neighbors_kwargs(neighbors_backend, output_dir))
+    with stage('cnv_leiden', n_obs=adata.n_obs):
+        cnv.tl.leiden(adata)
+    with stage('cnv_umap', n_obs=adata.n_obs):
+        cnv.tl.umap(adata)
+    with stage('cnv_score', n_obs=adata.n_obs):
+        cnv.tl.cnv_score(adata)
     fig, ax = plt.subplots(figsize=(10, 8))
     sc.pl.umap(adata, color="cnv_score", ax=ax, show=False)
     fig.savefig(os.path.join(output_dir, f'{name}_cnv_umap_{timestamp}.png'), dpi=300, bbox_inches='tight')
@@ -269,28 +323,32 @@ def run_inferncnv(input_file, output_dir, name, reference_key=None, gtf_path='db
     tumor=adata[adata.obs['cnv_status']=='tumor']
     adata=tumor
     print('Preprocessing...')
-    sc.pp.filter_cells(adata, min_genes=200)
-    sc.pp.filter_genes(adata, min_cells=3)
-    adata.var['mt'] = adata.var_names.str.startswith('MT-')
-    sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], percent_top=None, log1p=False, inplace=True)
-    if not (adata.obs.pct_counts_mt == 0).all():
-        adata = adata[adata.obs.pct_counts_mt < 30, :]
+    with stage('tumor_preprocessing', **adata_size(adata)):
+        sc.pp.filter_cells(adata, min_genes=200)
+        sc.pp.filter_genes(adata, min_cells=3)
+        adata.var['mt'] = adata.var_names.str.startswith('MT-')
+        sc.pp.calculate_qc_metrics(adata, qc_vars=['mt'], percent_top=None, log1p=False, inplace=True)
+        if not (adata.obs.pct_counts_mt == 0).all():
+            adata = adata[adata.obs.pct_counts_mt < 30, :]
 
-    adata.raw = adata.copy()
+        adata.raw = adata.copy()
 
-    sc.pp.highly_variable_genes(adata)
-    adata = adata[:, adata.var.highly_variable]
-    sc.pp.scale(adata)
-    sc.tl.pca(adata, svd_solver='arpack')
-    sc.pp.neighbors(adata, n_pcs=20)
-    sc.tl.umap(adata)
-    ov.utils.download_GDSC_data()
-    ov.utils.download_CaDRReS_model()
+        sc.pp.highly_variable_genes(adata)
+        adata = adata[:, adata.var.highly_variable]
+        sc.pp.scale(adata)
+        sc.tl.pca(adata, svd_solver='arpack')
+        sc.pp.neighbors(adata, n_pcs=20, **_neighbors_kwargs(neighbors_backend, output_dir))
+        sc.tl.umap(adata)
+    with stage('download_models'):
+        ov.utils.download_GDSC_data()
+        ov.utils.download_CaDRReS_model()
     print('at running')
-    adata, res,plot_df = ov.single.autoResolution(adata,cpus=cores)
-    job=ov.single.Drug_Response(adata,scriptpath='CaDRReS-Sc',
-                                    modelpath='models/',
-                                    output=output_dir)
+    with stage('auto_resolution', n_obs=adata.n_obs, cores=cores):
+        adata, res,plot_df = ov.single.autoResolution(adata,cpus=cores)
+    with stage('drug_response', **adata_size(adata)):
+        job=ov.single.Drug_Response(adata,scriptpath='CaDRReS-Sc',
+                                        modelpath='models/',
+                                        output=output_dir)
     data['adata'] = summarize_h5ad(adata=adata)
     for file in os.listdir(output_dir):
         if file in ['IC50_prediction.csv','drug_kill_prediction.csv', 'predicted cell death.png', 'GDSC prediction.png']:
@@ -16,6 +16,16 @@ import os
 import numpy as np
 import omicverse as ov
 from .utils import summarize_h5ad
+from .instrumentation import adata_size, pipeline_run, stage
+from .ingest import load_input
+from .pca import scaled_pca
+from .doublets import quality_filter, remove_doublets
+from .neighbors import neighbors_transformer
+from .sketch import SKETCH_REP, propagate, sketch_indices, sketch_space
+from .output import write_annotations, write_h5ad
+from .scsa import annotation_details, cluster_labels, rank_clusters, score_clusters
+from .pseudobulk import dotplot_frames, pseudobulk
+import scipy.sparse
 print(f'omicverse version: {ov.__version__}')
 print(f'scanpy version: {sc.__version__}')
 
@@ -28,7 +38,22 @@ def default_params():
         'n_hvgs': 2000,
         'n_pcs': 50,
         'n_neighbors': 15,
-        'resolution': 0.8
+        'resolution': 0.8,
+        'pca_mode': 'dense',
+        'pca_solver': 'arpack',
+        'neighbors_backend': 'scanpy',
+        'sketch_size': 0,
+        'sketch_method': 'geometric',
+        'doublet_method': 'scrublet',
+        'doublet_batch_key': None
+    }
+
+def qc_thresholds(params):
+    """`tresh` of `ov.pp.qc` for the pipeline parameters."""
+    return {
+        'mito_perc': params['mito_threshold'],
+        'nUMIs': params['min_counts'],
+        'detected_genes': params['min_genes']
     }
 
 def run_preprocessing(adata, output_dir, params, timestamp, name, data={}):
@@ -51,6 +76,24 @@ def run_preprocessing(adata, output_dir, params, timestamp, name, data={}):
         - n_pcs: Number of principal components to use
         - n_neighbors: Number of neighbors for graph construction
         - resolution: Resolution parameter for Leiden clustering
+        - pca_mode: 'dense' writes the scaled layer and runs PCA on it;
+          'implicit' keeps X sparse and float32, folds scaling into the PCA
+          (no clipping at max_value) and stores raw as a reference to the
+          normalized matrix instead of a copy
+        - pca_solver: 'arpack' or 'randomized' (implicit mode only)
+        - neighbors_backend: 'scanpy' (scanpy's own choice), 'exact',
+          'nndescent' or 'hnsw'; the latter three save their index under
+          <output_dir>/knn_index and reuse it on reruns over the same PCA
+        - sketch_size: when non-zero and the input has more cells, `annotate`
+          runs preprocessing and SCSA on a sketch of this many cells and
+          propagates the results to all cells (see `sketch.py`)
+        - sketch_method: 'geometric' or 'leverage'
+        - doublet_method: 'scrublet' (default) runs scrublet inside
+          `ov.pp.qc` before preprocessing; 'native' scores doublets after PCA
+          on the pipeline's own PCA, per sample in parallel (see
+          `doublets.py`), so the HVGs and PCA include the removed doublets
+        - doublet_batch_key: obs column to score doublets per value of;
+          defaults to 'sample' or 'batch' when present
         
     Returns:
     --------
@@ -59,7 +102,8 @@ def run_preprocessing(adata, output_dir, params, timestamp, name, data={}):
     """
     print("Starting preprocessing...")
     final_params = default_params()
-    for key in ['mito_prefix', 'mito_threshold', 'min_genes', 'min_counts', 'n_hvgs', 'n_pcs', 'n_neighbors', 'resolution']:
+    for key in ['mito_prefix', 'mito_threshold', 'min_genes', 'min_counts', 'n_hvgs', 'n_pcs', 'n_neighbors', 'resolution', 'pca_mode', 'pca_solver', 'neighbors_backend',
+                'sketch_size', 'sketch_method', 'doublet_method', 'doublet_batch_key']:
         if key in params:
             final_params[key] = params[key]
 
@@ -71,46 +115,88 @@ def run_preprocessing(adata, output_dir, params, timestamp, name, data={}):
     print("Initializing OmicVerse...")
     ov.ov_plot_set()
     print("Performing quality control...")
-    adata = ov.pp.qc(adata, tresh={
-        'mito_perc': final_params['mito_threshold'], 
-        'nUMIs': final_params['min_counts'], 
-        'detected_genes': final_params['min_genes']
-    }, doublets_method='scrublet')
+    tresh = qc_thresholds(final_params)
+    with stage('qc', **adata_size(adata), doublet_method=final_params['doublet_method']):
+        if final_params['doublet_method'] == 'scrublet':
+            adata = ov.pp.qc(adata, tresh=tresh, doublets_method='scrublet')
+        else:
+            adata = quality_filter(adata, tresh, mt_startswith=final_params['mito_prefix'])
     print("Normalizing and finding highly variable genes...")
-    adata = ov.pp.preprocess(adata, mode='shiftlog|pearson', n_HVGs=final_params['n_hvgs'])
-    adata.raw = adata
-    adata = adata[:, adata.var.highly_variable_features]
-    print("Scaling data...")
-    ov.pp.scale(adata)
-    print("Performing PCA...")
-    ov.pp.pca(adata, layer='scaled', n_pcs=final_params['n_pcs'])
+    with stage('normalize_hvg', **adata_size(adata)):
+        adata = ov.pp.preprocess(adata, mode='shiftlog|pearson', n_HVGs=final_params['n_hvgs'])
+        if final_params['pca_mode'] == 'implicit':
+            normalized = adata
+            if scipy.sparse.issparse(normalized.X):
+                normalized.X = normalized.X.astype(np.float32, copy=False)
+            # subset before setting raw so that materializing the HVG subset does not copy raw
+            adata = normalized[:, normalized.var.highly_variable_features].copy()
+            adata.raw = normalized
+            del normalized
+        else:
+            adata.raw = adata
+            adata = adata[:, adata.var.highly_variable_features]
+    if final_params['pca_mode'] == 'implicit':
+        print("Performing PCA with implicit scaling...")
+        with stage('pca', **adata_size(adata), n_pcs=final_params['n_pcs'], mode='implicit'):
+            scaled_pca(adata, n_pcs=final_params['n_pcs'], solver=final_params['pca_solver'])
+    else:
+        print("Scaling data...")
+        with stage('scale', **adata_size(adata)):
+            ov.pp.scale(adata)
+        print("Performing PCA...")
+        with stage('pca', **adata_size(adata), n_pcs=final_params['n_pcs']):
+            ov.pp.pca(adata, layer='scaled', n_pcs=final_params['n_pcs'])
+    if final_params['doublet_method'] != 'scrublet':
+        print("Detecting doublets...")
+        with stage('doublets', **adata_size(adata)):
+            adata = remove_doublets(adata, batch_key=final_params['doublet_batch_key'])
     print("Building neighborhood graph...")
-    sc.pp.neighbors(adata, n_neighbors=final_params['n_neighbors'], 
-                   n_pcs=final_params['n_pcs'],
-                   use_rep='scaled|original|X_pca')
+    with stage('neighbors', n_obs=adata.n_obs, n_neighbors=final_params['n_neighbors'],
+               backend=final_params['neighbors_backend']):
+        transformer = neighbors_transformer(final_params['neighbors_backend'],
+                                            n_neighbors=final_params['n_neighbors'],
+                                            index_dir=os.path.join(output_dir, 'knn_index'))
+        sc.pp.neighbors(adata, n_neighbors=final_params['n_neighbors'], 
+                       n_pcs=final_params['n_pcs'],
+                       use_rep='scaled|original|X_pca',
+                       transformer=transformer)
+        if transformer is not None:
+            adata.uns['knn_index'] = {
+                'path': transformer.index_path,
+                'backend': transformer.backend,
+                'metric': transformer.metric,
+                'use_rep': 'scaled|original|X_pca',
+                'n_pcs': final_params['n_pcs'],
+            }
     print("Performing clustering...")
-    sc.tl.leiden(adata, resolution=final_params['resolution'])
+    with stage('leiden', n_obs=adata.n_obs, resolution=final_params['resolution']):
+        sc.tl.leiden(adata, resolution=final_params['resolution'])
     print("Generating visualization coordinates...")
-    adata.obsm["X_mde"] = ov.utils.mde(adata.obsm["scaled|original|X_pca"])
+    with stage('mde', n_obs=adata.n_obs):
+        adata.obsm["X_mde"] = ov.utils.mde(adata.obsm["scaled|original|X_pca"])
     print("Generating UMAP...")
-    sc.tl.umap(adata)
+    with stage('umap', n_obs=adata.n_obs):
+        sc.tl.umap(adata)
     print("Generating cluster UMAP with counts...")
-    cluster_key = "leiden"
-    counts = adata.obs[cluster_key].value_counts().to_dict()
-    new_cats = {cat: f"{cat} (n={counts[cat]})" for cat in adata.obs[cluster_key].cat.categories}
-    annot_col = f"{cluster_key}_cnt"
-    adata.obs[annot_col] = adata.obs[cluster_key].cat.rename_categories(new_cats)
+    with stage('plot_clusters', n_obs=adata.n_obs):
+        cluster_key = "leiden"
+        counts = adata.obs[cluster_key].value_counts().to_dict()
+        new_cats = {cat: f"{cat} (n={counts[cat]})" for cat in adata.obs[cluster_key].cat.categories}
+        annot_col = f"{cluster_key}_cnt"
+        adata.obs[annot_col] = adata.obs[cluster_key].cat.rename_categories(new_cats)
 
-    fig, ax = plt.subplots(figsize=(10, 8))
-    sc.pl.umap(adata, color=annot_col, legend_loc="right margin", ax=ax, show=False)
-    umap_path = os.path.join(output_dir, f"{name}_clusters_umap_{timestamp}.png")
-    fig.savefig(umap_path, dpi=300, bbox_inches="tight")
-    plt.close(fig)
+        fig, ax = plt.subplots(figsize=(10, 8))
+        sc.pl.umap(adata, color=annot_col, legend_loc="right margin", ax=ax, show=False)
+        umap_path = os.path.join(output_dir, f"{name}_clusters_umap_{timestamp}.png")
+        fig.savefig(umap_path, dpi=300, bbox_inches="tight")
+        plt.close(fig)
     print(f"Cluster UMAP saved to {umap_path}")
     data['umap_path'] = umap_path
     print("Saving results...")
     output_file = os.path.join(output_dir, f"preprocessed_{name}_{timestamp}.h5ad")
-    adata.write(output_file)
+    with stage('write', **adata_size(adata)):
+        write_h5ad(adata, output_file)
+    data['preprocessed_output_file'] = output_file
     
     print("Pipeline completed successfully!")
     return adata, final_params
@@ -154,73 +240,104 @@ def annotate(
         Whether to generate marker gene heatmap
     """
     print(f"Starting cell type analysis with input file: {input_file}")
-
-    print("Loading data...")
-    if input_file.endswith('.h5ad'):
-        adata = sc.read_h5ad(input_file)
-    elif input_file.endswith('.h5'):
-        # Support for 10X Genomics H5 files
-        adata = sc.read_10x_h5(input_file)
-    elif input_file.endswith('.csv') or input_file.endswith('.txt'):
-        adata = sc.read_csv(input_file).transpose()
-    elif input_file.endswith('.mtx'):
-        mtx_dir = os.path.dirname(input_file)
-        adata = sc.read_10x_mtx(mtx_dir)
-    else:
-        raise ValueError(f"Unsupported file format: {input_file}")
-    
     outputs = {}
     data = {'figs': [], 'files': []}
-    
     os.makedirs(output_dir, exist_ok=True)
-    sc.settings.verbosity = 1
-    sc.settings.figdir = output_dir
-    sc.settings.autoshow = False
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-    params = {}
-    if not preprocessed:
-        adata, params = run_preprocessing(adata, output_dir, preprocessing_params, timestamp, name, data=data)
-    used_annotators = []
-    if use_cellmarker:
-        print("Running cellmarker annotation...")
-        adata = annotate_with_scsa(adata, output_dir, cell_type=('normal'),db_type=('cellmarker'), name=name, data=data)
-        used_annotators.append('cellmarker')
 
-    if use_panglao:
-        print("Running Panglao annotation...")
-        adata = annotate_with_scsa(adata, output_dir, cell_type='normal',db_type='panglaodb', name=name, data=data)
-        used_annotators.append('panglaodb')
+    with pipeline_run('annotate', output_dir, name) as run:
+        print("Loading data...")
+        with stage('load'):
+            # h5ad, 10x h5, CSV/TXT and MTX inputs are converted once to a cached h5ad
+            adata = load_input(input_file)
 
-    if use_cancer_single_cell_atlas:
-        print("Running Cancer Single Cell Atlas annotation...")
-        adata = annotate_with_scsa(adata, output_dir, cell_type='cancer',db_type='cancersea', name=name, data=data)
-        used_annotators.append('cancersea')
+        sc.settings.verbosity = 1
+        sc.settings.figdir = output_dir
+        sc.settings.autoshow = False
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+        params = {}
+        full = None
+        sketch_params = dict(default_params(), **preprocessing_params)
+        sketch_size = int(sketch_params['sketch_size'] or 0)
+        if not preprocessed and sketch_size and adata.n_obs > sketch_size:
+            print(f"Sketching {sketch_size} of {adata.n_obs} cells...")
+            with stage('sketch', **adata_size(adata), sketch_size=sketch_size):
+                # the cells a full run keeps: the sketch and the propagated output skip the ones failing QC
+                full = quality_filter(adata, qc_thresholds(sketch_params), mt_startswith=sketch_params['mito_prefix'])
+                full.obsm[SKETCH_REP], _ = sketch_space(full, n_hvgs=sketch_params['n_hvgs'],
+                                                        n_pcs=sketch_params['n_pcs'])
+                adata = full[sketch_indices(full.obsm[SKETCH_REP], sketch_size,
+                                            method=sketch_params['sketch_method'])].copy()
+        if not preprocessed:
+            with stage('preprocessing', **adata_size(adata)):
+                adata, params = run_preprocessing(adata, output_dir, preprocessing_params, timestamp, name, data=data)
+        # the annotated file only adds obs columns and uns entries to the preprocessed one
+        preprocessed_uns_keys = list(adata.uns.keys())
+        used_annotators = []
+        ranking = None
+        if use_cellmarker or use_panglao or use_cancer_single_cell_atlas:
+            # one Wilcoxon ranking of the leiden clusters serves every marker database
+            with stage('rank_genes', **adata_size(adata)):
+                ranking = rank_clusters(adata, 'leiden')
+        if use_cellmarker:
+            print("Running cellmarker annotation...")
+            with stage('scsa_cellmarker', **adata_size(adata)):
+                adata = annotate_with_scsa(adata, output_dir, cell_type=('normal'),db_type=('cellmarker'), name=name, data=data, ranking=ranking)
+            used_annotators.append('cellmarker')
 
-    for annotator in used_annotators:
-        adata.obs['cell_type'] = adata.obs[annotator]
-        break
+        if use_panglao:
+            print("Running Panglao annotation...")
+            with stage('scsa_panglaodb', **adata_size(adata)):
+                adata = annotate_with_scsa(adata, output_dir, cell_type='normal',db_type='panglaodb', name=name, data=data, ranking=ranking)
+            used_annotators.append('panglaodb')
 
-    # fig, ax = ov.utils.embedding(adata,
-    #                basis='X_mde',
-    #                color=['leiden',*used_annotators], 
-    #                legend_loc='on data', 
-    #                frameon='small',
-    #                legend_fontoutline=2,
-    #                palette=ov.utils.palette()[14:],
-    #               )
-    # fig.savefig(os.path.join(output_dir, f'{name}_combined_annotation_umap_{timestamp}.png'), dpi=300)
-    
-    # Save annotated data
-    output_file = os.path.join(output_dir, f"annotated_{name}_{timestamp}.h5ad")
-    print(f"Saving annotated data to {output_file}")
+        if use_cancer_single_cell_atlas:
+            print("Running Cancer Single Cell Atlas annotation...")
+            with stage('scsa_cancersea', **adata_size(adata)):
+                adata = annotate_with_scsa(adata, output_dir, cell_type='cancer',db_type='cancersea', name=name, data=data, ranking=ranking)
+            used_annotators.append('cancersea')
+
+        for annotator in used_annotators:
+            adata.obs['cell_type'] = adata.obs[annotator]
+            break
 
-    # 1) Persist to disk first so downstream steps can access the file
-    adata.write(output_file)
+        if full is not None:
+            print("Propagating sketch results to all cells...")
+            with stage('propagate', n_obs=full.n_obs, sketch_size=adata.n_obs):
+                confidence = propagate(full, adata, ['leiden', *used_annotators, 'cell_type'], ['X_umap', 'X_mde'])
+            data['sketch'] = {
+                'method': sketch_params['sketch_method'],
+                'sketch_size': int(adata.n_obs),
+                'n_obs': int(full.n_obs),
+                'transfer_confidence': confidence,
+            }
+            adata = full
 
-    # 2) Then build a lightweight summary for the response payload
-    data['adata']           = summarize_h5ad(output_file)
+        # fig, ax = ov.utils.embedding(adata,
+        #                basis='X_mde',
+        #                color=['leiden',*used_annotators], 
+        #                legend_loc='on data', 
+        #                frameon='small',
+        #                legend_fontoutline=2,
+        #                palette=ov.utils.palette()[14:],
+        #               )
+        # fig.savefig(os.path.join(output_dir, f'{name}_combined_annotation_umap_{timestamp}.png'), dpi=300)
+        
+        # Save annotated data
+        output_file = os.path.join(output_dir, f"annotated_{name}_{timestamp}.h5ad")
+        print(f"Saving annotated data to {output_file}")
+
+        # 1) Persist to disk first so downstream steps can access the file
+        with stage('write', **adata_size(adata)):
+            write_annotations(adata, output_file, parent=data.get('preprocessed_output_file'),
+                              parent_uns_keys=preprocessed_uns_keys)
+
+        # 2) Then build a lightweight summary for the response payload
+        with stage('summary'):
+            data['adata']           = summarize_h5ad(output_file)
     data['used_annotators'] = used_annotators
     data['adata_output_file'] = output_file
+    data['timings'] = run.as_list()
+    data['total_timing'] = run.total
     outputs['name'] = name
     outputs['input_file'] = input_file
     outputs['output_dir'] = output_dir
@@ -230,32 +347,29 @@ def annotate(
     print("Cell type analysis complete!")
     return outputs, params
 
-def annotate_with_scsa(adata, output_dir, cell_type='normal', db_type='cellmarker', name='', data={}):
-    """Annotate clusters using OmicVerse"""
-    print("Running OmicVerse annotation...")
+def annotate_with_scsa(adata, output_dir, cell_type='normal', db_type='cellmarker', name='', data={}, ranking=None):
+    """
+    Annotate clusters with an SCSA marker database (see scsa.py)
+
+    `ranking` is a `rank_clusters` result to reuse; without it the leiden
+    clusters are ranked here.
+    """
+    print("Running SCSA annotation...")
     ov.ov_plot_set()
     timestamp = datetime.now().strftime('%Y%m%d_%H%M')
     print("annotation...")
-    scsa=ov.single.pySCSA(adata=adata,
-                    foldchange=1.5,
-                    pvalue=0.01,
-                    celltype=cell_type,
-                    target=db_type,
-                    tissue='All',
-                    model_path='db/pySCSA_2024_v1_plus.db'                    
-    )
-    scsa.cell_anno(clustertype='leiden',
-               cluster='all',rank_rep=True)
-    scsa.cell_auto_anno(adata,key=db_type)
-    import io
-    import sys
-    from contextlib import redirect_stdout
+    with stage('cell_anno', n_obs=adata.n_obs):
+        if ranking is None:
+            ranking = rank_clusters(adata, 'leiden')
+        result = score_clusters(ranking, db_type, celltype=cell_type)
+        adata.obs[db_type] = adata.obs['leiden'].map(cluster_labels(result, ranking['clusters'])).astype('category')
+        print(f'...cell type added to {db_type} on obs of anndata')
+    details = annotation_details(result)
     annotation_output_file = os.path.join(output_dir, f'{name}_{db_type}_annotation_details_{timestamp}.txt')
     data['files'].append((annotation_output_file, f'{db_type} Clusters'))
     with open(annotation_output_file, 'w') as f:
-        with redirect_stdout(f):
-            scsa.cell_anno_print()
-    scsa.cell_anno_print()
+        f.write(details)
+    print(details, end='')
     print(f"Annotation details saved to: {annotation_output_file}")
 
     # Build a counts-aware categorical column for nicer legend labels
@@ -264,24 +378,33 @@ def annotate_with_scsa(adata, output_dir, cell_type='normal', db_type='cellmarke
     annot_col = f"{db_type}_cnt"
     adata.obs[annot_col] = adata.obs[db_type].astype('category').cat.rename_categories(new_cats)
 
-    fig, ax = ov.utils.plot_embedding(
-        adata,
-        basis='X_mde',
-        color=annot_col,
-        legend_loc='on data',
-        frameon='small',
-        legend_fontoutline=2,
-        palette=ov.utils.palette()[14:],
-        title=f'{db_type} annotation'
-    )
-    fig.savefig(os.path.join(output_dir, f'{name}_{db_type}_scsa_annotation_{timestamp}.png'), dpi=300)
+    with stage('plot_embedding', n_obs=adata.n_obs):
+        fig, ax = ov.utils.plot_embedding(
+            adata,
+            basis='X_mde',
+            color=annot_col,
+            legend_loc='on data',
+            frameon='small',
+            legend_fontoutline=2,
+            palette=ov.utils.palette()[14:],
+            title=f'{db_type} annotation'
+        )
+        fig.savefig(os.path.join(output_dir, f'{name}_{db_type}_scsa_annotation_{timestamp}.png'), dpi=300)
     data['figs'].append((os.path.join(output_dir, f'{name}_{db_type}_scsa_annotation_{timestamp}.png'), f'{db_type} Clusters'))
-    path_marker_dict, marker_dict = save_marker_gene_expression(adata, output_dir, name, db_type, timestamp, data)
+    with stage('marker_genes'):
+        path_marker_dict, marker_dict = save_marker_gene_expression(adata, output_dir, name, db_type, timestamp, data)
     data['files'].append((path_marker_dict, f'{db_type} Marker Gene Expression'))
     sc.settings.figdir = output_dir
-    sc.pl.dotplot(adata, marker_dict, groupby=db_type, standard_scale="var", save=f'{name}_{db_type}_{timestamp}.png')
+    with stage('dotplot', n_obs=adata.n_obs, n_cell_types=len(marker_dict)):
+        # sc.pl.dotplot aggregates raw when there is one
+        groups = pseudobulk(adata, db_type, use_raw=True)
+        markers = [g for genes in marker_dict.values() for g in genes]
+        dot_color_df, dot_size_df = dotplot_frames(groups, markers, standard_scale="var")
+        sc.pl.dotplot(adata, marker_dict, groupby=db_type, standard_scale="var", dot_color_df=dot_color_df,
+                      dot_size_df=dot_size_df, save=f'{name}_{db_type}_{timestamp}.png')
     data['figs'].append((os.path.join(output_dir, f'dotplot_{name}_{db_type}_{timestamp}.png'), f'{db_type} Marker Gene Expression'))
-    path_marker_gene_expression_counts = count_marker_gene_expression(adata, marker_dict, timestamp, annotation_column=db_type, min_expression=0.1, output_dir=output_dir, name=name)
+    with stage('marker_counts', n_obs=adata.n_obs):
+        path_marker_gene_expression_counts = count_marker_gene_expression(adata, marker_dict, timestamp, annotation_column=db_type, min_expression=0.1, output_dir=output_dir, name=name)
     data['files'].append((path_marker_gene_expression_counts, f'{db_type} Marker Gene Expression'))
     return adata
 
@@ -315,57 +438,37 @@ def count_marker_gene_expression(adata, marker_dict, timestamp, annotation_colum
     pd.DataFrame
         DataFrame with counts and percentages for each marker gene in each cell type
     """
-    import scipy.sparse
-    
-    # Flatten the marker dictionary to get all unique markers
-    all_markers = []
-    for markers in marker_dict.values():
-        all_markers.extend(markers)
-    
     # Remove duplicates while preserving order
-    unique_markers = []
-    for marker in all_markers:
-        if marker not in unique_markers and marker in adata.var_names:
-            unique_markers.append(marker)
-    
-    # Get all cell types
-    cell_types = adata.obs[annotation_column].unique()
-    
-    # Initialize results
-    results = []
-    
-    # For each marker gene
-    for marker in unique_markers:
-        # Get expression vector for this gene
-        if scipy.sparse.issparse(adata.X):
-            expr = adata[:, marker].X.toarray().flatten()
-        else:
-            expr = adata[:, marker].X.flatten()
-        
-        # For each cell type
-        for cell_type in cell_types:
-            # Get mask for cells of this type
-            mask = adata.obs[annotation_column] == cell_type
-            
-            # Count cells with expression above threshold
-            total_cells = np.sum(mask)
-            expressing_cells = np.sum((expr > min_expression) & mask)
-            
-            # Calculate percentage
-            percentage = (expressing_cells / total_cells * 100) if total_cells > 0 else 0
-            
-            # Add to results
-            results.append({
-                'Marker Gene': marker,
-                'Cell Type': cell_type,
-                'Total Cells': total_cells,
-                'Expressing Cells': expressing_cells,
-                'Percentage': percentage,
-                'Marker For': next((ct for ct, markers in marker_dict.items() if marker in markers), 'Unknown')
-            })
-    
-    # Convert to DataFrame
-    results_df = pd.DataFrame(results)
+    unique_markers = [m for m in dict.fromkeys(g for markers in marker_dict.values() for g in markers)
+                      if m in adata.var_names]
+    marker_for = {}
+    for cell_type, markers in marker_dict.items():
+        for marker in markers:
+            marker_for.setdefault(marker, cell_type)
+
+    # per cell type aggregates of X, shared with other consumers of the same grouping
+    groups = pseudobulk(adata, annotation_column, thresholds=(min_expression,))
+
+    # Cell types in order of appearance; cells without a label have no group
+    cell_types = [ct for ct in adata.obs[annotation_column].unique() if not pd.isna(ct)]
+    labels = [str(ct) for ct in cell_types]
+    total = groups.size().reindex(labels).to_numpy()
+    expressing = groups.count(min_expression, unique_markers).reindex(labels).to_numpy()
+
+    # one row per (marker, cell type), markers outermost
+    n_types = len(cell_types)
+    total_cells = np.tile(total, len(unique_markers)).astype(np.int64)
+    expressing_cells = expressing.T.ravel().astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentage = np.where(total_cells > 0, expressing_cells / total_cells * 100, 0)
+    results_df = pd.DataFrame({
+        'Marker Gene': np.repeat(unique_markers, n_types),
+        'Cell Type': np.tile(np.array(cell_types, dtype=object), len(unique_markers)),
+        'Total Cells': total_cells,
+        'Expressing Cells': expressing_cells,
+        'Percentage': percentage,
+        'Marker For': [marker_for.get(m, 'Unknown') for m in np.repeat(unique_markers, n_types)],
+    })
     filename = f'{name}_{annotation_column}_marker_gene_expression_counts_{timestamp}.csv'
     results_df.to_csv(f'{output_dir}/{filename}', index=False)
     
@@ -0,0 +1,230 @@
+"""
+SQLite catalog of finished pipeline runs.
+
+Every pipeline request records one row when it finishes (or fails): the
+pipeline, name, status, parameters, input paths with a content fingerprint,
+the artifacts it wrote with their sizes, stage timings and the summary of
+its result.  The `/runs` endpoints list and look up runs from indexed
+columns instead of walking output directories.
+
+The database lives at CELLPILOT_CATALOG (default `cache/catalog.sqlite`) and
+runs in WAL mode, so listing never waits for a pipeline that is recording.
+Listing is keyset-paginated on the run id: pass the `next` value of a page
+as `before` to get the following one.
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from .coalesce import ARTIFACT_KEYS
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+# bulky result fields that live in their own columns or tables
+SUMMARY_SKIP = ('figs', 'files', 'timings', 'total_timing')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pipeline TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    timestamp TEXT,
+    input_path TEXT,
+    output_dir TEXT,
+    wall_seconds REAL,
+    error TEXT,
+    params TEXT,
+    summary TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_pipeline ON runs (pipeline, id);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (name, id);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status, id);
+CREATE INDEX IF NOT EXISTS runs_output_dir ON runs (output_dir, id);
+CREATE INDEX IF NOT EXISTS runs_created_at ON runs (created_at);
+CREATE TABLE IF NOT EXISTS inputs (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS inputs_run ON inputs (run_id);
+CREATE INDEX IF NOT EXISTS inputs_fingerprint ON inputs (fingerprint, run_id);
+CREATE INDEX IF NOT EXISTS inputs_path ON inputs (path, run_id);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    label TEXT,
+    size_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS artifacts_run ON artifacts (run_id);
+CREATE INDEX IF NOT EXISTS artifacts_path ON artifacts (path);
+"""
+
+LIST_COLUMNS = ('id', 'pipeline', 'name', 'status', 'created_at', 'timestamp', 'input_path', 'output_dir',
+                'wall_seconds', 'error')
+# filter name -> SQL condition on the runs table
+FILTERS = {
+    'pipeline': 'pipeline = ?',
+    'name': 'name = ?',
+    'status': 'status = ?',
+    'output_dir': 'output_dir = ?',
+    'since': 'created_at >= ?',
+    'until': 'created_at < ?',
+    'fingerprint': 'id IN (SELECT run_id FROM inputs WHERE fingerprint = ?)',
+    'input_path': 'id IN (SELECT run_id FROM inputs WHERE path = ?)',
+    'artifact': 'id IN (SELECT run_id FROM artifacts WHERE path = ?)',
+}
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+
+def catalog_path():
+    return os.environ.get('CELLPILOT_CATALOG', os.path.join('cache', 'catalog.sqlite'))
+
+
+def connect(path=None):
+    """A connection to the catalog, creating the schema on first use."""
+    path = path or catalog_path()
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    with _init_lock:
+        if path not in _initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.executescript(SCHEMA)
+            _initialized.add(path)
+    return conn
+
+
+def _fingerprint(path):
+    """Content hash of an input file, or None for inputs that are not plain files (e.g. Zarr stores)."""
+    from .ingest import source_hash
+    try:
+        return source_hash(path)
+    except OSError:
+        return None
+
+
+def _artifacts(data):
+    """(path, kind, label, size) of every file a pipeline result references."""
+    rows = []
+    for key in ARTIFACT_KEYS:
+        value = data.get(key)
+        entries = [value] if isinstance(value, str) else value if isinstance(value, list) else []
+        for entry in entries:
+            path, label = (entry[0], entry[1] if len(entry) > 1 else None) if isinstance(entry, (list, tuple)) \
+                else (entry, None)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            rows.append((str(path), key, label, size))
+    return rows
+
+
+def _json(value):
+    return json.dumps(value, default=str) if value is not None else None
+
+
+def record_run(pipeline, name, input_paths, output_dir, data=None, params=None, status='ok', error=None,
+               path=None):
+    """
+    Record a finished run and return its id.  Catalog errors are reported
+    and swallowed: a run that succeeded is not failed by its bookkeeping.
+    """
+    data = data or {}
+    input_paths = [input_paths] if isinstance(input_paths, str) else list(input_paths or [])
+    total = data.get('total_timing') or {}
+    summary = {k: v for k, v in data.items() if k not in SUMMARY_SKIP}
+    try:
+        inputs = [(p, _fingerprint(p)) for p in input_paths]
+        conn = connect(path)
+        try:
+            with conn:
+                cursor = conn.execute(
+                    'INSERT INTO runs (pipeline, name, status, created_at, timestamp, input_path, output_dir, '
+                    'wall_seconds, error, params, summary, timings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (pipeline, name or '', status, datetime.now().isoformat(timespec='seconds'),
+                     data.get('timestamp'), input_paths[0] if input_paths else None, output_dir,
+                     total.get('wall_seconds'), error, _json(params), _json(summary), _json(data.get('timings'))))
+                run_id = cursor.lastrowid
+                conn.executemany('INSERT INTO inputs (run_id, path, fingerprint) VALUES (?, ?, ?)',
+                                 [(run_id, p, f) for p, f in inputs])
+                conn.executemany('INSERT INTO artifacts (run_id, path, kind, label, size_bytes) VALUES (?, ?, ?, ?, ?)',
+                                 [(run_id, *a) for a in _artifacts(data)])
+        finally:
+            conn.close()
+        return run_id
+    except (sqlite3.Error, OSError) as e:
+        print(f"Warning: could not record {pipeline} run {name!r} in the run catalog: {e}")
+        return None
+
+
+def record_events(events, pipeline, name, input_paths, output_dir, params=None):
+    """Pass progress events through and record the run at its `done` (or `error`) event."""
+    try:
+        for event in events:
+            if event.get('event') == 'done':
+                record_run(pipeline, name, input_paths, output_dir, event, params=params)
+            yield event
+    except Exception as e:
+        record_run(pipeline, name, input_paths, output_dir, params=params, status='error', error=str(e))
+        raise
+
+
+def list_runs(limit=DEFAULT_LIMIT, before=None, path=None, **filters):
+    """
+    One page of runs, newest first, without parameters, summaries and
+    timings.  `filters` are the keys of `FILTERS`; None values are ignored.
+    """
+    unknown = set(filters) - set(FILTERS)
+    if unknown:
+        raise ValueError(f"Unknown run filters {sorted(unknown)}. Available: {sorted(FILTERS)}")
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    conditions, args = [], []
+    for key, value in filters.items():
+        if value is not None:
+            conditions.append(FILTERS[key])
+            args.append(value)
+    if before is not None:
+        conditions.append('id < ?')
+        args.append(int(before))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            f"SELECT {', '.join(LIST_COLUMNS)}, "
+            f"(SELECT COUNT(*) FROM artifacts WHERE run_id = runs.id) AS n_artifacts "
+            f"FROM runs {where} ORDER BY id DESC LIMIT ?", (*args, limit + 1)).fetchall()
+    finally:
+        conn.close()
+    runs = [dict(r) for r in rows[:limit]]
+    return {'runs': runs, 'next': runs[-1]['id'] if len(rows) > limit else None}
+
+
+def get_run(run_id, path=None):
+    """Full record of one run with its inputs and artifacts, or None."""
+    conn = connect(path)
+    try:
+        row = conn.execute('SELECT * FROM runs WHERE id = ?', (int(run_id),)).fetchone()
+        if row is None:
+            return None
+        inputs = conn.execute('SELECT path, fingerprint FROM inputs WHERE run_id = ?', (row['id'],)).fetchall()
+        artifacts = conn.execute('SELECT path, kind, label, size_bytes FROM artifacts WHERE run_id = ?',
+                                 (row['id'],)).fetchall()
+    finally:
+        conn.close()
+    run = dict(row)
+    for key in ('params', 'summary', 'timings'):
+        run[key] = json.loads(run[key]) if run[key] else None
+    run['inputs'] = [dict(r) for r in inputs]
+    run['artifacts'] = [dict(r) for r in artifacts]
+    return run
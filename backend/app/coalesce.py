@@ -0,0 +1,115 @@
+"""
+Coalescing of identical pipeline requests.
+
+A request is identified by the endpoint, the identity of its input file
+(real path, size, mtime) and its normalized parameters.  While a run for a
+key is in flight, further requests with the same key await the same future
+instead of starting a second run into the same output directory.  Finished
+results stay in a small index and are served again for as long as the
+figures and files they reference are unchanged on disk.
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict
+
+# keys of a pipeline's data dict that reference files it wrote
+ARTIFACT_KEYS = ('figs', 'files', 'adata_output_file', 'umap_path')
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_size, st.st_mtime_ns
+
+
+def request_key(endpoint, input_path, params):
+    """
+    Canonical key for one request: endpoint, input identity, sorted
+    parameters.  `input_path` may be a list when a request reads several files.
+    """
+    if hasattr(params, 'model_dump'):
+        params = params.model_dump()
+    params = {k: v for k, v in params.items() if k != 'input_path'}
+    if isinstance(input_path, str):
+        identity = file_identity(input_path)
+    else:
+        identity = [file_identity(p) for p in input_path]
+    return json.dumps([endpoint, identity, params], sort_keys=True, default=str)
+
+
+def _artifact_paths(result):
+    if isinstance(result, tuple):  # annotate returns (outputs, params)
+        result = result[0].get('data', {})
+    paths = []
+    for key in ARTIFACT_KEYS:
+        value = result.get(key) if isinstance(result, dict) else None
+        if isinstance(value, str):
+            paths.append(value)
+        elif isinstance(value, list):
+            paths.extend(v[0] if isinstance(v, (list, tuple)) else v for v in value)
+    return paths
+
+
+def _fingerprint(paths):
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        fingerprint.append((path, st.st_size, st.st_mtime_ns))
+    return fingerprint
+
+
+class RequestCoalescer:
+    def __init__(self, max_results=128):
+        self.max_results = max_results
+        self.inflight = {}
+        self.results = OrderedDict()
+
+    def _cached(self, key):
+        entry = self.results.get(key)
+        if entry is None:
+            return None
+        result, fingerprint = entry
+        if _fingerprint([p for p, _, _ in fingerprint]) != fingerprint:
+            del self.results[key]
+            return None
+        self.results.move_to_end(key)
+        return result
+
+    def _finish(self, key, task):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        fingerprint = _fingerprint(_artifact_paths(result))
+        if fingerprint is None:
+            return
+        self.results[key] = (result, fingerprint)
+        while len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+
+    async def run(self, key, factory):
+        """
+        Result of `factory()` for `key`, shared with identical requests.
+
+        A cached result with unchanged outputs is returned directly; an
+        in-flight run is joined; otherwise a new run is started.  The run is
+        shielded, so one client disconnecting does not cancel it for the others.
+        """
+        cached = self._cached(key)
+        if cached is not None:
+            print("Serving cached result for identical request")
+            return cached
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            print("Joining identical in-flight request")
+        return await asyncio.shield(task)
+
+
+coalescer = RequestCoalescer()
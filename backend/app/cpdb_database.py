@@ -0,0 +1,44 @@
+"""
+Genes of a CellPhoneDB database.
+
+The database zip (`db/cellphonedb.zip`) holds CSV tables of proteins, genes,
+complexes, multidata entries and interactions.  The statistical analysis
+reads the zip itself; `database_genes` only reads the gene tables, so a run
+whose counts share no gene with the database fails before the counts are
+written out and the analysis starts.
+"""
+import os
+import zipfile
+from functools import lru_cache
+
+import pandas as pd
+
+GENE_COLUMNS = {
+    'gene_table.csv': ('hgnc_symbol', 'gene_name', 'ensembl'),
+    'gene_synonym_to_gene_name.csv': ('Gene Synonym',),
+}
+
+
+@lru_cache(maxsize=4)
+def _database_genes(identity, zip_path):
+    with zipfile.ZipFile(zip_path) as zf:
+        names = set(zf.namelist())
+        if 'gene_table.csv' not in names:
+            raise ValueError(f"{zip_path} is not a CellPhoneDB database: missing gene_table.csv")
+        genes = set()
+        for table, columns in GENE_COLUMNS.items():
+            if table in names:
+                df = pd.read_csv(zf.open(table), usecols=lambda c: c in columns, dtype=str)
+                genes.update(df.stack().tolist())
+    return frozenset(genes)
+
+
+def database_genes(zip_path):
+    """
+    Every gene identifier CellPhoneDB can match counts against: symbols,
+    names, Ensembl ids and synonyms.  Cached per path, size and mtime.
+    """
+    if not os.path.exists(zip_path):
+        raise FileNotFoundError(f"CellPhoneDB database not found: {zip_path}")
+    st = os.stat(zip_path)
+    return _database_genes((os.path.realpath(zip_path), st.st_size, st.st_mtime_ns), zip_path)
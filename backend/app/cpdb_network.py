@@ -0,0 +1,130 @@
+"""
+Cell-cell interaction network from in-memory CellPhoneDB results.
+
+`interaction_network` replaces `ov.single.cpdb_network_cal` (ktplotspy's
+`plot_cpdb_heatmap(..., return_tables=True)`).  The cell-type-pair columns
+of the pvalues table become a boolean interaction x pair significance
+matrix; edge counts are its column sums, scattered into a sender x receiver
+matrix, and the row/column totals are reductions of that matrix.  With a
+means table the summed means of the significant interactions are returned
+as edge weights.
+
+The returned `interaction_edges`, `count_network` and `interaction_count`
+tables have the rows, columns and values ktplotspy produces, so the
+omicverse network plots take them unchanged.
+"""
+import numpy as np
+import pandas as pd
+
+# ktplotspy: CellPhoneDB v5 tables have 13 annotation columns before the pairs, older ones 11
+V5_COL_START = 13
+COL_START = 11
+CLASS_COL = 12
+CPDB_SEP = '|'
+
+
+def pair_columns(table):
+    """Index of the first cell-type-pair column of a CellPhoneDB means or pvalues table."""
+    return V5_COL_START if table.columns[CLASS_COL] == 'classification' else COL_START
+
+
+def _pairs(columns, sep):
+    senders, receivers = zip(*(c.split(sep, 1) for c in columns)) if len(columns) else ((), ())
+    cell_types = sorted(set(senders) | set(receivers))
+    index = {ct: i for i, ct in enumerate(cell_types)}
+    return cell_types, np.array([index[s] for s in senders], dtype=np.int64), \
+        np.array([index[r] for r in receivers], dtype=np.int64)
+
+
+def significance(pvals, alpha=0.05, sep=CPDB_SEP):
+    """
+    Cell types, sender and receiver index of every pair column, and the
+    interaction x pair matrix of p-values below `alpha`.
+    """
+    start = pair_columns(pvals)
+    columns = list(pvals.columns[start:])
+    cell_types, senders, receivers = _pairs(columns, sep)
+    with np.errstate(invalid='ignore'):
+        significant = pvals.iloc[:, start:].to_numpy(dtype=np.float64) < alpha
+    return cell_types, senders, receivers, significant
+
+
+def significance_tensor(pvals, alpha=0.05, sep=CPDB_SEP):
+    """Cell types and the (sender, receiver, interaction) boolean tensor of significant interactions."""
+    cell_types, senders, receivers, significant = significance(pvals, alpha, sep)
+    tensor = np.zeros((len(cell_types), len(cell_types), significant.shape[0]), dtype=bool)
+    tensor[senders, receivers] = significant.T
+    return cell_types, tensor
+
+
+def interaction_network(pvals, means=None, alpha=0.05, symmetrical=False, sep=CPDB_SEP):
+    """
+    Interaction counts between cell types from a CellPhoneDB pvalues table.
+
+    Returns:
+    --------
+    dict with
+        interaction_edges : pd.DataFrame
+            SOURCE, TARGET, COUNT for every ordered pair of cell types
+        count_network : pd.DataFrame
+            Counts, receivers x senders (or the symmetrized matrix)
+        interaction_count : pd.DataFrame
+            Totals per cell type
+        weight_network : pd.DataFrame
+            Senders x receivers sum of the means of significant
+            interactions, when `means` is given
+    """
+    cell_types, senders, receivers, significant = significance(pvals, alpha, sep)
+    n = len(cell_types)
+    counts = np.zeros((n, n), dtype=np.int64)
+    counts[senders, receivers] = significant.sum(axis=0)
+
+    # ktplotspy lists pairs in the order of their "sender|receiver" labels
+    labels = np.array([f'{s}|{r}' for s in cell_types for r in cell_types], dtype=object)
+    order = np.argsort(labels, kind='stable')
+    edges = pd.DataFrame({
+        'SOURCE': np.repeat(np.array(cell_types, dtype=object), n)[order],
+        'TARGET': np.tile(np.array(cell_types, dtype=object), n)[order],
+        'COUNT': counts.ravel()[order],
+    })
+
+    matrix = counts.astype(np.float64)
+    if symmetrical:
+        matrix = matrix + matrix.T
+        matrix[np.diag_indices(n)] = np.diag(counts)
+        count_network = pd.DataFrame(matrix, index=cell_types, columns=cell_types)
+        interaction_count = pd.DataFrame({'total_interactions': matrix.sum(axis=0)}, index=cell_types)
+    else:
+        count_network = pd.DataFrame(matrix.T, index=cell_types, columns=cell_types)
+        interaction_count = pd.DataFrame({'total_interactions_row': matrix.sum(axis=1),
+                                          'total_interactions_col': matrix.sum(axis=0)}, index=cell_types)
+    network = {'count_network': count_network, 'interaction_count': interaction_count, 'interaction_edges': edges}
+
+    if means is not None:
+        # CellPhoneDB's means table has the rows and pair columns of its pvalues table
+        values = np.nan_to_num(means[list(pvals.columns[pair_columns(pvals):])].to_numpy(dtype=np.float64))
+        weights = np.zeros((n, n))
+        weights[senders, receivers] = np.where(significant, values, 0).sum(axis=0)
+        network['weight_network'] = pd.DataFrame(weights, index=cell_types, columns=cell_types)
+    return network
+
+
+def symmetrize(count_network):
+    """Symmetrical counts (both directions summed, self-interactions once) of an `interaction_network` count matrix."""
+    counts = count_network.to_numpy()
+    matrix = counts + counts.T
+    matrix[np.diag_indices_from(matrix)] = np.diag(counts)
+    return pd.DataFrame(matrix, index=count_network.index, columns=count_network.columns)
+
+
+def plot_interaction_heatmap(count_network, title='', **kwargs):
+    """ktplotspy's `plot_cpdb_heatmap` drawing of an already computed count matrix."""
+    import seaborn as sns
+    from ktplotspy.utils.support import diverging_palette
+
+    g = sns.clustermap(count_network, row_cluster=True, col_cluster=True, linewidths=0.5,
+                       tree_kws={'linewidths': 0},
+                       cmap=diverging_palette(low='#104e8b', medium='#ffdab9', high='#8b0a50'), **kwargs)
+    if title != '':
+        g.fig.suptitle(title)
+    return g
@@ -0,0 +1,319 @@
+"""
+Doublet detection on the pipeline's own PCA.
+
+`ov.pp.qc(..., doublets_method='scrublet')` runs scrublet before anything
+else, so scrublet normalizes, selects genes and fits a PCA of its own, then
+builds a kNN graph over observed and simulated cells on one thread.  Here
+the same score is computed after the pipeline's PCA instead:
+
+1. `quality_filter` applies the per-cell thresholds of `ov.pp.qc` without
+   doublet detection,
+2. `simulate_doublets` sums random pairs of cells' raw counts (the HVG
+   columns of `layers['counts']`) as one sparse float32 matmul,
+3. the simulated cells are normalized like `ov.pp.preprocess` (shiftlog,
+   with the summed total counts of both parents) and projected onto the
+   pipeline's PCA loadings (`incremental.project`), so no second PCA is fit,
+4. `score_sample` counts simulated cells among each cell's neighbors in
+   blocks of BLAS distances, with the per-row selection spread over threads
+   by numba, and turns the counts into scrublet's doublet likelihood,
+5. the threshold is the minimum between the singlet and doublet modes of the
+   observed cells' neighbor counts (`doublet_threshold`).
+
+Samples (`obs['sample']` or `obs['batch']`) are scored separately, as
+scrublet does with `batch_key`, and in parallel worker processes when there
+are several.  The HVGs and the PCA include the doublets, just as scrublet's
+own PCA does.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+import numba
+import numpy as np
+import scipy.sparse
+from numba import njit, prange
+
+from .incremental import PCA_KEY, TARGET_SUM, project
+from .neighbors import KnnIndex
+
+BATCH_COLUMNS = ('sample', 'batch')
+EXPECTED_DOUBLET_RATE = 0.05  # scrublet defaults
+SIM_DOUBLET_RATIO = 2.0
+N_PCS = 30
+BLOCK_VALUES = 2**25  # distances per block: 128 MB of float32
+EXACT_MAX_PAIRS = 2**34  # larger samples use an nndescent graph instead of exact search
+
+
+def quality_filter(adata, tresh, mt_startswith='MT-', min_genes=200, min_cells=3):
+    """
+    The QC of `ov.pp.qc(adata, tresh=tresh)` ('seurat' mode) without doublet
+    detection: the same obs metrics and passing_* columns, the same strict
+    thresholds and the same final gene and cell filters.
+    """
+    import scanpy as sc
+
+    adata.var_names_make_unique()
+    adata.var['mt'] = adata.var_names.str.startswith(mt_startswith)
+    X = scipy.sparse.csr_matrix(adata.X)
+    adata.obs['nUMIs'] = np.asarray(X.sum(axis=1)).ravel()
+    adata.obs['mito_perc'] = np.asarray(X[:, adata.var['mt'].values].sum(axis=1)).ravel() / adata.obs['nUMIs'].values
+    adata.obs['detected_genes'] = np.diff(X.indptr)
+    adata.obs['cell_complexity'] = adata.obs['detected_genes'] / adata.obs['nUMIs']
+    adata.obs['passing_mt'] = adata.obs['mito_perc'] < tresh['mito_perc']
+    adata.obs['passing_nUMIs'] = adata.obs['nUMIs'] > tresh['nUMIs']
+    adata.obs['passing_ngenes'] = adata.obs['detected_genes'] > tresh['detected_genes']
+    passing = (adata.obs['passing_mt'] & adata.obs['passing_nUMIs'] & adata.obs['passing_ngenes']).values
+    print(f"Cells retained after QC thresholds: {int(passing.sum())}, {int((~passing).sum())} removed.")
+    adata = adata[passing].copy()
+    sc.pp.filter_cells(adata, min_genes=min_genes)
+    sc.pp.filter_genes(adata, min_cells=min_cells)
+    return adata
+
+
+def batch_column(adata, batch_key=None):
+    """`batch_key`, or the first of `BATCH_COLUMNS` in obs with more than one value."""
+    if batch_key:
+        return batch_key
+    for column in BATCH_COLUMNS:
+        if column in adata.obs and adata.obs[column].nunique() > 1:
+            return column
+    return None
+
+
+def simulate_doublets(counts, n_sim, random_state=0):
+    """
+    Raw counts of `n_sim` simulated doublets, each the sum of two random
+    cells, as a float32 CSR matrix; also returns the (n_sim, 2) parent indices.
+    """
+    rng = np.random.default_rng(random_state)
+    parents = rng.integers(0, counts.shape[0], size=(n_sim, 2))
+    pairs = scipy.sparse.csr_matrix(
+        (np.ones(2 * n_sim, dtype=np.float32), parents.ravel(), np.arange(0, 2 * n_sim + 1, 2)),
+        shape=(n_sim, counts.shape[0]))
+    return (pairs @ scipy.sparse.csr_matrix(counts, dtype=np.float32)).tocsr(), parents
+
+
+def _shiftlog(counts, totals):
+    X = counts.copy()
+    X.data *= np.repeat((TARGET_SUM / np.maximum(totals, 1)).astype(np.float32), np.diff(X.indptr))
+    np.log1p(X.data, out=X.data)
+    return X
+
+
+def simulated_coordinates(adata, counts, totals, n_sim, n_pcs=N_PCS, random_state=0, batch_rows=8192):
+    """PCA coordinates of simulated doublets of the cells in `counts` (HVG raw counts, with full-gene `totals`)."""
+    sim, parents = simulate_doublets(counts, n_sim, random_state)
+    sim_totals = totals[parents[:, 0]] + totals[parents[:, 1]]
+    coords = np.empty((n_sim, n_pcs), dtype=np.float32)
+    # projection densifies, so it runs in row batches
+    for start in range(0, n_sim, batch_rows):
+        stop = start + batch_rows
+        _, X_pca = project(adata, _shiftlog(sim[start:stop], sim_totals[start:stop]))
+        coords[start:stop] = X_pca[:, :n_pcs]
+    return coords
+
+
+@njit(parallel=True, cache=True)
+def _count_simulated(d, k, n_obs):
+    """Simulated points (columns >= n_obs) among the k smallest of each row."""
+    counts = np.empty(d.shape[0], dtype=np.int32)
+    for i in prange(d.shape[0]):
+        kth = np.partition(d[i], k - 1)[k - 1]
+        c = 0
+        for j in range(n_obs, d.shape[1]):
+            if d[i, j] <= kth:
+                c += 1
+        counts[i] = min(c, k)
+    return counts
+
+
+def simulated_neighbor_counts(points, n_obs, k, rows=None, backend='auto'):
+    """
+    Number of simulated points (rows >= n_obs of `points`) among the k
+    nearest neighbors, excluding itself, of each of `rows` (default: all).
+
+    'exact' computes squared distances block by block and selects with
+    `_count_simulated`; 'nndescent' reads the neighbors off a pynndescent
+    graph; 'auto' picks exact unless the sample is large.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float32)
+    rows = np.arange(points.shape[0]) if rows is None else np.asarray(rows)
+    if backend == 'auto':
+        backend = 'exact' if len(rows) * points.shape[0] <= EXACT_MAX_PAIRS else 'nndescent'
+    if backend != 'exact':
+        indices, _ = KnnIndex(backend, n_neighbors=k + 1).build(points).knn()
+        return (indices[rows, 1:] >= n_obs).sum(axis=1)
+
+    sq = np.einsum('ij,ij->i', points, points)
+    block = max(1, BLOCK_VALUES // points.shape[0])
+    counts = np.empty(len(rows), dtype=np.int32)
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start + block]
+        d = sq[None, :] - 2 * points[chunk] @ points.T + sq[chunk][:, None]
+        d[np.arange(len(chunk)), chunk] = np.inf
+        counts[start:start + len(chunk)] = _count_simulated(d, k, n_obs)
+    return counts
+
+
+def doublet_likelihood(n_sim_neighbors, k, expected_rate, sim_ratio):
+    """scrublet's doublet score from the number of simulated neighbors among k."""
+    q = (n_sim_neighbors + 1) / (k + 2)
+    rho, r = expected_rate, sim_ratio
+    return q * rho / r / (1 - rho - q * (1 - rho - rho / r))
+
+
+def _minimum_between_modes(hist, max_iter=10000):
+    """
+    Bin of the minimum between the two modes of `hist`, smoothed until it
+    has exactly two (as `skimage.filters.threshold_minimum`); None when the
+    histogram never becomes bimodal.
+    """
+    def local_maxima(hist):
+        maxima, rising = [], True
+        for i in range(len(hist) - 1):
+            if rising and hist[i + 1] < hist[i]:
+                rising = False
+                maxima.append(i)
+            elif not rising and hist[i + 1] > hist[i]:
+                rising = True
+        return maxima
+
+    smooth = np.asarray(hist, dtype=np.float64)
+    for _ in range(max_iter):
+        maxima = local_maxima(smooth)
+        if len(maxima) == 2:
+            low, high = maxima
+            return int(low + np.argmin(smooth[low:high + 1]))
+        if len(maxima) < 2:
+            return None
+        smooth = np.convolve(np.pad(smooth, 1, mode='edge'), np.ones(3) / 3, mode='valid')
+    return None
+
+
+def threshold_minimum(values, n_bins=256):
+    """`skimage.filters.threshold_minimum`: the minimum between the two modes of a histogram of `values`."""
+    hist, edges = np.histogram(values, bins=n_bins)
+    i = _minimum_between_modes(hist)
+    return None if i is None else float((edges[i] + edges[i + 1]) / 2)
+
+
+def doublet_threshold(obs_counts, sim_scores, k, expected_rate, sim_ratio):
+    """
+    Score threshold: the minimum between the singlet and doublet modes of the
+    observed cells' simulated-neighbor counts (one histogram bin per count).
+
+    scrublet takes the minimum of the simulated scores instead, which are
+    often unimodal when simulated doublets overlap each other more than they
+    overlap singlets; that rule is the fallback when the observed counts
+    have no second mode.  None when neither is bimodal.
+    """
+    count = _minimum_between_modes(np.bincount(obs_counts, minlength=k + 1))
+    if count is not None:
+        return float(doublet_likelihood(count, k, expected_rate, sim_ratio))
+    return threshold_minimum(sim_scores)
+
+
+def score_sample(obs_coords, sim_coords, n_neighbors=None, expected_rate=EXPECTED_DOUBLET_RATE,
+                 backend='auto', random_state=0, max_sim_scored=20000):
+    """
+    Doublet scores of observed cells given simulated ones in the same space:
+    (observed scores, scores of up to `max_sim_scored` simulated cells, threshold).
+    """
+    n_obs, n_sim = len(obs_coords), len(sim_coords)
+    sim_ratio = n_sim / n_obs
+    k = n_neighbors or int(round(0.5 * np.sqrt(n_obs)))
+    k_adj = min(int(round(k * (1 + sim_ratio))), n_obs + n_sim - 1)
+    points = np.vstack([obs_coords, sim_coords])
+    # the threshold only needs the distribution of simulated scores, so a sample of them is scored
+    rng = np.random.default_rng(random_state)
+    sim_rows = n_obs + np.sort(rng.choice(n_sim, min(n_sim, max_sim_scored), replace=False))
+    rows = np.concatenate([np.arange(n_obs), sim_rows])
+    counts = simulated_neighbor_counts(points, n_obs, k_adj, rows=rows, backend=backend)
+    scores = doublet_likelihood(counts, k_adj, expected_rate, sim_ratio)
+    threshold = doublet_threshold(counts[:n_obs], scores[n_obs:], k_adj, expected_rate, sim_ratio)
+    return scores[:n_obs], scores[n_obs:], threshold
+
+
+def _init_worker(threads):
+    import numba
+    numba.set_num_threads(threads)
+
+
+def detect_doublets(adata, batch_key=None, n_pcs=N_PCS, sim_ratio=SIM_DOUBLET_RATIO,
+                    expected_rate=EXPECTED_DOUBLET_RATE, backend='auto', random_state=0, n_jobs=None):
+    """
+    Score every cell of a normalized, PCA-reduced `adata` (after
+    `ov.pp.preprocess` and the pipeline PCA) and set `obs['doublet_score']`,
+    `obs['predicted_doublet']` and `uns['scrublet']`, as `sc.pp.scrublet` does.
+
+    Needs `layers['counts']` (raw counts of the HVGs) and `obs['nUMIs']`
+    (total counts over all genes, from `quality_filter`).  Samples are scored
+    in up to `n_jobs` processes (default: one per numba thread of the caller),
+    which share the caller's numba threads.
+    """
+    if 'counts' not in adata.layers:
+        raise ValueError("Doublet detection needs raw counts in layers['counts']")
+    coords = np.asarray(adata.obsm[f'{PCA_KEY}|X_pca'])
+    n_pcs = min(n_pcs, coords.shape[1])
+    counts = scipy.sparse.csr_matrix(adata.layers['counts'], dtype=np.float32)
+    if 'nUMIs' in adata.obs:
+        totals = adata.obs['nUMIs'].values.astype(np.float64)
+    else:
+        totals = np.asarray(counts.sum(axis=1)).ravel()
+
+    column = batch_column(adata, batch_key)
+    if column is None:
+        groups = {'all': np.arange(adata.n_obs)}
+    else:
+        groups = {str(b): np.flatnonzero((adata.obs[column] == b).values)
+                  for b in adata.obs[column].unique()}
+
+    tasks = {}
+    for batch, cells in groups.items():
+        n_sim = int(round(sim_ratio * len(cells)))
+        sim = simulated_coordinates(adata, counts[cells], totals[cells], n_sim, n_pcs, random_state)
+        tasks[batch] = (coords[cells, :n_pcs], sim)
+
+    # the calling thread's numba thread count is the run's admitted allotment (see admission.py);
+    # worker processes split it between them
+    budget = numba.get_num_threads()
+    n_jobs = min(len(tasks), n_jobs or budget)
+    kwargs = dict(expected_rate=expected_rate, backend=backend, random_state=random_state)
+    if n_jobs > 1:
+        # spawn: numba's thread pool is not safe to fork
+        threads = max(1, budget // n_jobs)
+        with ProcessPoolExecutor(n_jobs, mp_context=mp.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(threads,)) as pool:
+            futures = {b: pool.submit(score_sample, *args, **kwargs) for b, args in tasks.items()}
+            results = {b: f.result() for b, f in futures.items()}
+    else:
+        results = {b: score_sample(*args, **kwargs) for b, args in tasks.items()}
+
+    scores = np.zeros(adata.n_obs)
+    predicted = np.zeros(adata.n_obs, dtype=bool)
+    thresholds = {}
+    for batch, (obs_scores, _, threshold) in results.items():
+        cells = groups[batch]
+        scores[cells] = obs_scores
+        if threshold is None:
+            print(f"No doublet score threshold found for {batch}; no cells called as doublets")
+        else:
+            predicted[cells] = obs_scores > threshold
+        thresholds[batch] = threshold
+    adata.obs['doublet_score'] = scores
+    adata.obs['predicted_doublet'] = predicted
+    adata.uns['scrublet'] = {
+        'method': 'native',
+        'threshold': {b: (np.nan if t is None else t) for b, t in thresholds.items()},
+        'parameters': {'batch_key': column or '', 'n_pcs': n_pcs, 'sim_doublet_ratio': sim_ratio,
+                       'expected_doublet_rate': expected_rate},
+    }
+    return adata
+
+
+def remove_doublets(adata, **kwargs):
+    """`detect_doublets`, then the cells not called as doublets."""
+    n0 = adata.n_obs
+    detect_doublets(adata, **kwargs)
+    adata = adata[~adata.obs['predicted_doublet'].values].copy()
+    print(f"Cells retained after doublet detection: {adata.n_obs}, {n0 - adata.n_obs} removed.")
+    return adata
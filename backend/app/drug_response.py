@@ -0,0 +1,261 @@
+"""
+Batch CaDRReS-Sc drug response scoring.
+
+`run_inferncnv` scores one tumour h5ad per request through
+`ov.single.Drug_Response`.  This module scores many samples at once: the
+reference (GDSC cell line) fold-change is computed once per reference file
+and its standardized kernel matrix once per gene set, each sample's kernel
+features are computed over its own genes shared with the reference (so its
+scores do not depend on the other samples of the batch), and the kernel rows
+of all samples are stacked so each model is applied with a single
+`predict_from_model` call.
+"""
+import os
+import sys
+import json
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from .pseudobulk import pseudobulk, read_pseudobulk
+
+CADRRES_SCRIPT_PATH = 'CaDRReS-Sc'
+DEFAULT_MODELS = {'GDSC': 'models/cadrres-wo-sample-bias_param_dict_all_genes.pickle'}
+DEFAULT_REFERENCE_EXP = os.path.join(CADRRES_SCRIPT_PATH, 'data', 'GDSC', 'GDSC_exp.tsv')
+DEFAULT_DRUG_INFO = os.path.join(CADRRES_SCRIPT_PATH, 'preprocessed_data', 'GDSC', 'drug_stat.csv')
+
+
+def _cadrres():
+    """Import cadrres_sc from the bundled CaDRReS-Sc checkout."""
+    script_path = os.path.abspath(CADRRES_SCRIPT_PATH)
+    if script_path not in sys.path:
+        sys.path.append(script_path)
+    from cadrres_sc import pp, model
+    return pp, model
+
+
+@lru_cache(maxsize=4)
+def _load_reference(reference_exp_path, mtime):
+    """Reference log2 fold-change profiles, cached per (file, mtime)."""
+    pp, _ = _cadrres()
+    gene_exp_df = pd.read_csv(reference_exp_path, sep='\t', index_col=0)
+    gene_exp_df = gene_exp_df.groupby(gene_exp_df.index).mean()
+    ref_fc_df, _ = pp.gexp.normalize_log2_mean_fc(gene_exp_df)
+    return ref_fc_df
+
+
+@lru_cache(maxsize=8)
+def _load_kernel_reference(reference_exp_path, mtime, gene_list):
+    """Standardized kernel reference, cached per (reference, gene list)."""
+    pp, _ = _cadrres()
+    return pp.gexp.prepare_kernel_reference(_load_reference(reference_exp_path, mtime), list(gene_list))
+
+
+@lru_cache(maxsize=4)
+def _load_model(model_path, mtime):
+    _, model = _cadrres()
+    return model.load_model(model_path)
+
+
+def _profiles(groups):
+    """
+    Genes x clusters means, centered on the sample's mean over all cells, and
+    cluster fractions of a `pseudobulk` result.
+    """
+    # as ov.single.Drug_Response: cluster means minus the sample-wide gene means
+    overall = pd.Series(groups.sums.sum(0) / groups.sizes.sum(), index=groups.genes)
+    profile_df = groups.mean().T.sub(overall, axis=0)
+    fraction = groups.size() / groups.sizes.sum()
+    return profile_df, fraction
+
+
+def cluster_profiles_from_adata(adata, cluster_key='louvain'):
+    """
+    Mean expression per cluster and cluster fractions for one AnnData.
+
+    Uses `adata.raw` when present and subtracts the mean over all cells from
+    every cluster mean, like `ov.single.Drug_Response`.  The means come from
+    the shared per-cluster aggregation (see `pseudobulk.py`).
+
+    Returns:
+    --------
+    profile_df : pd.DataFrame
+        Genes x clusters mean expression minus the sample mean
+    fraction : pd.Series
+        Fraction of cells in each cluster
+    """
+    if cluster_key not in adata.obs.columns:
+        raise ValueError(
+            f"'{cluster_key}' column not found in adata.obs. Provide AnnData with pre-computed clusters.")
+    return _profiles(pseudobulk(adata, cluster_key, use_raw=True, thresholds=()))
+
+
+def load_sample(input_path, cluster_key='louvain'):
+    """
+    Load cluster profiles for one sample.
+
+    `.h5ad` inputs and `.zarr` stores are reduced to per-cluster means minus
+    the sample mean (cached per file).  `.csv`/`.tsv` inputs are precomputed cluster x gene profiles
+    (as in the CaDRReS-Sc notebooks) and every cluster gets the same weight.
+    """
+    if input_path.endswith('.h5ad') or input_path.rstrip('/').endswith('.zarr'):
+        return _profiles(read_pseudobulk(input_path, cluster_key, use_raw=True, thresholds=()))
+    elif input_path.endswith('.csv') or input_path.endswith('.tsv'):
+        sep = '\t' if input_path.endswith('.tsv') else ','
+        profile_df = pd.read_csv(input_path, sep=sep, index_col=0).T
+        profile_df.columns = [str(c) for c in profile_df.columns]
+        fraction = pd.Series(1.0 / profile_df.shape[1], index=profile_df.columns)
+        return profile_df, fraction
+    else:
+        raise ValueError(f"Unsupported file format: {input_path}")
+
+
+def _sample_name(input_path):
+    return os.path.splitext(os.path.basename(input_path))[0]
+
+
+def iter_batch_drug_response(
+    input_files,
+    output_dir,
+    name='',
+    cluster_key='louvain',
+    model_paths=None,
+    reference_exp_path=DEFAULT_REFERENCE_EXP,
+    drug_info_path=DEFAULT_DRUG_INFO,
+    freq_cutoff=0.05,
+):
+    """
+    Score many samples with CaDRReS-Sc and yield progress events.
+
+    Parameters:
+    -----------
+    input_files : list
+        h5ad files (clustered by `cluster_key`) or precomputed cluster profile tables
+    output_dir : str
+        Directory for the combined prediction tables
+    name : str
+        Prefix for output files
+    cluster_key : str
+        Column in adata.obs holding the clusters to score
+    model_paths : dict
+        Model label -> pickled CaDRReS model.  Defaults to the GDSC model.
+    reference_exp_path : str
+        Reference (cell line) expression used for the kernel features
+    drug_info_path : str
+        Drug table with a `log2_max_conc` column, used for the cell death estimate
+    freq_cutoff : float
+        Clusters below this fraction of a sample are ignored when combining
+
+    Yields:
+    -------
+    dict
+        `{'event': 'profiled', ...}` once per loaded sample, then
+        `{'event': 'scored', ...}` once per sample with its per-drug results,
+        then a final `{'event': 'done', ...}` with the combined table paths.
+    """
+    model_paths = model_paths or DEFAULT_MODELS
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+
+    profiles = {}
+    fractions = {}
+    for input_file in input_files:
+        sample = _sample_name(input_file)
+        if sample in profiles:
+            raise ValueError(f"Duplicate sample name: {sample}")
+        profiles[sample], fractions[sample] = load_sample(input_file, cluster_key)
+        yield {'event': 'profiled', 'sample': sample, 'input_path': input_file,
+               'clusters': fractions[sample].round(4).to_dict()}
+
+    # Kernel features of each sample over its own genes shared with the reference, so
+    # a sample scores the same whichever samples it is submitted with; the rows of
+    # every sample are then stacked for one prediction per model
+    ref_mtime = os.path.getmtime(reference_exp_path)
+    ref_genes = set(_load_reference(reference_exp_path, ref_mtime).index)
+    pp, model = _cadrres()
+    kernel_rows = []
+    for sample, profile_df in profiles.items():
+        gene_list = tuple(sorted(set(profile_df.index) & ref_genes))
+        kernel_ref = _load_kernel_reference(reference_exp_path, ref_mtime, gene_list)
+        sample_df = profile_df.loc[list(gene_list)]
+        sample_df.columns = [f'{sample}|{c}' for c in sample_df.columns]
+        kernel_rows.append(pp.gexp.calculate_kernel_feature_from_reference(sample_df, kernel_ref))
+    test_kernel_df = pd.concat(kernel_rows)
+
+    drug_info_df = pd.read_csv(drug_info_path, index_col=0)
+    drug_info_df.index = drug_info_df.index.astype(str)
+
+    ic50_tables = []
+    rows = []
+    for model_label, model_path in model_paths.items():
+        cadrres_model = _load_model(model_path, os.path.getmtime(model_path))
+        pred_df, _ = model.predict_from_model(cadrres_model, test_kernel_df)
+        pred_df.columns = pred_df.columns.astype(str)
+        pred_df.insert(0, 'model', model_label)
+        ic50_tables.append(pred_df)
+
+    ic50_df = pd.concat(ic50_tables)
+    ic50_df.index.name = 'sample|cluster'
+
+    for sample, fraction in fractions.items():
+        kept = fraction[fraction >= freq_cutoff]
+        freqs = (kept / kept.sum()).values
+        sample_rows = []
+        for model_label, model_pred_df in ic50_df.groupby('model', sort=False):
+            cluster_ic50 = model_pred_df.drop(columns='model').loc[[f'{sample}|{c}' for c in kept.index]]
+            drug_list = [d for d in cluster_ic50.columns if d in drug_info_df.index]
+            cluster_ic50 = cluster_ic50[drug_list]
+            max_conc = drug_info_df.loc[drug_list, 'log2_max_conc'].values
+            cluster_kill = 100 - 100 / (1 + np.power(2, -(cluster_ic50.values - max_conc)))
+            ic50 = freqs @ cluster_ic50.values
+            kill = freqs @ cluster_kill
+            for d_i, d_id in enumerate(drug_list):
+                sample_rows.append({
+                    'sample': sample,
+                    'model': model_label,
+                    'drug_id': d_id,
+                    'drug_name': drug_info_df.loc[d_id, 'Drug Name'],
+                    'cluster': '|'.join(kept.index),
+                    'cluster_p': '|'.join(f'{f:.6g}' for f in freqs),
+                    'cluster_ic50': '|'.join(f'{v:.6g}' for v in cluster_ic50.values[:, d_i]),
+                    'ic50': ic50[d_i],
+                    'cluster_cell_death': '|'.join(f'{v:.6g}' for v in cluster_kill[:, d_i]),
+                    'cell_death': kill[d_i],
+                })
+        rows.extend(sample_rows)
+        yield {'event': 'scored', 'sample': sample, 'results': sample_rows}
+
+    ic50_path = os.path.join(output_dir, f'{name}_batch_IC50_prediction_{timestamp}.csv')
+    ic50_df.to_csv(ic50_path)
+    kill_path = os.path.join(output_dir, f'{name}_batch_drug_kill_prediction_{timestamp}.csv')
+    pd.DataFrame(rows).to_csv(kill_path, index=False)
+    print(f"Batch drug response saved to {ic50_path} and {kill_path}")
+    yield {
+        'event': 'done',
+        'timestamp': timestamp,
+        'files': [(ic50_path, 'Drug Response'), (kill_path, 'Drug Response')],
+        'samples': list(profiles.keys()),
+    }
+
+
+def batch_drug_response(input_files, output_dir, name='', **kwargs):
+    """Run `iter_batch_drug_response` to completion and return the final event."""
+    result = None
+    for event in iter_batch_drug_response(input_files, output_dir, name, **kwargs):
+        result = event
+    return result
+
+
+def stream_events(events):
+    """Encode progress events as newline-delimited JSON.
+
+    Errors raised after the response has started cannot change the status
+    code, so they are reported as a final `error` event.
+    """
+    try:
+        for event in events:
+            yield json.dumps(event, default=str) + '\n'
+    except Exception as e:
+        print(f"Error in batch drug response: {str(e)}")
+        yield json.dumps({'event': 'error', 'detail': str(e)}) + '\n'
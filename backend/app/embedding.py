@@ -0,0 +1,256 @@
+"""
+Embedding coordinates and one obs column as packed binary buffers.
+
+`embedding_buffers` reads only `obsm/<basis>` and `obs/<column>` of an h5ad
+file (the parent's obsm for annotation delta files) or a Zarr store, never
+the expression matrix, and reduces them to the requested level of detail:
+
+    full     every cell
+    sample   at most `max_points` cells, drawn from every cell of a
+             `resolution`-wide grid in proportion to its count (so density
+             is preserved), after one from each occupied grid cell (so
+             sparse populations stay visible)
+    grid     one point per occupied grid cell: centroid, cell count and the
+             majority category or the mean value of the column
+
+An optional viewport (x0, x1, y0, y1) restricts the cells first, so zooming
+in gets finer detail.  Results are cached per (file, basis, column, level of
+detail).
+
+The payload is a little-endian uint32 header length, a JSON header and the
+buffers, each starting at a multiple of 8 bytes from the end of the header
+block.  The header lists every buffer's name, dtype, offset and length and,
+for categorical columns, the categories the uint16 codes refer to (65535 for
+missing values).  Buffers: `xy` float32 pairs, `index` uint32 cell indices
+(sample/full) or `count` uint32 cells per point (grid), and `values`:
+uint16 codes for categorical columns, float32 for numeric ones.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .output import delta_parent
+from .store import is_zarr
+
+MODES = ('full', 'sample', 'grid')
+MISSING_CODE = np.iinfo(np.uint16).max
+MAX_CATEGORIES = MISSING_CODE
+CACHE_BYTES = 512 * 2**20
+
+
+def _identity(path, group):
+    """Cache identity of one group of a file; a store changes per group (see `store.append_obs`)."""
+    stat_path = os.path.join(path, group) if is_zarr(path) else path
+    st = os.stat(stat_path)
+    return os.path.realpath(path), st.st_size, st.st_mtime_ns
+
+
+def _read_element(path, key):
+    from anndata.experimental import read_elem
+
+    if is_zarr(path):
+        import zarr
+        root = zarr.open_group(path, mode='r')
+        if key not in root:
+            raise KeyError(f"{key} not found in {path}")
+        return read_elem(root[key])
+    import h5py
+    with h5py.File(path, 'r') as f:
+        if key in f:
+            return read_elem(f[key])
+    parent = delta_parent(path)
+    if parent is not None:
+        return _read_element(parent, key)
+    raise KeyError(f"{key} not found in {path}")
+
+
+@lru_cache(maxsize=8)
+def _coordinates(identity, path, basis):
+    coords = np.asarray(_read_element(path, f'obsm/{basis}'))
+    if coords.ndim != 2 or coords.shape[1] < 2:
+        raise ValueError(f"obsm['{basis}'] of {path} is not a 2-d embedding")
+    return np.ascontiguousarray(coords[:, :2], dtype=np.float32)
+
+
+@lru_cache(maxsize=16)
+def _column(identity, path, column):
+    """(values, categories): uint16 codes and category names, or float32 values and None."""
+    values = _read_element(path, f'obs/{column}')
+    series = pd.Series(values)
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        series = series.astype('category')
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = [str(c) for c in series.cat.categories]
+        if len(categories) > MAX_CATEGORIES:
+            raise ValueError(f"obs['{column}'] has {len(categories)} categories; at most {MAX_CATEGORIES} are supported")
+        codes = series.cat.codes.to_numpy()
+        return np.where(codes < 0, MISSING_CODE, codes).astype(np.uint16), categories
+    return series.to_numpy(dtype=np.float32), None
+
+
+def _grid(xy, bounds, resolution):
+    """Grid cell of every point and the grid shape: `resolution` cells along the longer side."""
+    x0, x1, y0, y1 = bounds
+    width, height = max(x1 - x0, 1e-12), max(y1 - y0, 1e-12)
+    nx = max(int(round(resolution * min(width / height, 1.0))), 1)
+    ny = max(int(round(resolution * min(height / width, 1.0))), 1)
+    ix = np.clip(((xy[:, 0] - x0) / width * nx).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((xy[:, 1] - y0) / height * ny).astype(np.int64), 0, ny - 1)
+    return iy * nx + ix, nx * ny
+
+
+def sample_points(xy, max_points, bounds, resolution, seed=0):
+    """Indices (sorted) of a density-preserving sample of `max_points` rows of `xy`."""
+    n = len(xy)
+    if n <= max_points:
+        return np.arange(n)
+    cells, _ = _grid(xy, bounds, resolution)
+    counts = np.bincount(cells)
+    # a random rank within each grid cell; a point's rank over its cell's count
+    # orders the cells' first points before any second ones, then draws from
+    # every cell in proportion to its count
+    noise = np.random.default_rng(seed).random(n)
+    order = np.lexsort((noise, cells))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - np.r_[0, np.cumsum(counts)[:-1]][cells[order]]
+    priority = rank / counts[cells]
+    return np.sort(np.lexsort((noise, priority))[:max_points])
+
+
+def aggregate_grid(xy, values, categories, bounds, resolution):
+    """Centroid, count and majority category / mean value of every occupied grid cell."""
+    cells, n_cells = _grid(xy, bounds, resolution)
+    counts = np.bincount(cells, minlength=n_cells)
+    occupied = np.flatnonzero(counts)
+    n = counts[occupied].astype(np.float64)
+    centroids = np.stack([np.bincount(cells, xy[:, 0], n_cells)[occupied] / n,
+                          np.bincount(cells, xy[:, 1], n_cells)[occupied] / n], axis=1).astype(np.float32)
+    out = {'xy': centroids, 'count': counts[occupied].astype(np.uint32)}
+    if values is not None and categories is not None:
+        # missing values vote as one extra category
+        n_codes = len(categories) + 1
+        codes = np.minimum(values.astype(np.int64), n_codes - 1)
+        votes = scipy.sparse.csr_matrix((np.ones(len(cells), dtype=np.int64), (cells, codes)),
+                                        shape=(n_cells, n_codes))[occupied]
+        majority = np.asarray(votes.argmax(axis=1)).ravel()
+        out['values'] = np.where(majority == n_codes - 1, MISSING_CODE, majority).astype(np.uint16)
+    elif values is not None:
+        finite = np.isfinite(values)
+        sums = np.bincount(cells[finite], values[finite].astype(np.float64), n_cells)[occupied]
+        seen = np.bincount(cells[finite], minlength=n_cells)[occupied]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['values'] = (sums / seen).astype(np.float32)
+    return out
+
+
+def pack(header, buffers):
+    """Length-prefixed JSON header followed by 8-byte aligned little-endian buffers."""
+    header = dict(header, buffers=[])
+    body, offset = [], 0
+    for name, array in buffers.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        pad = (-offset) % 8
+        body.append(b'\0' * pad)
+        offset += pad
+        header['buffers'].append({'name': name, 'dtype': array.dtype.str, 'offset': offset,
+                                  'length': int(array.size), 'shape': list(array.shape)})
+        body.append(array.tobytes())
+        offset += array.nbytes
+    head = json.dumps(header).encode()
+    head += b' ' * ((-(4 + len(head))) % 8)
+    return len(head).to_bytes(4, 'little') + head + b''.join(body)
+
+
+class _ByteCache:
+    """LRU of packed payloads bounded by their total size, shared by the threadpool's requests."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            payload = self.items.get(key)
+            if payload is not None:
+                self.items.move_to_end(key)
+            return payload
+
+    def put(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            # two requests that missed the same key both put it
+            replaced = self.items.pop(key, None)
+            if replaced is not None:
+                self.size -= len(replaced)
+            self.items[key] = payload
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+_payloads = _ByteCache()
+
+
+def embedding_buffers(path, basis='X_umap', column=None, mode='sample', max_points=200000, resolution=512,
+                      viewport=None, seed=0):
+    """
+    Packed payload (see module docstring) of `obsm[basis]` and `obs[column]`
+    at one level of detail.  `viewport` is (x0, x1, y0, y1) or None for the
+    whole embedding.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown level-of-detail mode {mode!r}. Available: {MODES}")
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    obsm_identity = _identity(path, 'obsm')
+    obs_identity = _identity(path, 'obs') if column else None
+    viewport = tuple(float(v) for v in viewport) if viewport is not None else None
+    key = (obsm_identity, obs_identity, basis, column, mode, int(max_points), int(resolution), viewport, seed)
+    payload = _payloads.get(key)
+    if payload is not None:
+        return payload
+
+    xy = _coordinates(obsm_identity, path, basis)
+    values, categories = _column(obs_identity, path, column) if column else (None, None)
+    if values is not None and len(values) != len(xy):
+        raise ValueError(f"obs['{column}'] and obsm['{basis}'] of {path} have different lengths")
+    keep = np.isfinite(xy).all(axis=1)
+    if viewport is not None:
+        x0, x1, y0, y1 = viewport
+        keep &= (xy[:, 0] >= x0) & (xy[:, 0] <= x1) & (xy[:, 1] >= y0) & (xy[:, 1] <= y1)
+    index = np.flatnonzero(keep)
+    points = xy[index]
+    if viewport is not None:
+        bounds = viewport
+    elif len(points):
+        bounds = (float(points[:, 0].min()), float(points[:, 0].max()),
+                  float(points[:, 1].min()), float(points[:, 1].max()))
+    else:
+        bounds = (0.0, 0.0, 0.0, 0.0)
+
+    if mode == 'grid':
+        buffers = aggregate_grid(points, None if values is None else values[index], categories, bounds, resolution)
+    else:
+        if mode == 'sample':
+            index = index[sample_points(points, max_points, bounds, resolution, seed)]
+        buffers = {'xy': xy[index], 'index': index.astype(np.uint32)}
+        if values is not None:
+            buffers['values'] = values[index]
+    header = {
+        'basis': basis, 'column': column, 'mode': mode, 'n_obs': int(len(xy)), 'n_in_view': int(keep.sum()),
+        'n_points': int(len(buffers['xy'])), 'bounds': list(bounds), 'resolution': int(resolution),
+        'categories': categories, 'missing_code': int(MISSING_CODE) if categories is not None else None,
+    }
+    payload = pack(header, buffers)
+    _payloads.put(key, payload)
+    return payload
@@ -0,0 +1,252 @@
+"""
+Per-gene expression queries from a column-major companion of X.
+
+Pipelines keep X row-major (CSR), where pulling one gene out costs a pass
+over every stored value.  `build_store` writes the matrix once more as CSC,
+one `.npy` file per array, in CELLPILOT_EXPRESSION_CACHE_DIR (default
+`cache/expression`) under a fingerprint of the file holding it: the content
+hash for h5ad files (the parent's for annotation delta files, so every delta
+of a dataset shares one store), the size and mtime of the matrix files for
+Zarr stores.  The matrix is `raw.X` with the genes of `raw.var` when the
+file has a raw (preprocessed outputs keep only the HVGs in X and every gene
+in raw), otherwise X.  The store is built in two passes over row blocks of
+the matrix, so memory stays at one block plus the output, which is written
+to memory-mapped files.
+
+Arrays:
+
+    indptr      int64, n_genes + 1
+    indices     int32 cell rows of each gene's values, ascending
+    data        float32 values
+    var_names   gene names
+    shape       (n_obs, n_genes)
+
+Queries memory-map the arrays: a gene is a slice of `indices` and `data`,
+and the dense vectors of the most recently used genes stay in an LRU.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from functools import lru_cache
+
+import numpy as np
+import scipy.sparse
+
+from .ingest import source_hash
+from .output import delta_parent
+from .store import is_zarr
+
+ROW_BLOCK = 65536
+GENE_CACHE_SIZE = 256
+
+# store directory -> lock, so threads of one process build each store once
+_build_locks = {}
+_build_locks_guard = threading.Lock()
+
+
+def cache_dir():
+    return os.environ.get('CELLPILOT_EXPRESSION_CACHE_DIR', os.path.join('cache', 'expression'))
+
+
+def matrix_source(path):
+    """The file or store holding the X of `path` (the parent of an annotation delta file)."""
+    if not is_zarr(path):
+        parent = delta_parent(path)
+        if parent is not None:
+            if not os.path.exists(parent):
+                raise FileNotFoundError(f"Parent of annotation file {path} not found: {parent}")
+            return parent
+    return path
+
+
+def matrix_group(source):
+    """'raw' when `source` has a raw matrix, else '' (the root); the store is built from its X and var."""
+    if is_zarr(source):
+        return 'raw' if os.path.isdir(os.path.join(source, 'raw', 'X')) else ''
+    import h5py
+    with h5py.File(source, 'r') as f:
+        return 'raw' if 'raw/X' in f else ''
+
+
+def fingerprint(path):
+    """Fingerprint of the matrix of `path` (see module docstring)."""
+    source = matrix_source(path)
+    group = matrix_group(source)
+    if not is_zarr(source):
+        return f'{source_hash(source)}_{group or "X"}'
+    digest = hashlib.sha256(os.path.realpath(source).encode())
+    digest.update(group.encode())
+    for folder, _, files in sorted(os.walk(os.path.join(source, group, 'X'))):
+        for name in sorted(files):
+            st = os.stat(os.path.join(folder, name))
+            digest.update(f'{os.path.relpath(folder, source)}/{name}:{st.st_size}:{st.st_mtime_ns}'.encode())
+    return digest.hexdigest()[:24]
+
+
+def store_path(path):
+    """Directory of the CSC store of `path`."""
+    return os.path.join(cache_dir(), fingerprint(path))
+
+
+def _open_root(source):
+    if is_zarr(source):
+        import zarr
+        return zarr.open_group(source, mode='r'), None
+    import h5py
+    f = h5py.File(source, 'r')
+    return f, f
+
+
+def _var_names(root):
+    from anndata.experimental import read_elem
+    return np.asarray(read_elem(root['var']).index.astype(str)).astype(np.str_)
+
+
+def _row_blocks(X, n_obs, block):
+    """CSR row blocks (start, matrix) of a sparse or dense X group."""
+    encoding = X.attrs.get('encoding-type') if hasattr(X, 'attrs') else None
+    if encoding == 'csr_matrix':
+        indptr = X['indptr'][...].astype(np.int64)
+        n_vars = int(tuple(X.attrs['shape'])[1])
+        for start in range(0, n_obs, block):
+            stop = min(start + block, n_obs)
+            lo, hi = indptr[start], indptr[stop]
+            yield start, scipy.sparse.csr_matrix(
+                (X['data'][lo:hi], X['indices'][lo:hi], indptr[start:stop + 1] - lo), shape=(stop - start, n_vars))
+    else:
+        for start in range(0, n_obs, block):
+            yield start, scipy.sparse.csr_matrix(X[start:min(start + block, n_obs)])
+
+
+def _write_csc(X, shape, tmp, block):
+    n_obs, n_vars = shape
+    if getattr(X, 'attrs', {}).get('encoding-type') == 'csc_matrix':
+        np.save(os.path.join(tmp, 'indptr.npy'), X['indptr'][...].astype(np.int64))
+        np.save(os.path.join(tmp, 'indices.npy'), X['indices'][...].astype(np.int32))
+        np.save(os.path.join(tmp, 'data.npy'), X['data'][...].astype(np.float32))
+        return
+    # pass 1: values per gene
+    counts = np.zeros(n_vars, dtype=np.int64)
+    for _, rows in _row_blocks(X, n_obs, block):
+        rows.eliminate_zeros()
+        counts += np.bincount(rows.indices, minlength=n_vars)
+    indptr = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    np.save(os.path.join(tmp, 'indptr.npy'), indptr)
+    nnz = int(indptr[-1])
+    indices = np.lib.format.open_memmap(os.path.join(tmp, 'indices.npy'), mode='w+', dtype=np.int32, shape=(nnz,))
+    data = np.lib.format.open_memmap(os.path.join(tmp, 'data.npy'), mode='w+', dtype=np.float32, shape=(nnz,))
+    # pass 2: scatter each block's columns behind the rows already written
+    cursor = indptr[:-1].copy()
+    for start, rows in _row_blocks(X, n_obs, block):
+        rows.eliminate_zeros()
+        cols = rows.tocsc()
+        cols.sort_indices()
+        per_gene = np.diff(cols.indptr)
+        target = np.repeat(cursor - cols.indptr[:-1], per_gene) + np.arange(cols.nnz)
+        indices[target] = cols.indices + start
+        data[target] = cols.data
+        cursor += per_gene
+    indices.flush()
+    data.flush()
+    del indices, data
+
+
+def _build_lock(target):
+    with _build_locks_guard:
+        return _build_locks.setdefault(target, threading.Lock())
+
+
+def build_store(path, block=ROW_BLOCK):
+    """Write the CSC store of `path` unless it exists; returns its directory."""
+    target = store_path(path)
+    with _build_lock(target):
+        if os.path.isdir(target):
+            return target
+        source = matrix_source(path)
+        print(f"Building expression store of {source} in {target}")
+        os.makedirs(cache_dir(), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir(), prefix=f'{os.path.basename(target)}.', suffix='.tmp')
+        root, handle = _open_root(source)
+        try:
+            name = matrix_group(source)
+            group = root[name] if name else root
+            var_names = _var_names(group)
+            X = group['X']
+            shape = tuple(int(s) for s in (X.attrs['shape'] if 'shape' in X.attrs else X.shape))
+            _write_csc(X, shape, tmp, block)
+            np.save(os.path.join(tmp, 'var_names.npy'), var_names)
+            np.save(os.path.join(tmp, 'shape.npy'), np.array(shape, dtype=np.int64))
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        finally:
+            if handle is not None:
+                handle.close()
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            # another process built the same store first
+            shutil.rmtree(tmp, ignore_errors=True)
+    return target
+
+
+@lru_cache(maxsize=8)
+def _open(directory):
+    arrays = {name[:-4]: np.load(os.path.join(directory, name), mmap_mode='r', allow_pickle=False)
+              for name in ('indptr.npy', 'indices.npy', 'data.npy')}
+    arrays['var_names'] = np.load(os.path.join(directory, 'var_names.npy'), allow_pickle=False)
+    arrays['shape'] = tuple(int(s) for s in np.load(os.path.join(directory, 'shape.npy')))
+    arrays['gene_index'] = {g: i for i, g in enumerate(arrays['var_names'].tolist())}
+    return arrays
+
+
+@lru_cache(maxsize=64)
+def _store_directory(identity, path):
+    return os.path.abspath(build_store(path))
+
+
+def store_directory(path):
+    """`build_store` memoized per path, size and mtime, so hot queries skip fingerprinting."""
+    st = os.stat(os.path.join(path, matrix_group(path), 'X') if is_zarr(path) else path)
+    return _store_directory((os.path.realpath(path), st.st_size, st.st_mtime_ns), path)
+
+
+def open_store(path):
+    """Memory-mapped CSC store of `path`, building it on first use."""
+    return _open(store_directory(path))
+
+
+def gene_index(store, genes):
+    """Column of every gene of `genes` in the store, and the genes it does not have."""
+    lookup = store['gene_index']
+    return [lookup[g] for g in genes if g in lookup], [g for g in genes if g not in lookup]
+
+
+@lru_cache(maxsize=GENE_CACHE_SIZE)
+def _gene_vector(directory, column):
+    store = _open(directory)
+    lo, hi = store['indptr'][column], store['indptr'][column + 1]
+    vector = np.zeros(store['shape'][0], dtype=np.float32)
+    vector[store['indices'][lo:hi]] = store['data'][lo:hi]
+    vector.flags.writeable = False
+    return vector
+
+
+def gene_vector(path, gene):
+    """Dense expression of one gene over all cells of `path` (read-only, cached)."""
+    directory = store_directory(path)
+    columns, missing = gene_index(_open(directory), [gene])
+    if missing:
+        raise KeyError(f"Gene {gene} not found in {path}")
+    return _gene_vector(directory, columns[0])
+
+
+def gene_vectors(path, genes):
+    """{gene: dense expression} for the genes of `genes` the dataset has, and the missing ones."""
+    directory = store_directory(path)
+    store = _open(directory)
+    found = [g for g in genes if g in store['gene_index']]
+    return {g: _gene_vector(directory, store['gene_index'][g]) for g in found}, \
+        [g for g in genes if g not in store['gene_index']]
@@ -0,0 +1,268 @@
+"""
+Incremental annotation: add new cells to an already annotated dataset.
+
+Instead of rerunning `annotate` on the merged data, new cells are
+
+1. filtered with the same per-cell QC thresholds (no doublet detection),
+   normalized the way `ov.pp.preprocess` does (`shiftlog`: total counts to
+   5e5, then log1p) and restricted to the reference HVGs,
+2. standardized with the reference per-gene mean/std and projected onto the
+   stored PCA loadings,
+3. attached to the reference neighbor index (`uns['knn_index']`, built from
+   the reference PCA when missing): each new cell gets its k nearest
+   reference cells, weighted with UMAP's fuzzy membership strengths,
+4. labelled by weighted kNN vote for `leiden` and every SCSA column, and
+5. placed in `X_umap` / `X_mde` at the membership-weighted mean of its
+   neighbors, which is how `umap.UMAP.transform` initializes new points.
+
+Reference cells keep their labels, graph and coordinates, so the work per
+call grows with the number of new cells; only reading and writing the h5ad
+touch the whole dataset.
+"""
+import os
+from datetime import datetime
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .ingest import load_input
+from .instrumentation import adata_size, pipeline_run, stage
+from .neighbors import KnnIndex
+from .output import POLICY_KEY, read_h5ad, write_h5ad
+from .pca import mean_std
+from .utils import summarize_h5ad
+
+PCA_KEY = 'scaled|original'
+TARGET_SUM = 50 * 1e4  # ov.pp.preprocess default
+MAX_SCALED_VALUE = 10  # ov.pp.scale default, applied when the reference has a 'scaled' layer
+LABEL_COLUMNS = ('leiden', 'cellmarker', 'panglaodb', 'cancersea', 'cell_type')
+EMBEDDING_KEYS = ('X_umap', 'X_mde')
+QC_DEFAULTS = {'mito_prefix': 'MT-', 'mito_threshold': 0.05, 'min_genes': 250, 'min_counts': 500}
+
+
+def _qc_filter(adata, params):
+    """Per-cell thresholds of `ov.pp.qc`: counts, detected genes and mitochondrial fraction."""
+    X = scipy.sparse.csr_matrix(adata.X)
+    counts = np.asarray(X.sum(axis=1)).ravel()
+    genes = np.diff(X.indptr)
+    mito = adata.var_names.str.startswith(params['mito_prefix'])
+    mito_frac = np.asarray(X[:, mito].sum(axis=1)).ravel() / np.maximum(counts, 1)
+    keep = (counts >= params['min_counts']) & (genes >= params['min_genes']) & (mito_frac <= params['mito_threshold'])
+    print(f"QC kept {int(keep.sum())} of {adata.n_obs} new cells")
+    return adata[keep].copy()
+
+
+def shiftlog(X):
+    """shiftlog normalization: scale each cell to TARGET_SUM counts, then log1p."""
+    X = scipy.sparse.csr_matrix(X, dtype=np.float32, copy=True)
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    X.data *= np.repeat((TARGET_SUM / np.maximum(totals, 1)).astype(np.float32), np.diff(X.indptr))
+    np.log1p(X.data, out=X.data)
+    return X
+
+
+def _reindex_columns(X, source_names, target_names):
+    """Columns of X reordered to `target_names`; genes missing from the source are all-zero."""
+    position = pd.Index(source_names).get_indexer(target_names)
+    present = np.flatnonzero(position >= 0)
+    selector = scipy.sparse.csr_matrix(
+        (np.ones(len(present), dtype=np.float32), (position[present], present)),
+        shape=(len(source_names), len(target_names)))
+    return scipy.sparse.csr_matrix(X @ selector)
+
+
+def reference_scaling(reference):
+    """Per-gene mean/std the reference PCA was computed with; derived from X when not stored."""
+    if 'mean' in reference.var and 'std' in reference.var:
+        return reference.var['mean'].values, reference.var['std'].values
+    # dense-mode runs scale into a layer without keeping mean/std; recompute once and store them
+    print("Reference has no stored mean/std; computing them from X...")
+    mean, std = mean_std(reference.X)
+    std[std == 0] = 1
+    reference.var['mean'] = mean
+    reference.var['std'] = std
+    return mean, std
+
+
+def _had_scaled_layer(reference):
+    dropped = reference.uns.get(POLICY_KEY, {}).get('dropped_layers', [])
+    return 'scaled' in reference.layers or 'scaled' in list(dropped)
+
+
+def project(reference, X_hvg):
+    """Scaled values and PCA coordinates of new cells (HVG columns, normalized) in the reference space."""
+    mean, std = reference_scaling(reference)
+    scaled = (np.asarray(X_hvg.todense(), dtype=np.float32) - mean) / std
+    if _had_scaled_layer(reference):
+        np.clip(scaled, None, MAX_SCALED_VALUE, out=scaled)
+    loadings = np.asarray(reference.varm[f'{PCA_KEY}|pca_loadings'])
+    return scaled.astype(np.float32), (scaled @ loadings).astype(np.float32)
+
+
+def reference_index(reference, output_dir, n_neighbors):
+    """The persisted neighbor index of the reference PCA, or a new HNSW index saved under output_dir."""
+    rep = np.asarray(reference.obsm[f'{PCA_KEY}|X_pca'])
+    info = reference.uns.get('knn_index')
+    if info is not None and os.path.exists(str(info['path'])):
+        n_pcs = int(info.get('n_pcs', rep.shape[1]))
+        try:
+            return KnnIndex.load(str(info['path']), rep[:, :n_pcs]), n_pcs
+        except ValueError as e:
+            print(f"Stored neighbor index not usable ({e}); rebuilding")
+    n_pcs = rep.shape[1]
+    index, path = KnnIndex.build_or_load(rep, os.path.join(output_dir, 'knn_index'),
+                                         backend='hnsw', n_neighbors=n_neighbors)
+    reference.uns['knn_index'] = {'path': path, 'backend': 'hnsw', 'metric': 'euclidean',
+                                  'use_rep': f'{PCA_KEY}|X_pca', 'n_pcs': n_pcs}
+    return index, n_pcs
+
+
+def membership_weights(distances, n_neighbors):
+    """UMAP fuzzy-set membership strengths of each row's neighbors."""
+    from umap.umap_ import smooth_knn_dist
+    sigmas, rhos = smooth_knn_dist(distances.astype(np.float32), float(n_neighbors))
+    return np.exp(-np.maximum(distances - rhos[:, None], 0) / sigmas[:, None])
+
+
+def transfer_labels(labels, indices, weights):
+    """Weighted kNN vote: (winning labels, fraction of the weight behind each winner)."""
+    labels = pd.Categorical(labels)
+    codes = labels.codes[indices]
+    rows = np.repeat(np.arange(indices.shape[0]), indices.shape[1])
+    valid = codes.ravel() >= 0
+    scores = np.zeros((indices.shape[0], max(len(labels.categories), 1)))
+    np.add.at(scores, (rows[valid], codes.ravel()[valid]), weights.ravel()[valid])
+    best = scores.argmax(axis=1)
+    confidence = scores[np.arange(len(best)), best] / np.maximum(scores.sum(axis=1), 1e-12)
+    return pd.Categorical.from_codes(best, labels.categories), confidence
+
+
+def _extend_graph(reference, indices, distances, weights):
+    """Reference obsp graphs with the new cells appended as extra rows and (symmetric) columns."""
+    n_ref, n_new = reference.n_obs, indices.shape[0]
+    shape = (n_new, n_ref)
+    rows = np.repeat(np.arange(n_new), indices.shape[1])
+    new_dist = scipy.sparse.csr_matrix((distances.ravel(), (rows, indices.ravel())), shape=shape)
+    new_conn = scipy.sparse.csr_matrix((weights.ravel(), (rows, indices.ravel())), shape=shape)
+    graphs = {}
+    for key, block, symmetric in (('distances', new_dist, False), ('connectivities', new_conn, True)):
+        if key not in reference.obsp:
+            continue
+        upper_right = block.T if symmetric else scipy.sparse.csr_matrix((n_ref, n_new), dtype=block.dtype)
+        graphs[key] = scipy.sparse.bmat(
+            [[reference.obsp[key], upper_right],
+             [block, scipy.sparse.csr_matrix((n_new, n_new), dtype=block.dtype)]], format='csr')
+    return graphs
+
+
+def add_cells(reference, new, output_dir, params=None):
+    """
+    Annotate `new` (raw counts) against the annotated `reference` and return
+    the merged AnnData plus a summary of the transferred labels.
+    """
+    qc_params = dict(QC_DEFAULTS, **(params or {}))
+    neighbors_params = reference.uns.get('neighbors', {}).get('params', {})
+    n_neighbors = int(neighbors_params.get('n_neighbors', 15))
+
+    with stage('qc', **adata_size(new)):
+        new = _qc_filter(new, qc_params)
+    if new.n_obs == 0:
+        raise ValueError("No new cells passed QC")
+
+    with stage('normalize', **adata_size(new)):
+        counts = scipy.sparse.csr_matrix(new.X, dtype=np.float32)
+        normalized = shiftlog(counts)
+        hvg = reference.var_names
+        X_hvg = _reindex_columns(normalized, new.var_names, hvg)
+        missing = int((~pd.Index(hvg).isin(new.var_names)).sum())
+        if missing:
+            print(f"{missing} of {len(hvg)} reference HVGs are missing from the new cells and set to zero")
+
+    with stage('project', n_obs=new.n_obs):
+        scaled, X_pca = project(reference, X_hvg)
+
+    with stage('neighbors', n_obs=new.n_obs, n_neighbors=n_neighbors):
+        index, n_pcs = reference_index(reference, output_dir, n_neighbors)
+        indices, distances = index.query(X_pca[:, :n_pcs], n_neighbors)
+        weights = membership_weights(distances, n_neighbors)
+
+    added = ad.AnnData(X=X_hvg, obs=pd.DataFrame(index=new.obs_names.copy()), var=reference.var.copy())
+    added.obs = added.obs.join(new.obs)
+    if 'counts' in reference.layers:
+        added.layers['counts'] = _reindex_columns(counts, new.var_names, hvg)
+    if 'scaled' in reference.layers:
+        added.layers['scaled'] = scaled
+    added.obsm[f'{PCA_KEY}|X_pca'] = X_pca
+
+    summary = {'n_new_cells': int(new.n_obs), 'n_neighbors': n_neighbors, 'labels': {}}
+    with stage('transfer', n_obs=new.n_obs):
+        for column in LABEL_COLUMNS:
+            if column not in reference.obs:
+                continue
+            labels, confidence = transfer_labels(reference.obs[column].values, indices, weights)
+            added.obs[column] = labels
+            summary['labels'][column] = {
+                'mean_confidence': round(float(confidence.mean()), 4),
+                'counts': pd.Series(labels).value_counts().astype(int).to_dict(),
+            }
+        normalized_weights = weights / weights.sum(axis=1, keepdims=True)
+        for key in EMBEDDING_KEYS:
+            if key in reference.obsm:
+                coords = np.asarray(reference.obsm[key])[indices]
+                added.obsm[key] = np.einsum('ij,ijk->ik', normalized_weights, coords).astype(coords.dtype)
+
+    with stage('merge', n_obs=reference.n_obs + new.n_obs):
+        graphs = _extend_graph(reference, indices, distances, weights)
+        raw = None
+        if reference.raw is not None:
+            raw_new = _reindex_columns(normalized, new.var_names, reference.raw.var_names)
+            raw = ad.AnnData(X=scipy.sparse.vstack([reference.raw.X, raw_new], format='csr'),
+                             var=reference.raw.var.copy())
+        if 'incremental_batch' not in reference.obs:
+            reference.obs['incremental_batch'] = 'reference'
+        added.obs['incremental_batch'] = datetime.now().strftime('%Y%m%d_%H%M')
+        merged = ad.concat([reference, added], join='inner', merge='first', uns_merge='first')
+        merged.obs_names_make_unique()
+        for column in LABEL_COLUMNS:
+            if column in merged.obs:
+                merged.obs[column] = merged.obs[column].astype('category')
+        if 'leiden_cnt' in reference.obs:
+            counts_per_cluster = merged.obs['leiden'].value_counts().to_dict()
+            merged.obs['leiden_cnt'] = merged.obs['leiden'].cat.rename_categories(
+                {c: f"{c} (n={counts_per_cluster[c]})" for c in merged.obs['leiden'].cat.categories})
+        for key, graph in graphs.items():
+            merged.obsp[key] = graph
+        if raw is not None:
+            merged.raw = raw
+    return merged, summary
+
+
+def annotate_incremental(name, input_file, reference_file, output_dir, params=None):
+    """
+    Add the cells of `input_file` (raw counts, any format `annotate` reads)
+    to the annotated `reference_file` written by `annotate`, and write the
+    merged dataset as `annotated_<name>_incremental_<timestamp>.h5ad`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+    data = {'figs': [], 'files': []}
+    with pipeline_run('annotate_incremental', output_dir, name) as run:
+        with stage('load'):
+            reference = read_h5ad(reference_file)
+            new = load_input(input_file)
+        if f'{PCA_KEY}|pca_loadings' not in reference.varm:
+            raise ValueError(f"{reference_file} has no stored PCA loadings; run annotate on it first")
+        merged, summary = add_cells(reference, new, output_dir, params)
+        output_file = os.path.join(output_dir, f"annotated_{name}_incremental_{timestamp}.h5ad")
+        with stage('write', **adata_size(merged)):
+            write_h5ad(merged, output_file)
+        with stage('summary'):
+            data['adata'] = summarize_h5ad(output_file)
+    data['incremental'] = summary
+    data['adata_output_file'] = output_file
+    data['timestamp'] = timestamp
+    data['timings'] = run.as_list()
+    data['total_timing'] = run.total
+    return data
@@ -0,0 +1,270 @@
+"""
+Input ingestion for the pipelines.
+
+Every supported input (h5ad, 10x h5, CSV/TXT, MTX) is converted once to an
+uncompressed h5ad in the ingestion cache, keyed by a hash of the source
+file contents; later runs on the same input read that file directly.
+
+CSV/TXT and MTX inputs are parsed in chunks straight into a float32 CSR
+matrix, so peak memory stays close to the size of the final sparse matrix
+instead of a dense float64 frame plus its transpose.
+
+`read_obs` reads only the obs table (backed mode) for steps that never
+touch the expression matrix.
+"""
+import csv
+import gzip
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from .output import read_h5ad
+from .store import is_zarr, read_obs_var
+
+CHUNK_BYTES = 64 * 2**20
+
+
+def cache_dir():
+    return os.environ.get('CELLPILOT_CACHE_DIR', os.path.join('cache', 'ingest'))
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+
+
+# ----------------------------------------------------------------------------
+# Source hashing
+# ----------------------------------------------------------------------------
+
+def _mtx_files(mtx_path):
+    """matrix, features/genes and barcodes files of a 10x MTX directory."""
+    folder = os.path.dirname(mtx_path)
+
+    def first_existing(*names):
+        for n in names:
+            if os.path.exists(os.path.join(folder, n)):
+                return os.path.join(folder, n)
+        raise FileNotFoundError(f"None of {names} found in {folder}")
+
+    features = first_existing('features.tsv.gz', 'features.tsv', 'genes.tsv.gz', 'genes.tsv')
+    barcodes = first_existing('barcodes.tsv.gz', 'barcodes.tsv')
+    return mtx_path, features, barcodes
+
+
+def _source_files(input_file):
+    if input_file.endswith('.mtx') or input_file.endswith('.mtx.gz'):
+        return _mtx_files(input_file)
+    return (input_file,)
+
+
+@lru_cache(maxsize=64)
+def _hash_files(identity):
+    digest = hashlib.sha256()
+    for path, _, _ in identity:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+    return digest.hexdigest()[:24]
+
+
+def source_hash(input_file):
+    """Content hash of an input (all three files for MTX); memoized per path, size and mtime."""
+    identity = tuple((os.path.realpath(p), os.path.getsize(p), os.stat(p).st_mtime_ns)
+                     for p in _source_files(input_file))
+    return _hash_files(identity)
+
+
+# ----------------------------------------------------------------------------
+# Streaming parsers
+# ----------------------------------------------------------------------------
+
+def read_text_csr(path, delimiter=None):
+    """
+    Read a gene x cell CSV/TXT table (genes in rows, cells in columns, as
+    `sc.read_csv(path).transpose()` expects) into a cells x genes AnnData
+    with a float32 CSR matrix, a bounded number of gene rows at a time.
+    """
+    with _open_text(path) as f:
+        header_line = f.readline()
+        first_line = f.readline()
+    if delimiter is None:
+        delimiter = '\t' if '\t' in header_line else ','
+    header = next(csv.reader([header_line], delimiter=delimiter))
+    n_fields = len(next(csv.reader([first_line], delimiter=delimiter)))
+    cell_names = header[1:] if len(header) == n_fields else header
+    n_cells = len(cell_names)
+
+    chunk_rows = max(CHUNK_BYTES // (4 * max(n_cells, 1)), 1)
+    dtype = {i: np.float32 for i in range(1, n_cells + 1)}
+    dtype[0] = str
+    reader = pd.read_csv(path, sep=delimiter, header=None, skiprows=1, index_col=0,
+                         dtype=dtype, chunksize=chunk_rows)
+
+    # each chunk of gene rows becomes a block of columns of the final matrix
+    genes, data, indices, indptr = [], [], [], [np.zeros(1, dtype=np.int64)]
+    nnz = 0
+    for chunk in reader:
+        block = scipy.sparse.csr_matrix(np.nan_to_num(chunk.values, copy=False))
+        genes.extend(chunk.index.astype(str))
+        data.append(block.data)
+        indices.append(block.indices.astype(np.int32, copy=False))
+        indptr.append(block.indptr[1:].astype(np.int64) + nnz)
+        nnz += block.nnz
+    X_csc = scipy.sparse.csc_matrix(
+        (np.concatenate(data) if data else np.zeros(0, np.float32),
+         np.concatenate(indices) if indices else np.zeros(0, np.int32),
+         np.concatenate(indptr)),
+        shape=(n_cells, len(genes)))
+    del data, indices
+    X = X_csc.tocsr()
+    del X_csc
+    return ad.AnnData(X=X, obs=pd.DataFrame(index=pd.Index(cell_names).astype(str)),
+                      var=pd.DataFrame(index=pd.Index(genes)))
+
+
+def _mtx_header(path):
+    with _open_text(path) as f:
+        line = f.readline()
+        if not line.startswith('%%MatrixMarket'):
+            raise ValueError(f"Not a MatrixMarket file: {path}")
+        symmetric = 'symmetric' in line
+        n_comment = 1
+        line = f.readline()
+        while line.startswith('%'):
+            n_comment += 1
+            line = f.readline()
+    if symmetric:
+        raise ValueError(f"Symmetric MatrixMarket files are not supported: {path}")
+    n_rows, n_cols, nnz = (int(v) for v in line.split())
+    return n_rows, n_cols, nnz, n_comment + 1
+
+
+def _mtx_chunks(path, skiprows):
+    chunk_rows = max(CHUNK_BYTES // 12, 1)
+    reader = pd.read_csv(path, sep=r'\s+', header=None, skiprows=skiprows, chunksize=chunk_rows,
+                         names=['gene', 'cell', 'value'],
+                         dtype={'gene': np.int64, 'cell': np.int64, 'value': np.float32})
+    for chunk in reader:
+        yield chunk['gene'].values - 1, chunk['cell'].values - 1, chunk['value'].values
+
+
+def read_mtx_csr(mtx_path):
+    """
+    Read a 10x MTX directory (matrix is genes x cells) into a cells x genes
+    AnnData with a float32 CSR matrix.  The matrix is scanned twice: once to
+    count entries per cell, once to write them into preallocated CSR arrays.
+    Names follow `sc.read_10x_mtx`: gene symbols (made unique) as var names,
+    gene ids and feature types in var, and only 'Gene Expression' features kept.
+    """
+    mtx_path, features_path, barcodes_path = _mtx_files(mtx_path)
+    n_genes, n_cells, _, skiprows = _mtx_header(mtx_path)
+
+    per_cell = np.zeros(n_cells, dtype=np.int64)
+    for _, cell, _ in _mtx_chunks(mtx_path, skiprows):
+        per_cell += np.bincount(cell, minlength=n_cells)
+    indptr = np.concatenate([[0], np.cumsum(per_cell)])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=np.float32)
+
+    cursor = indptr[:-1].copy()
+    for gene, cell, value in _mtx_chunks(mtx_path, skiprows):
+        order = np.argsort(cell, kind='stable')
+        cell = cell[order]
+        starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]])
+        run_lengths = np.diff(np.r_[starts, len(cell)])
+        offset = np.arange(len(cell)) - np.repeat(starts, run_lengths)
+        pos = cursor[cell] + offset
+        indices[pos] = gene[order]
+        data[pos] = value[order]
+        cursor[cell[starts]] += run_lengths
+
+    X = scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_cells, n_genes))
+    X.has_sorted_indices = False
+    X.sort_indices()
+
+    features = pd.read_csv(features_path, sep='\t', header=None, dtype=str)
+    barcodes = pd.read_csv(barcodes_path, sep='\t', header=None, dtype=str)[0].values
+    var = pd.DataFrame({'gene_ids': features[0].values},
+                       index=pd.Index(features[1 if features.shape[1] > 1 else 0].values))
+    adata = ad.AnnData(X=X, obs=pd.DataFrame(index=pd.Index(barcodes)), var=var)
+    if features.shape[1] > 2:
+        adata.var['feature_types'] = features[2].values
+        adata = adata[:, adata.var['feature_types'] == 'Gene Expression'].copy()
+    adata.var_names_make_unique()
+    return adata
+
+
+def _read_source(input_file):
+    if input_file.endswith('.h5ad'):
+        return ad.read_h5ad(input_file)
+    if input_file.endswith('.h5'):
+        import scanpy as sc
+        # Support for 10X Genomics H5 files
+        return sc.read_10x_h5(input_file)
+    if input_file.endswith('.csv') or input_file.endswith('.txt'):
+        return read_text_csr(input_file)
+    if input_file.endswith('.mtx') or input_file.endswith('.mtx.gz'):
+        return read_mtx_csr(input_file)
+    raise ValueError(f"Unsupported file format: {input_file}")
+
+
+# ----------------------------------------------------------------------------
+# Cache
+# ----------------------------------------------------------------------------
+
+def ingest(input_file):
+    """
+    Path of an uncompressed h5ad holding `input_file`.
+
+    h5ad inputs and Zarr stores are used in place.  Anything else is parsed
+    once and written to `<cache_dir>/<source hash>.h5ad`; later calls return
+    that file.
+    """
+    if input_file.endswith('.h5ad') or is_zarr(input_file):
+        return input_file
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(input_file)
+    cached = os.path.join(cache_dir(), f'{source_hash(input_file)}.h5ad')
+    if os.path.exists(cached):
+        print(f"Using cached ingestion of {input_file}: {cached}")
+        return cached
+
+    print(f"Converting {input_file} to h5ad...")
+    adata = _read_source(input_file)
+    if not scipy.sparse.issparse(adata.X):
+        adata.X = scipy.sparse.csr_matrix(adata.X, dtype=np.float32)
+    os.makedirs(cache_dir(), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir(), suffix='.h5ad')
+    os.close(fd)
+    try:
+        adata.write_h5ad(tmp)
+        os.replace(tmp, cached)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return cached
+
+
+def load_input(input_file):
+    """Load any supported input as an in-memory AnnData via the ingestion cache."""
+    # annotation delta files are resolved against their parent
+    return read_h5ad(ingest(input_file))
+
+
+def read_obs(input_file):
+    """Only the obs table of an input; h5ad files are opened in backed mode so X is never read."""
+    path = ingest(input_file)
+    if is_zarr(path):
+        return read_obs_var(path)[0]
+    adata = ad.read_h5ad(path, backed='r')
+    try:
+        return adata.obs.copy()
+    finally:
+        adata.file.close()
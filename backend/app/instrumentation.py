@@ -0,0 +1,306 @@
+"""
+Per-stage timing and memory instrumentation for pipeline runs.
+
+A pipeline wraps its body in `pipeline_run(...)` and each step in
+`stage(...)`:
+
+    with pipeline_run('annotate', output_dir, name) as run:
+        with stage('pca', **adata_size(adata)):
+            ...
+    data['timings'] = run.as_list()
+
+Every stage records wall time, CPU time, peak RSS while it ran and the input
+sizes passed to it.  CPU time (`cpu_seconds`) is process-wide
+(`time.process_time`): it includes the BLAS and numba threads a stage
+starts, and also the work of any other run executing in the same process
+at the time.  Peak RSS is sampled with psutil; without it only the process
+high-water mark (`ru_maxrss`) is known, which may have been reached before
+the stage started, and stages report it as `max_rss_mb` instead of
+`peak_rss_mb`.  Nested stages are recorded as `parent/child`.  Outside a
+`pipeline_run` the `stage` context manager is a no-op, so instrumented
+helpers can still be called on their own.
+
+Totals are also aggregated in-process and rendered in the Prometheus text
+format by `render_metrics()` for the `/metrics` endpoint.
+
+Setting `CELLPILOT_PROFILE=cprofile` (or `pyinstrument`, if installed) dumps
+a profile of every run to `CELLPILOT_PROFILE_DIR` (default: the run's output
+directory).
+"""
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+
+try:
+    import psutil
+except ImportError:  # fall back to the process high-water mark
+    psutil = None
+
+# name of the memory figure: current RSS (sampled) or the process high-water mark
+RSS_FIELD = 'peak_rss' if psutil is not None else 'max_rss'
+RSS_HELP = {
+    'stage': 'Highest resident set size seen during a stage.' if psutil is not None
+    else 'Process maximum resident set size at the end of a stage (psutil not installed).',
+    'process': 'Current resident set size of the API process.' if psutil is not None
+    else 'Maximum resident set size of the API process so far.',
+}
+
+RSS_SAMPLE_INTERVAL = 0.05
+
+_current_run = ContextVar('cellpilot_run', default=None)
+
+
+def _rss_bytes():
+    """Current RSS with psutil, otherwise the process's maximum RSS so far."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def adata_size(adata):
+    """Input-size fields for a stage record."""
+    sizes = {'n_obs': int(adata.n_obs), 'n_vars': int(adata.n_vars)}
+    X = getattr(adata, 'X', None)
+    if X is not None and hasattr(X, 'nnz'):
+        sizes['nnz'] = int(X.nnz)
+    return sizes
+
+
+class RunTimings:
+    """Stage records collected for one pipeline run."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.stages = []
+        self.total = {}
+        self._stack = []
+        self._active = []
+        self._lock = threading.Lock()
+
+    def as_list(self):
+        return [dict(s) for s in self.stages]
+
+    def _observe_rss(self, rss):
+        with self._lock:
+            for record in self._active:
+                if rss > record['_peak_rss']:
+                    record['_peak_rss'] = rss
+
+
+class _RssSampler(threading.Thread):
+    """Samples RSS in the background so each active stage sees its own peak."""
+
+    def __init__(self, timings):
+        super().__init__(daemon=True, name=f'rss-sampler-{timings.pipeline}')
+        self.timings = timings
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.timings._observe_rss(_rss_bytes())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+@contextmanager
+def stage(name, **sizes):
+    """Record one named stage of the current pipeline run."""
+    run = _current_run.get()
+    if run is None:
+        yield {}
+        return
+
+    rss = _rss_bytes()
+    record = {'stage': '/'.join(run._stack + [name]), 'inputs': sizes, '_peak_rss': rss}
+    run._stack.append(name)
+    with run._lock:
+        run._active.append(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    status = 'error'
+    try:
+        yield record
+        status = 'ok'
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        run._observe_rss(_rss_bytes())
+        with run._lock:
+            run._active.remove(record)
+        run._stack.pop()
+        peak = record.pop('_peak_rss')
+        record.update({
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            f'{RSS_FIELD}_mb': round(peak / 2**20, 1),
+            'status': status,
+        })
+        if not record['inputs']:
+            del record['inputs']
+        run.stages.append(record)
+        _metrics.observe_stage(run.pipeline, record['stage'], wall, cpu, peak)
+
+
+def timed(name=None):
+    """Decorator form of `stage`."""
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def pipeline_run(pipeline, output_dir=None, name=''):
+    """Collect stage timings for one pipeline run and optionally profile it."""
+    run = RunTimings(pipeline)
+    token = _current_run.set(run)
+    # without psutil every sample would read the same high-water mark
+    sampler = _RssSampler(run) if psutil is not None else None
+    if sampler is not None:
+        sampler.start()
+    profiler = _start_profiler()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    status = 'error'
+    try:
+        yield run
+        status = 'ok'
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        run.total = {
+            'wall_seconds': round(time.perf_counter() - wall_start, 4),
+            'cpu_seconds': round(time.process_time() - cpu_start, 4),
+            'status': status,
+        }
+        _current_run.reset(token)
+        _metrics.observe_run(pipeline, status, run.total['wall_seconds'])
+        if profiler is not None:
+            _dump_profile(profiler, pipeline, output_dir, name)
+
+
+# ----------------------------------------------------------------------------
+# Optional per-run profiling
+# ----------------------------------------------------------------------------
+
+def _profile_mode():
+    return os.environ.get('CELLPILOT_PROFILE', '').strip().lower()
+
+
+def _start_profiler():
+    mode = _profile_mode()
+    if not mode:
+        return None
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        except ImportError:
+            print("pyinstrument is not installed; falling back to cProfile")
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _dump_profile(profiler, pipeline, output_dir, name):
+    profile_dir = os.environ.get('CELLPILOT_PROFILE_DIR') or output_dir or '.'
+    os.makedirs(profile_dir, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    prefix = f'{name}_' if name else ''
+    if hasattr(profiler, 'output_html'):
+        profiler.stop()
+        path = os.path.join(profile_dir, f'{prefix}{pipeline}_profile_{timestamp}.html')
+        with open(path, 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        path = os.path.join(profile_dir, f'{prefix}{pipeline}_profile_{timestamp}.prof')
+        profiler.dump_stats(path)
+    print(f"Profile saved to {path}")
+
+
+# ----------------------------------------------------------------------------
+# Prometheus-style metrics
+# ----------------------------------------------------------------------------
+
+class _Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_count = defaultdict(int)
+        self.stage_wall = defaultdict(float)
+        self.stage_cpu = defaultdict(float)
+        self.stage_peak_rss = {}
+        self.run_count = defaultdict(int)
+        self.run_wall = defaultdict(float)
+
+    def observe_stage(self, pipeline, stage_name, wall, cpu, peak_rss):
+        key = (pipeline, stage_name)
+        with self._lock:
+            self.stage_count[key] += 1
+            self.stage_wall[key] += wall
+            self.stage_cpu[key] += cpu
+            self.stage_peak_rss[key] = max(peak_rss, self.stage_peak_rss.get(key, 0))
+
+    def observe_run(self, pipeline, status, wall):
+        with self._lock:
+            self.run_count[(pipeline, status)] += 1
+            self.run_wall[pipeline] += wall
+
+    def render(self):
+        lines = []
+
+        def family(metric, kind, help_text, samples):
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+
+        with self._lock:
+            stage_labels = lambda key: {'pipeline': key[0], 'stage': key[1]}
+            family('cellpilot_stage_runs_total', 'counter', 'Completed pipeline stages.',
+                   [(stage_labels(k), v) for k, v in sorted(self.stage_count.items())])
+            family('cellpilot_stage_wall_seconds_total', 'counter', 'Wall time spent in pipeline stages.',
+                   [(stage_labels(k), round(v, 6)) for k, v in sorted(self.stage_wall.items())])
+            family('cellpilot_stage_cpu_seconds_total', 'counter',
+                   'CPU time of the whole process (all threads and concurrent runs) during pipeline stages.',
+                   [(stage_labels(k), round(v, 6)) for k, v in sorted(self.stage_cpu.items())])
+            family(f'cellpilot_stage_{RSS_FIELD}_bytes', 'gauge', RSS_HELP['stage'],
+                   [(stage_labels(k), v) for k, v in sorted(self.stage_peak_rss.items())])
+            family('cellpilot_pipeline_runs_total', 'counter', 'Finished pipeline runs.',
+                   [({'pipeline': p, 'status': s}, v) for (p, s), v in sorted(self.run_count.items())])
+            family('cellpilot_pipeline_wall_seconds_total', 'counter', 'Wall time spent in pipeline runs.',
+                   [({'pipeline': p}, round(v, 6)) for p, v in sorted(self.run_wall.items())])
+        family('cellpilot_process_resident_memory_bytes' if psutil is not None
+               else 'cellpilot_process_max_resident_memory_bytes', 'gauge', RSS_HELP['process'], [({}, _rss_bytes())])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_metrics = _Metrics()
+
+
+def render_metrics():
+    """All collected metrics in the Prometheus text exposition format."""
+    return _metrics.render()
@@ -1,13 +1,25 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from .models import AdataRequest, AdataResponse, AnnotationParams, CellPhoneDBParams, InferCNVParams, Response
+from .models import AdataRequest, AdataResponse, AnnotationParams, IncrementalAnnotationParams, CellPhoneDBParams, InferCNVParams, DrugResponseBatchParams, Response
 from .tasks import spawn_process
 from .utils import summarize_h5ad
 from .analysis import run_cell_phone_db, run_inferncnv
 from .annotate import annotate
+from .incremental import annotate_incremental
+from .drug_response import iter_batch_drug_response, stream_events
+from .instrumentation import render_metrics
+from .admission import admission
+from .coalesce import coalescer, request_key
+from .catalog import DEFAULT_LIMIT, get_run, list_runs, record_events, record_run
+from .embedding import embedding_buffers, pack
+from .expression import gene_vectors
+from .transport import CompressionMiddleware, negotiated
 from fastapi.concurrency import run_in_threadpool
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from fastapi.responses import Response as BinaryResponse
 import asyncio
+import os
+from typing import List, Optional
 app = FastAPI(title="CellPilot API")
 
 #  allow renderer → http://localhost:5173 or packaged file://
@@ -17,33 +29,91 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+app.add_middleware(CompressionMiddleware)
 
 @app.get("/ping")
 def ping(): return {"ok": True}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Per-stage pipeline timings and memory in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/queue")
+def queue_status():
+    """Running and waiting pipeline jobs, with queue positions and the resource budgets."""
+    return admission.status()
+
+
+@app.get("/runs")
+def runs_list(request: Request, pipeline: Optional[str] = None, name: Optional[str] = None,
+              status: Optional[str] = None, output_dir: Optional[str] = None, since: Optional[str] = None,
+              until: Optional[str] = None, fingerprint: Optional[str] = None, input_path: Optional[str] = None,
+              artifact: Optional[str] = None, limit: int = DEFAULT_LIMIT, before: Optional[int] = None):
+    """Past runs from the run catalog, newest first; pass `next` as `before` for the following page."""
+    runs = list_runs(limit=limit, before=before, pipeline=pipeline, name=name, status=status,
+                     output_dir=output_dir, since=since, until=until, fingerprint=fingerprint,
+                     input_path=input_path, artifact=artifact)
+    return negotiated(request, runs)
+
+
+@app.get("/runs/{run_id}")
+def run_detail(run_id: int, request: Request):
+    """One cataloged run with its parameters, inputs, artifacts, timings and summary."""
+    run = get_run(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    return negotiated(request, run)
+
+
+def cataloged(pipeline, params, input_paths, run, payload=lambda result: result):
+    """Wrap a pipeline coroutine function so that its outcome is recorded in the run catalog."""
+    async def wrapped():
+        try:
+            result = await run()
+        except HTTPException:
+            raise
+        except Exception as e:
+            await run_in_threadpool(record_run, pipeline, params.name, input_paths, params.output_dir,
+                                    params=params.model_dump(), status='error', error=str(e))
+            raise
+        await run_in_threadpool(record_run, pipeline, params.name, input_paths, params.output_dir,
+                                payload(result), params=params.model_dump())
+        return result
+    return wrapped
+
+
 @app.post("/adata_upload")
-def adata_upload(adata_request: AdataRequest):
+def adata_upload(adata_request: AdataRequest, request: Request):
     #get metadata from adata_request to show preview on frontend
     print(adata_request)
     summary = summarize_h5ad(adata_request.input_path)
-    return AdataResponse(
+    return negotiated(request, AdataResponse(
         input_path=adata_request.input_path,
         name=adata_request.name,
         status="success",
         message="Adata uploaded successfully",
         summary=summary
-    )
+    ))
 
 # --------------------------- Annotation ---------------------------
 @app.post("/annotate")
-async def annotate_api(params: AnnotationParams):
+async def annotate_api(params: AnnotationParams, request: Request):
     """Run the heavy, synchronous `annotate` pipeline inside the thread-pool
     executor so that this *async* endpoint stays non-blocking. The function
     returns exactly the structure required by the shared `Response` model.
     """
-    try:
-        data, pre_params = await run_in_threadpool(
+    job = admission.job(
+        'annotate', params.name, params.input_path,
+        cpus=2 if params.preprocessed else 4,
+        n_hvgs=params.preprocessing_params.get('n_hvgs', 2000),
+        memory_kind='annotate_preprocessed' if params.preprocessed else 'annotate',
+    )
+    async def run():
+        data, pre_params = await admission.run(
+            job,
             annotate,
             params.name,
             params.input_path,
@@ -54,7 +124,16 @@ async def annotate_api(params: AnnotationParams):
             params.use_panglao,
             params.use_cancer_single_cell_atlas
         )
-        return Response(
+        data['data']['admission'] = job.summary()
+        return data, pre_params
+
+    try:
+        # the resolved preprocessing parameters go into the cataloged summary
+        payload = lambda result: dict(result[0]['data'], timestamp=result[0]['timestamp'],
+                                      preprocessing_params=result[1])
+        data, pre_params = await coalescer.run(request_key('annotate', params.input_path, params),
+                                               cataloged('annotate', params, params.input_path, run, payload))
+        return negotiated(request, Response(
             name=params.name,
             type="annotate",
             input_path=params.input_path,
@@ -62,15 +141,55 @@ async def annotate_api(params: AnnotationParams):
             data=data['data'],
             timestamp=data['timestamp'],
             params=pre_params
+        ))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/annotate/incremental")
+async def annotate_incremental_api(params: IncrementalAnnotationParams, request: Request):
+    """Add new cells to an annotated h5ad by projection and label transfer."""
+    # memory is dominated by the reference, which is loaded whole
+    job = admission.job('annotate', params.name, params.reference_path, cpus=2,
+                        memory_kind='annotate_preprocessed')
+    async def run():
+        data = await admission.run(
+            job,
+            annotate_incremental,
+            params.name,
+            params.input_path,
+            params.reference_path,
+            params.output_dir,
+            params.qc_params,
         )
+        data['admission'] = job.summary()
+        return data
+
+    try:
+        key = request_key('annotate_incremental', [params.input_path, params.reference_path], params)
+        data = await coalescer.run(key, cataloged('annotate_incremental', params,
+                                                  [params.input_path, params.reference_path], run))
+        return negotiated(request, Response(
+            name=params.name,
+            type="annotate_incremental",
+            input_path=params.input_path,
+            output_dir=params.output_dir,
+            data=data,
+            timestamp=data['timestamp']
+        ))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # --------------------------- CellPhoneDB -------------------------
 @app.post("/cellphonedb")
-async def cellphonedb_api(params: CellPhoneDBParams):
-    try:
-        data = await run_in_threadpool(
+async def cellphonedb_api(params: CellPhoneDBParams, request: Request):
+    job = admission.job('cellphonedb', params.name, params.input_path, cpus=params.threads)
+    async def run():
+        data = await admission.run(
+            job,
             run_cell_phone_db,
             params.input_path,          # input_file
             params.output_dir,          # output_dir
@@ -78,23 +197,34 @@ async def cellphonedb_api(params: CellPhoneDBParams):
             params.column_name,         # column_name in obs
             params.cpdb_file_path,      # database zip
             params.name,                # run name / prefix
+            threads=job.cpus,
         )
-        return Response(
+        data['admission'] = job.summary()
+        return data
+
+    try:
+        data = await coalescer.run(request_key('cellphonedb', params.input_path, params),
+                                   cataloged('cellphonedb', params, params.input_path, run))
+        return negotiated(request, Response(
             name=params.name,
             type="cellphonedb",
             input_path=params.input_path,
             output_dir=params.output_dir,
             data=data,
                 timestamp=data['timestamp']
-            )
+            ))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # --------------------------- InferCNV ----------------------------
 @app.post("/inferCNV")
-async def inferCNV_api(params: InferCNVParams):
-    try:
-        data = await run_in_threadpool(
+async def inferCNV_api(params: InferCNVParams, request: Request):
+    job = admission.job('infercnv', params.name, params.input_path, cpus=params.cores)
+    async def run():
+        data = await admission.run(
+            job,
             run_inferncnv,
             params.input_path,
             params.output_dir,
@@ -102,20 +232,52 @@ async def inferCNV_api(params: InferCNVParams):
             params.reference_key,
             params.gtf_path,
         params.reference_cat,
-        params.cnv_threshold
+        params.cnv_threshold,
+        cores=job.cpus,
+        neighbors_backend=params.neighbors_backend,
         )
-        return Response(
+        data['admission'] = job.summary()
+        return data
+
+    try:
+        data = await coalescer.run(request_key('inferCNV', params.input_path, params),
+                                   cataloged('inferCNV', params, params.input_path, run))
+        return negotiated(request, Response(
             name=params.name,
             type="inferCNV",
             input_path=params.input_path,
             output_dir=params.output_dir,
             data=data,
                 timestamp=data['timestamp']
-            )
+            ))
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+# --------------------------- Drug response -----------------------
+@app.post("/drug_response/batch")
+def drug_response_batch_api(params: DrugResponseBatchParams):
+    """Score many samples in one CaDRReS-Sc run. Progress is streamed back as
+    newline-delimited JSON: one `profiled` and one `scored` event per sample,
+    then a final `done` event with the combined tables.
+    """
+    missing = [p for p in params.input_paths if not os.path.exists(p)]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Input files not found: {missing}")
+    events = iter_batch_drug_response(
+        params.input_paths,
+        params.output_dir,
+        params.name,
+        cluster_key=params.cluster_key,
+        model_paths=params.model_paths,
+        freq_cutoff=params.freq_cutoff,
+    )
+    events = record_events(events, 'drug_response_batch', params.name, params.input_paths, params.output_dir,
+                           params=params.model_dump())
+    return StreamingResponse(stream_events(events), media_type="application/x-ndjson")
+
 @app.get("/preview_img")
 def preview_img(path: str):
     return FileResponse(path, media_type="image/png")
@@ -128,6 +290,46 @@ def preview_txt(path: str):
 def preview_csv(path: str):
     return FileResponse(path, media_type="text/csv")
 
+@app.get("/embedding")
+def embedding(path: str, basis: str = "X_umap", column: Optional[str] = None, mode: str = "sample",
+              max_points: int = 200000, resolution: int = 512, x0: Optional[float] = None,
+              x1: Optional[float] = None, y0: Optional[float] = None, y1: Optional[float] = None):
+    """
+    Embedding coordinates and one obs column as packed binary buffers at a
+    level of detail (`app.embedding`); x0/x1/y0/y1 restrict it to a viewport.
+    """
+    bounds = (x0, x1, y0, y1)
+    if any(v is not None for v in bounds) and any(v is None for v in bounds):
+        raise HTTPException(status_code=422, detail="A viewport needs all of x0, x1, y0 and y1")
+    viewport = bounds if x0 is not None else None
+    try:
+        payload = embedding_buffers(path, basis=basis, column=column, mode=mode, max_points=max_points,
+                                    resolution=resolution, viewport=viewport)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"File not found: {path}")
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]) if e.args else str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return BinaryResponse(payload, media_type="application/octet-stream")
+
+
+@app.get("/gene_expression")
+def gene_expression(path: str, genes: List[str] = Query(...)):
+    """
+    Expression of one or more genes over all cells, as packed float32
+    buffers (one per gene, layout of `/embedding`), from the CSC store of
+    the dataset (`app.expression`), which the first query builds.
+    """
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"File not found: {path}")
+    vectors, missing = gene_vectors(path, genes)
+    if not vectors:
+        raise HTTPException(status_code=404, detail=f"Genes not found in {path}: {missing}")
+    n_obs = len(next(iter(vectors.values())))
+    payload = pack({'genes': list(vectors), 'missing': missing, 'n_obs': n_obs}, vectors)
+    return BinaryResponse(payload, media_type="application/octet-stream")
+
 if __name__ == "__main__":
     params = AnnotationParams(
         name="test",
@@ -136,4 +338,5 @@ if __name__ == "__main__":
         use_cellmarker=True,
         use_panglao=True,
     )
-    asyncio.run(annotate_api(params))
\ No newline at end of file
+    # a bare request without an Accept header: the response is returned as JSON content
+    asyncio.run(annotate_api(params, Request({'type': 'http', 'headers': []})))
\ No newline at end of file
@@ -23,6 +23,13 @@ class AnnotationParams(BaseModel):
     use_panglao: bool
     use_cancer_single_cell_atlas: bool
 
+class IncrementalAnnotationParams(BaseModel):
+    name: str
+    input_path: str
+    reference_path: str
+    output_dir: str
+    qc_params: Dict[str, Any] = {}
+
 class CellPhoneDBParams(BaseModel):
     input_path: str
     name: str
@@ -30,6 +37,7 @@ class CellPhoneDBParams(BaseModel):
     plot_column_names: List[str]
     column_name: str
     cpdb_file_path: str
+    threads: int = 10
 
 class InferCNVParams(BaseModel):
     input_path: str
@@ -39,6 +47,8 @@ class InferCNVParams(BaseModel):
     gtf_path: str
     reference_cat: List[str]
     cnv_threshold: float
+    cores: int = 4
+    neighbors_backend: Optional[str] = None
 
 class Response(BaseModel):
     name: str
@@ -47,4 +57,13 @@ class Response(BaseModel):
     data: Dict[str, Any]
     timestamp: str
     type: Optional[str] = None
-    params: Optional[Dict[str, Any]] = None
\ No newline at end of file
+    params: Optional[Dict[str, Any]] = None
+
+
+class DrugResponseBatchParams(BaseModel):
+    name: str
+    input_paths: List[str]
+    output_dir: str
+    cluster_key: str = "louvain"
+    model_paths: Optional[Dict[str, str]] = None
+    freq_cutoff: float = 0.05
@@ -0,0 +1,486 @@
+"""
+Pluggable k-nearest-neighbor backends for `sc.pp.neighbors`.
+
+Backends:
+
+* `exact`      chunked brute force
+* `nndescent`  pynndescent's NN-descent graph
+* `hnsw`       a hierarchical navigable small-world index implemented here
+               with numba (no hnswlib dependency)
+
+`KnnIndex` builds once and answers both the all-points kNN graph and
+queries for new points.  Only the graph arrays are persisted (the data
+itself lives in the h5ad), in a file keyed by a fingerprint of the data, so
+rerunning on the same representation, e.g. with only a different Leiden
+resolution, loads the index instead of rebuilding it.
+
+`NeighborsTransformer` wraps an index in the KNeighborsTransformer
+interface, so it plugs into `sc.pp.neighbors(adata, transformer=...)` and
+therefore also into `cnv.pp.neighbors`.
+"""
+import hashlib
+import heapq
+import os
+import tempfile
+import threading
+
+import numpy as np
+import scipy.sparse
+import numba
+from numba import njit, prange
+
+BACKENDS = ('exact', 'nndescent', 'hnsw')
+
+# saved index path -> lock, so threads of one process build each index once
+_build_locks = {}
+_build_locks_guard = threading.Lock()
+
+
+def fingerprint(X):
+    """Content hash of a dense representation."""
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(str((X.shape, X.dtype.str)).encode())
+    digest.update(X.data)
+    return digest.hexdigest()[:16]
+
+
+def _prepare(X, metric):
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if metric == 'cosine':
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        X = X / np.where(norms == 0, 1, norms)
+    elif metric != 'euclidean':
+        raise ValueError(f"Unsupported metric {metric!r}: use 'euclidean' or 'cosine'")
+    return X
+
+
+def _to_metric(sq_dist, metric):
+    sq_dist = np.maximum(sq_dist, 0)
+    # on unit vectors |a - b|^2 / 2 = 1 - cos(a, b)
+    return (sq_dist / 2 if metric == 'cosine' else np.sqrt(sq_dist)).astype(np.float32)
+
+
+def _self_first(indices, distances):
+    """Move each row's own index to column 0 (duplicates can tie with it at distance 0)."""
+    rows = np.arange(indices.shape[0])
+    is_self = indices == rows[:, None]
+    has_self = is_self.any(axis=1)
+    position = np.where(has_self, is_self.argmax(axis=1), indices.shape[1] - 1)
+    for col in range(indices.shape[1] - 1, 0, -1):
+        move = position >= col
+        indices[move, col] = indices[move, col - 1]
+        distances[move, col] = distances[move, col - 1]
+    indices[:, 0] = rows
+    distances[:, 0] = 0
+    return indices, distances
+
+
+# ----------------------------------------------------------------------------
+# Exact
+# ----------------------------------------------------------------------------
+
+def exact_knn(X, k, Y=None, chunk_size=2048):
+    """Squared-euclidean k nearest rows of X for every row of Y (default: X itself)."""
+    Y = X if Y is None else Y
+    x_sq = np.einsum('ij,ij->i', X, X)
+    indices = np.empty((Y.shape[0], k), dtype=np.int64)
+    distances = np.empty((Y.shape[0], k), dtype=np.float32)
+    for start in range(0, Y.shape[0], chunk_size):
+        block = Y[start:start + chunk_size]
+        d = x_sq[None, :] - 2 * block @ X.T + np.einsum('ij,ij->i', block, block)[:, None]
+        part = np.argpartition(d, k - 1, axis=1)[:, :k]
+        part_d = np.take_along_axis(d, part, axis=1)
+        order = np.argsort(part_d, axis=1, kind='stable')
+        indices[start:start + len(block)] = np.take_along_axis(part, order, axis=1)
+        distances[start:start + len(block)] = np.take_along_axis(part_d, order, axis=1)
+    return indices, distances
+
+
+# ----------------------------------------------------------------------------
+# Graph search (shared by hnsw and by queries on a plain kNN graph)
+# ----------------------------------------------------------------------------
+
+@njit(cache=True)
+def _sq_dist(X, i, q):
+    d = 0.0
+    for j in range(q.shape[0]):
+        t = X[i, j] - q[j]
+        d += t * t
+    return d
+
+
+@njit(cache=True)
+def _neighbors_of(node, layer, graph0, upper_id, graph_upper):
+    if layer == 0:
+        row = graph0[node]
+    else:
+        row = graph_upper[upper_id[node], layer - 1]
+    n = 0
+    while n < row.shape[0] and row[n] >= 0:
+        n += 1
+    return row[:n]
+
+
+@njit(cache=True)
+def _search_layer(X, q, entries, ef, layer, graph0, upper_id, graph_upper, visited, tag):
+    """
+    Beam search on one layer; returns (sq_dist, node) pairs sorted ascending,
+    at most `ef`.  `visited[i] == tag` marks nodes seen in this search, so the
+    scratch array is reused across searches by bumping `tag`.
+    """
+    first = np.int64(entries[0])
+    d0 = _sq_dist(X, first, q)
+    visited[first] = tag
+    candidates = [(d0, first)]
+    results = [(-d0, first)]
+    for e in entries[1:]:
+        e = np.int64(e)
+        if visited[e] == tag:
+            continue
+        d = _sq_dist(X, e, q)
+        visited[e] = tag
+        heapq.heappush(candidates, (d, e))
+        heapq.heappush(results, (-d, e))
+        if len(results) > ef:
+            heapq.heappop(results)
+    while len(candidates) > 0:
+        d, c = heapq.heappop(candidates)
+        if d > -results[0][0] and len(results) >= ef:
+            break
+        for n in _neighbors_of(c, layer, graph0, upper_id, graph_upper):
+            n = np.int64(n)
+            if visited[n] == tag:
+                continue
+            visited[n] = tag
+            dn = _sq_dist(X, n, q)
+            if len(results) < ef or dn < -results[0][0]:
+                heapq.heappush(candidates, (dn, n))
+                heapq.heappush(results, (-dn, n))
+                if len(results) > ef:
+                    heapq.heappop(results)
+    out_d = np.empty(len(results), dtype=np.float64)
+    out_i = np.empty(len(results), dtype=np.int64)
+    for j in range(len(results) - 1, -1, -1):
+        d, n = heapq.heappop(results)
+        out_d[j] = -d
+        out_i[j] = n
+    return out_d, out_i
+
+
+@njit(cache=True)
+def _select(X, base, cand_d, cand_i, m):
+    """HNSW neighbor-selection heuristic: prefer candidates not already covered by a closer pick."""
+    keep = np.full(m, -1, dtype=np.int64)
+    n_keep = 0
+    skipped = np.empty(cand_i.shape[0], dtype=np.int64)
+    n_skipped = 0
+    for j in range(cand_i.shape[0]):
+        c = cand_i[j]
+        if c == base:
+            continue
+        if n_keep >= m:
+            break
+        good = True
+        for r in range(n_keep):
+            if _sq_dist(X, keep[r], X[c]) < cand_d[j]:
+                good = False
+                break
+        if good:
+            keep[n_keep] = c
+            n_keep += 1
+        else:
+            skipped[n_skipped] = c
+            n_skipped += 1
+    j = 0
+    while n_keep < m and j < n_skipped:
+        keep[n_keep] = skipped[j]
+        n_keep += 1
+        j += 1
+    return keep
+
+
+@njit(cache=True)
+def _link(X, node, new, layer, m, graph0, upper_id, graph_upper):
+    row = graph0[node] if layer == 0 else graph_upper[upper_id[node], layer - 1]
+    for j in range(m):
+        if row[j] == new:
+            return
+        if row[j] < 0:
+            row[j] = new
+            return
+    # full: re-select among the current neighbors plus the new node
+    cand_i = np.empty(m + 1, dtype=np.int64)
+    cand_d = np.empty(m + 1, dtype=np.float64)
+    for j in range(m):
+        cand_i[j] = row[j]
+        cand_d[j] = _sq_dist(X, row[j], X[node])
+    cand_i[m] = new
+    cand_d[m] = _sq_dist(X, new, X[node])
+    order = np.argsort(cand_d)
+    row[:] = _select(X, node, cand_d[order], cand_i[order], m)
+
+
+@njit(cache=True)
+def _build_hnsw(X, levels, upper_id, m, ef_construction):
+    n = X.shape[0]
+    max_level = levels.max()
+    graph0 = np.full((n, 2 * m), -1, dtype=np.int32)
+    n_upper = max(upper_id.max() + 1, 1)
+    graph_upper = np.full((n_upper, max(max_level, 1), m), -1, dtype=np.int32)
+    visited = np.zeros(n, dtype=np.int64)
+    tag = 0
+    entry = 0
+    top = levels[0]
+    for i in range(1, n):
+        q = X[i]
+        level = levels[i]
+        ep = np.array([entry], dtype=np.int64)
+        for layer in range(top, level, -1):
+            tag += 1
+            _, found = _search_layer(X, q, ep, 1, layer, graph0, upper_id, graph_upper, visited, tag)
+            ep = found[:1]
+        for layer in range(min(level, top), -1, -1):
+            width = 2 * m if layer == 0 else m
+            tag += 1
+            cand_d, cand_i = _search_layer(X, q, ep, ef_construction, layer, graph0, upper_id, graph_upper,
+                                           visited, tag)
+            chosen = _select(X, i, cand_d, cand_i, width)
+            for c in chosen:
+                if c < 0:
+                    break
+                _link(X, i, c, layer, width, graph0, upper_id, graph_upper)
+                _link(X, c, i, layer, width, graph0, upper_id, graph_upper)
+            ep = cand_i
+        if level > top:
+            top = level
+            entry = i
+    return graph0, graph_upper, entry
+
+
+@njit(parallel=True, cache=True)
+def _query_hnsw(X, Q, k, ef, entries, top, graph0, upper_id, graph_upper, n_blocks):
+    """k nearest points for each row of Q, entering at the points `entries[i]` (top layer `top`)."""
+    n_q = Q.shape[0]
+    indices = np.empty((n_q, k), dtype=np.int64)
+    distances = np.empty((n_q, k), dtype=np.float64)
+    for b in prange(n_blocks):
+        # one visited array per block of queries
+        visited = np.zeros(X.shape[0], dtype=np.int64)
+        tag = 0
+        for i in range(b, n_q, n_blocks):
+            q = Q[i]
+            ep = entries[i]
+            for layer in range(top, 0, -1):
+                tag += 1
+                _, found = _search_layer(X, q, ep, 1, layer, graph0, upper_id, graph_upper, visited, tag)
+                ep = found[:1]
+            tag += 1
+            d, found = _search_layer(X, q, ep, max(ef, k), 0, graph0, upper_id, graph_upper, visited, tag)
+            indices[i] = found[:k]
+            distances[i] = d[:k]
+    return indices, distances
+
+
+
+# ----------------------------------------------------------------------------
+# Index
+# ----------------------------------------------------------------------------
+
+class KnnIndex:
+    """
+    Build-once, query-many kNN index over the rows of a dense matrix.
+
+    `knn()` returns the all-points graph (self in column 0), `query()`
+    neighbors of new points.  For `exact` queries are brute force; for
+    `hnsw` they walk the hierarchy; for `nndescent` they beam-search the
+    stored kNN graph from a few random entry points.
+    """
+
+    def __init__(self, backend='hnsw', n_neighbors=15, metric='euclidean', m=16,
+                 ef_construction=100, ef_search=None, random_state=0):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown neighbors backend {backend!r}. Available: {BACKENDS}")
+        self.backend = backend
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search or max(2 * n_neighbors, 50)
+        self.random_state = random_state
+        self.fingerprint = None
+        self._X = None
+        self._arrays = {}
+
+    # -- build ---------------------------------------------------------------
+
+    def build(self, X):
+        self._X = _prepare(X, self.metric)
+        self.fingerprint = fingerprint(self._X)
+        k = min(self.n_neighbors, self._X.shape[0])
+        if self.backend == 'exact':
+            indices, sq = exact_knn(self._X, k)
+        elif self.backend == 'nndescent':
+            from pynndescent import NNDescent
+            nnd = NNDescent(self._X, n_neighbors=k, metric='euclidean', random_state=self.random_state)
+            indices, dist = nnd.neighbor_graph
+            sq = dist.astype(np.float64) ** 2
+        else:
+            self._build_hnsw()
+            indices, sq = self._query_graph(self._X, k, ef=max(self.ef_search, k))
+        indices, sq = _self_first(indices.astype(np.int64), sq.astype(np.float64))
+        self._arrays['knn_indices'] = indices
+        self._arrays['knn_distances'] = _to_metric(sq, self.metric)
+        return self
+
+    def _build_hnsw(self):
+        n = self._X.shape[0]
+        rng = np.random.default_rng(self.random_state)
+        levels = np.floor(-np.log(rng.uniform(size=n) + 1e-12) / np.log(self.m)).astype(np.int64)
+        upper_id = np.where(levels > 0, np.cumsum(levels > 0) - 1, -1).astype(np.int64)
+        graph0, graph_upper, entry = _build_hnsw(self._X, levels, upper_id, self.m, self.ef_construction)
+        self._arrays.update(levels=levels, upper_id=upper_id, graph0=graph0,
+                            graph_upper=graph_upper, entry=np.array([entry]))
+
+    # -- query ---------------------------------------------------------------
+
+    def knn(self):
+        """All-points kNN graph: (indices, distances), each row starting with the point itself."""
+        return self._arrays['knn_indices'], self._arrays['knn_distances']
+
+    def _query_graph(self, Q, k, ef):
+        a = self._arrays
+        if 'graph0' in a:
+            graph0, upper_id, graph_upper = a['graph0'], a['upper_id'], a['graph_upper']
+            top = int(a['levels'].max())
+            entries = np.full((Q.shape[0], 1), int(a['entry'][0]), dtype=np.int64)
+        else:
+            # plain kNN graph: a single layer, entered at the closest of a sample of points
+            graph0 = a['knn_indices'].astype(np.int32)
+            upper_id = np.full(graph0.shape[0], -1, dtype=np.int64)
+            graph_upper = np.full((1, 1, 1), -1, dtype=np.int32)
+            top = 0
+            rng = np.random.default_rng(self.random_state)
+            starts = rng.choice(graph0.shape[0], min(256, graph0.shape[0]), replace=False)
+            entries = starts[exact_knn(self._X[starts], min(4, len(starts)), Q)[0]].astype(np.int64)
+        n_blocks = max(min(Q.shape[0], 4 * numba.get_num_threads()), 1)
+        return _query_hnsw(self._X, Q, k, ef, entries, top, graph0, upper_id, graph_upper, n_blocks)
+
+    def query(self, Y, k=None):
+        """k nearest indexed points for each row of Y: (indices, distances)."""
+        k = k or self.n_neighbors
+        Q = _prepare(Y, self.metric)
+        if self.backend == 'exact':
+            indices, sq = exact_knn(self._X, k, Q)
+        else:
+            indices, sq = self._query_graph(Q, k, ef=max(self.ef_search, k))
+        return indices, _to_metric(sq, self.metric)
+
+    # -- persistence ---------------------------------------------------------
+
+    def file_name(self, fp=None):
+        return f'{self.backend}_{self.metric}_k{self.n_neighbors}_{fp or self.fingerprint}.npz'
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.file_name())
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f'{self.file_name()}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, backend=self.backend, metric=self.metric, n_neighbors=self.n_neighbors,
+                         fingerprint=self.fingerprint, **self._arrays)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
+
+    @classmethod
+    def load(cls, path, X):
+        """Load a saved index and attach the data it was built on (checked by fingerprint)."""
+        with np.load(path, allow_pickle=False) as f:
+            index = cls(backend=str(f['backend']), n_neighbors=int(f['n_neighbors']), metric=str(f['metric']))
+            index.fingerprint = str(f['fingerprint'])
+            index._arrays = {k: f[k] for k in f.files if k not in ('backend', 'metric', 'n_neighbors', 'fingerprint')}
+        index._X = _prepare(X, index.metric)
+        if fingerprint(index._X) != index.fingerprint:
+            raise ValueError(f"{path} was built on different data")
+        return index
+
+    @classmethod
+    def build_or_load(cls, X, directory=None, **kwargs):
+        index = cls(**kwargs)
+        if directory is None:
+            index.build(X)
+            return index, None
+        path = os.path.join(directory, index.file_name(fingerprint(_prepare(X, index.metric))))
+        with _build_lock(os.path.abspath(path)):
+            if os.path.exists(path):
+                print(f"Reusing neighbor index {path}")
+                return cls.load(path, X), path
+            index.build(X)
+            return index, index.save(directory)
+
+
+def _build_lock(path):
+    with _build_locks_guard:
+        return _build_locks.setdefault(path, threading.Lock())
+
+
+def knn_graph(indices, distances):
+    """CSR distance matrix with each row in neighbor order, as scanpy's transformers return it."""
+    n, k = indices.shape
+    return scipy.sparse.csr_matrix(
+        (distances.ravel().copy(), indices.ravel().copy(), np.arange(0, n * k + 1, k)), shape=(n, n))
+
+
+class NeighborsTransformer:
+    """
+    KNeighborsTransformer-compatible wrapper around `KnnIndex`, for
+    `sc.pp.neighbors(adata, transformer=NeighborsTransformer(...))`.
+
+    With `index_dir`, the index is saved there and reused when the same
+    representation is seen again.
+    """
+
+    def __init__(self, backend='hnsw', n_neighbors=15, metric='euclidean', index_dir=None, random_state=0):
+        self.backend = backend
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.index_dir = index_dir
+        self.random_state = random_state
+        self.index_path = None
+
+    def get_params(self, deep=True):
+        return {'backend': self.backend, 'n_neighbors': self.n_neighbors, 'metric': self.metric,
+                'index_dir': self.index_dir, 'random_state': self.random_state}
+
+    def set_params(self, **params):
+        for key, value in params.items():
+            setattr(self, key, value)
+        return self
+
+    def fit(self, X, y=None):
+        self.knn_index_, self.index_path = KnnIndex.build_or_load(
+            np.asarray(X), self.index_dir, backend=self.backend, n_neighbors=self.n_neighbors,
+            metric=self.metric, random_state=self.random_state)
+        return self
+
+    def transform(self, X):
+        return knn_graph(*self.knn_index_.query(np.asarray(X), self.n_neighbors))
+
+    def fit_transform(self, X, y=None):
+        return knn_graph(*self.fit(X).knn_index_.knn())
+
+
+def neighbors_transformer(backend, n_neighbors=15, index_dir=None, metric='euclidean'):
+    """Transformer for `sc.pp.neighbors`, or None to keep scanpy's own choice (`backend` None or 'scanpy')."""
+    if backend in (None, '', 'scanpy'):
+        return None
+    return NeighborsTransformer(backend=backend, n_neighbors=n_neighbors, metric=metric, index_dir=index_dir)
+
+
+def recall(indices, exact_indices):
+    """Mean fraction of the exact neighbors (excluding self) that an approximate graph found."""
+    hits = [len(np.intersect1d(a[1:], b[1:])) for a, b in zip(indices, exact_indices)]
+    return float(np.mean(hits) / max(exact_indices.shape[1] - 1, 1))
@@ -0,0 +1,225 @@
+"""
+Output policy for the h5ad files the pipelines write.
+
+`write_h5ad` replaces `adata.write()`: it applies one compression codec and
+chunk layout to every dataset and leaves out layers that can be recomputed
+(`scaled` is X standardized with var mean/std).  Settings come from the
+environment:
+
+    CELLPILOT_H5AD_CODEC          none | lzf (default) | gzip | blosc
+    CELLPILOT_H5AD_CHUNK_ROWS     rows per chunk of 2-d arrays (default: h5py's choice)
+    CELLPILOT_H5AD_CHUNK_VALUES   values per chunk of 1-d arrays, e.g. sparse data
+    CELLPILOT_DROP_LAYERS         comma-separated layers to leave out (default: scaled)
+    CELLPILOT_ANNOTATION_DELTAS   1 to write annotations as delta files (default 0: full files)
+    CELLPILOT_OUTPUT_FORMAT       h5ad (default) or both, to also emit a Zarr store (see store.py)
+
+`blosc` (zstd with byte shuffle) needs the optional `hdf5plugin` package,
+also when reading; without it `lzf` is used.
+
+`write_delta` stores only obs and the uns entries added since the parent
+was written, plus a reference to the parent h5ad (its path relative to the
+delta, size, mtime and content hash; the content is only hashed again when
+the mtime differs).  The result is itself a valid h5ad with zero
+genes; `read_h5ad` overlays it on the parent, after checking that the parent
+is unchanged, and `read_obs`-style readers can open it directly.  Readers
+outside the app (`sc.read_h5ad`, downloads) see no expression in a delta,
+so deltas are opt-in.
+"""
+import os
+import tempfile
+
+import anndata as ad
+import numpy as np
+import scipy.sparse
+
+from .store import append_obs, is_zarr, output_format, read_zarr, sibling_store, write_zarr
+
+CODECS = ('none', 'lzf', 'gzip', 'blosc')
+DELTA_KEY = 'cellpilot_delta'
+POLICY_KEY = 'cellpilot_output'
+
+
+def codec():
+    return os.environ.get('CELLPILOT_H5AD_CODEC', 'lzf')
+
+
+def drop_layers():
+    return [l.strip() for l in os.environ.get('CELLPILOT_DROP_LAYERS', 'scaled').split(',') if l.strip()]
+
+
+def deltas_enabled():
+    return os.environ.get('CELLPILOT_ANNOTATION_DELTAS', '0') not in ('0', 'false', 'False', '')
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def codec_kwargs(name=None):
+    """h5py dataset keyword arguments for a codec name."""
+    name = name or codec()
+    if name not in CODECS:
+        raise ValueError(f"Unknown h5ad codec {name!r}. Available: {CODECS}")
+    if name == 'none':
+        return {}
+    if name == 'lzf':
+        return {'compression': 'lzf'}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4}
+    try:
+        import hdf5plugin
+    except ImportError:
+        print("hdf5plugin is not installed; writing with lzf instead of blosc")
+        return {'compression': 'lzf'}
+    # zstd at level 1 writes faster than lzf and compresses better
+    return {'compression': hdf5plugin.Blosc(cname='zstd', clevel=1, shuffle=hdf5plugin.Blosc.SHUFFLE)}
+
+
+def _dataset_kwargs(elem, iospec, dataset_kwargs, chunk_rows, chunk_values):
+    """
+    Per-dataset keyword arguments: chunk shapes for numeric arrays (maxshape
+    lets a chunk be larger than a small array), and lzf instead of blosc for
+    variable-length strings, which the blosc filter cannot handle.
+    """
+    if iospec.encoding_type == 'string-array' and not isinstance(dataset_kwargs.get('compression', ''), str):
+        return dict(dataset_kwargs, compression='lzf')
+    if isinstance(elem, np.ndarray) and elem.ndim == 2 and chunk_rows:
+        return dict(dataset_kwargs, chunks=(chunk_rows, max(elem.shape[1], 1)), maxshape=(None, elem.shape[1]))
+    is_1d = scipy.sparse.issparse(elem) or (isinstance(elem, np.ndarray) and elem.ndim == 1)
+    if is_1d and chunk_values and getattr(elem, 'dtype', None) is not None and elem.dtype.kind in 'biuf':
+        return dict(dataset_kwargs, chunks=(chunk_values,), maxshape=(None,))
+    return dataset_kwargs
+
+
+def write_h5ad(adata, path, codec_name=None, chunk_rows=None, chunk_values=None, drop=None):
+    """
+    Write `adata` to `path` under the output policy and return `path`.
+
+    Dropped layers are recorded in `uns['cellpilot_output']`, so readers
+    know they were left out on purpose.
+    """
+    from anndata.experimental import write_dispatched
+    import h5py
+
+    drop = drop_layers() if drop is None else drop
+    dropped = [l for l in drop if l in adata.layers]
+    chunk_rows = chunk_rows or _env_int('CELLPILOT_H5AD_CHUNK_ROWS')
+    chunk_values = chunk_values or _env_int('CELLPILOT_H5AD_CHUNK_VALUES')
+    dataset_kwargs = codec_kwargs(codec_name)
+
+    # a shallow copy: layers and uns change, matrices are shared
+    out = ad.AnnData(X=adata.X, obs=adata.obs, var=adata.var, uns=dict(adata.uns),
+                     obsm=dict(adata.obsm), varm=dict(adata.varm), obsp=dict(adata.obsp),
+                     layers={k: v for k, v in adata.layers.items() if k not in dropped})
+    if adata.raw is not None:
+        out.raw = ad.AnnData(X=adata.raw.X, var=adata.raw.var, varm=dict(adata.raw.varm))
+    out.uns[POLICY_KEY] = {'codec': codec_name or codec(), 'dropped_layers': dropped}
+    out.strings_to_categoricals()
+    if is_zarr(path):
+        return write_zarr(out, path)
+
+    def callback(func, store, key, elem, dataset_kwargs, iospec):
+        func(store, key, elem, dataset_kwargs=_dataset_kwargs(elem, iospec, dataset_kwargs, chunk_rows, chunk_values))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f'{os.path.basename(path)}.',
+                               suffix='.tmp')
+    os.close(fd)
+    try:
+        with h5py.File(tmp, 'w') as f:
+            write_dispatched(f, '/', out, callback=callback, dataset_kwargs=dataset_kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if output_format() == 'both':
+        write_zarr(out, sibling_store(path))
+    return path
+
+
+def _identity(parent, path):
+    """Reference to `parent` from a delta at `path`: relative path, size, mtime and content hash."""
+    from .ingest import source_hash
+    st = os.stat(parent)
+    return {'parent': os.path.relpath(os.path.abspath(parent), os.path.dirname(os.path.abspath(path))),
+            'parent_size': int(st.st_size), 'parent_mtime_ns': str(st.st_mtime_ns), 'parent_hash': source_hash(parent)}
+
+
+def _parent_changed(parent, info):
+    """Whether `parent` differs from the reference `info`; the content is hashed only when the mtime moved."""
+    from .ingest import source_hash
+    st = os.stat(parent)
+    if int(st.st_size) != int(info['parent_size']):
+        return True
+    if str(st.st_mtime_ns) == str(info.get('parent_mtime_ns')):
+        return False
+    return source_hash(parent) != info.get('parent_hash')
+
+
+def write_delta(adata, path, parent, parent_uns_keys=()):
+    """
+    Write the obs of `adata` and the uns entries not in `parent_uns_keys` as
+    a delta on `parent`, which must hold the same cells in the same order.
+    """
+    delta = ad.AnnData(X=scipy.sparse.csr_matrix((adata.n_obs, 0), dtype=np.float32), obs=adata.obs.copy(),
+                       uns={k: v for k, v in adata.uns.items() if k not in set(parent_uns_keys)})
+    delta.uns[DELTA_KEY] = _identity(parent, path)
+    delta.write_h5ad(path)
+    return path
+
+
+def delta_parent(path):
+    """Parent path of a delta file, or None for an ordinary h5ad."""
+    import h5py
+    with h5py.File(path, 'r') as f:
+        if f'uns/{DELTA_KEY}' not in f:
+            return None
+        value = f[f'uns/{DELTA_KEY}']['parent'][()]
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    # stored relative to the delta's directory (absolute paths are kept as they are)
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), value))
+
+
+def read_h5ad(path, backed=None):
+    """
+    `anndata.read_h5ad` that resolves delta files: the parent is read and
+    the delta's obs and uns are laid over it.  Zarr stores are read in memory.
+    """
+    if is_zarr(path):
+        return read_zarr(path)
+    parent_path = delta_parent(path) if path.endswith('.h5ad') else None
+    if parent_path is None:
+        return ad.read_h5ad(path, backed=backed)
+    delta = ad.read_h5ad(path)
+    info = delta.uns.pop(DELTA_KEY)
+    if not os.path.exists(parent_path):
+        raise FileNotFoundError(f"Parent of annotation file {path} not found: {parent_path}")
+    if _parent_changed(parent_path, info):
+        raise ValueError(f"{parent_path} changed after the annotations in {path} were written")
+    adata = read_h5ad(parent_path, backed=backed)
+    if adata.n_obs != delta.n_obs or not (adata.obs_names == delta.obs_names).all():
+        raise ValueError(f"Annotation file {path} does not match the cells of {parent_path}")
+    adata.obs = delta.obs
+    adata.uns.update(delta.uns)
+    return adata
+
+
+def write_annotations(adata, path, parent=None, parent_uns_keys=()):
+    """
+    Annotated output: a delta on `parent` when deltas are enabled and the
+    parent holds the same cells, otherwise a full file under the policy.
+    A Zarr store next to the parent gets the new obs and uns in place.
+    """
+    if parent is not None and deltas_enabled() and os.path.exists(parent):
+        parent_obs = ad.read_h5ad(parent, backed='r')
+        try:
+            same_cells = parent_obs.n_obs == adata.n_obs and (parent_obs.obs_names == adata.obs_names).all()
+        finally:
+            parent_obs.file.close()
+        if same_cells:
+            if os.path.isdir(sibling_store(parent)):
+                append_obs(sibling_store(parent), adata.obs,
+                           {k: v for k, v in adata.uns.items() if k not in set(parent_uns_keys)})
+            return write_delta(adata, path, parent, parent_uns_keys)
+    return write_h5ad(adata, path)
@@ -0,0 +1,118 @@
+"""
+PCA of standardized (zero-mean, unit-variance) expression without building
+the dense scaled matrix.
+
+`ov.pp.scale` writes a dense cells x HVGs `scaled` layer and `ov.pp.pca`
+decomposes it.  Here the standardization is folded into a LinearOperator
+over the sparse matrix instead:
+
+    Z v   = X (v / std) - (mean / std) . v
+    Z^T u = (X^T u - mean * sum(u)) / std
+
+so the decomposition only ever touches X and a few dense cells x k blocks.
+The difference to the dense path is that values are not clipped at
+`max_value`, since clipping cannot be expressed as a linear map.
+"""
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def mean_std(X):
+    """Per-gene mean and standard deviation (ddof=1, as in scanpy's scale) of a sparse or dense matrix."""
+    n = X.shape[0]
+    mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+    if scipy.sparse.issparse(X):
+        sq_mean = np.asarray(X.multiply(X).mean(axis=0), dtype=np.float64).ravel()
+    else:
+        sq_mean = np.asarray((X.astype(np.float64) ** 2).mean(axis=0)).ravel()
+    var = np.maximum(sq_mean - mean ** 2, 0) * (n / max(n - 1, 1))
+    return mean, np.sqrt(var)
+
+
+def standardized_operator(X, mean, std):
+    """LinearOperator for (X - mean) / std that never densifies X; `std` must be non-zero."""
+    inv_std = 1.0 / std
+    shift = mean * inv_std
+
+    def matmat(V):
+        V = np.asarray(V, dtype=np.float64)
+        return X @ (V * inv_std[:, None]) - shift @ V
+
+    def rmatmat(U):
+        U = np.asarray(U, dtype=np.float64)
+        return (X.T @ U - np.outer(mean, U.sum(axis=0))) * inv_std[:, None]
+
+    return scipy.sparse.linalg.LinearOperator(
+        shape=X.shape, dtype=np.float64,
+        matvec=lambda v: matmat(np.reshape(v, (-1, 1))).ravel(),
+        rmatvec=lambda u: rmatmat(np.reshape(u, (-1, 1))).ravel(),
+        matmat=matmat, rmatmat=rmatmat,
+    )
+
+
+def _randomized_svd(op, k, n_oversamples=10, n_iter=7, random_state=0):
+    """Halko et al. randomized SVD using only products with `op` and its transpose."""
+    rng = np.random.default_rng(random_state)
+    Q = op.matmat(rng.standard_normal((op.shape[1], k + n_oversamples)))
+    for _ in range(n_iter):
+        Q, _ = scipy.linalg.qr(Q, mode='economic')
+        Q, _ = scipy.linalg.qr(op.rmatmat(Q), mode='economic')
+        Q = op.matmat(Q)
+    Q, _ = scipy.linalg.qr(Q, mode='economic')
+    B = op.rmatmat(Q).T
+    Ub, S, Vt = scipy.linalg.svd(B, full_matrices=False)
+    return (Q @ Ub)[:, :k], S[:k], Vt[:k]
+
+
+def _svd(op, k, solver, random_state):
+    if solver == 'randomized':
+        return _randomized_svd(op, k, random_state=random_state)
+    v0 = np.random.default_rng(random_state).uniform(-1, 1, min(op.shape))
+    U, S, Vt = scipy.sparse.linalg.svds(op, k=k, solver='arpack', v0=v0)
+    order = np.argsort(S)[::-1]
+    return U[:, order], S[order], Vt[order]
+
+
+def scaled_pca(adata, n_pcs=50, key='scaled|original', solver='arpack', random_state=0):
+    """
+    PCA of the standardized `adata.X`, stored under the same keys as
+    `ov.pp.pca(adata, layer='scaled')`:
+
+    * `obsm['<key>|X_pca']`            cell coordinates (float32)
+    * `varm['<key>|pca_loadings']`     gene loadings
+    * `uns['<key>|pca_var_ratios']`    explained variance ratio
+    * `uns['<key>|cum_sum_eigenvalues']`
+
+    The per-gene `mean` and `std` used for standardization are kept in
+    `adata.var`, so new cells can be projected onto the same components.
+    """
+    X = adata.X
+    if scipy.sparse.issparse(X):
+        X = scipy.sparse.csr_matrix(X, dtype=np.float32)
+    else:
+        X = np.asarray(X, dtype=np.float32)
+    n_pcs = min(n_pcs, min(X.shape) - 1)
+    mean, std = mean_std(X)
+    constant = std == 0
+    std[constant] = 1
+
+    U, S, Vt = _svd(standardized_operator(X, mean, std), n_pcs, solver, random_state)
+    # deterministic signs: largest loading of each component is positive
+    signs = np.sign(Vt[np.arange(n_pcs), np.abs(Vt).argmax(axis=1)])
+    signs[signs == 0] = 1
+    U *= signs
+    Vt *= signs[:, None]
+
+    # every non-constant gene has variance exactly 1 after scaling
+    total_var = max(np.count_nonzero(~constant), 1)
+    var_ratio = S ** 2 / max(X.shape[0] - 1, 1) / total_var
+
+    adata.obsm[f'{key}|X_pca'] = (U * S).astype(np.float32)
+    adata.varm[f'{key}|pca_loadings'] = Vt.T.astype(np.float32)
+    adata.uns[f'{key}|pca_var_ratios'] = var_ratio
+    adata.uns[f'{key}|cum_sum_eigenvalues'] = np.cumsum(var_ratio)
+    adata.var['mean'] = mean
+    adata.var['std'] = std
+    return adata
@@ -0,0 +1,178 @@
+"""
+Per-group expression statistics ("pseudobulk") shared by the pipelines.
+
+`pseudobulk` reduces an expression matrix to a groups x genes table of sums,
+means, counts of expressing cells (value above a threshold) and fractions
+expressing, with one sparse group-indicator product per statistic instead
+of one boolean slice per group or gene.  Dot plots (mean and fraction above
+0), marker expression counts (cells above `min_expression`) and CaDRReS
+cluster profiles (means) all read the same result.
+
+Results are cached per (matrix, groupby column, grouping): in memory for
+AnnData objects, for as long as their matrix is alive and its values are
+unchanged (a CRC32 of the stored values is part of the key, so in-place
+normalization or scaling is not served stale aggregates), and per file
+identity for `read_pseudobulk`.  Counts for a threshold not computed yet are added to
+the cached result.
+"""
+import os
+import weakref
+import zlib
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+# id(matrix) -> {grouping key: Pseudobulk}; an entry is dropped when its matrix is
+# (matrices are unhashable, so no WeakKeyDictionary)
+_cache = {}
+
+
+class Pseudobulk:
+    """Groups x genes aggregates of one grouping of the cells."""
+
+    def __init__(self, groups, genes, sizes, sums):
+        self.groups = pd.Index(groups)
+        self.genes = pd.Index(genes)
+        self.sizes = sizes
+        self.sums = sums
+        self.counts = {}
+
+    def _frame(self, values, genes):
+        frame = pd.DataFrame(values, index=self.groups, columns=self.genes)
+        return frame if genes is None else frame[list(genes)]
+
+    def sum(self, genes=None):
+        return self._frame(self.sums, genes)
+
+    def mean(self, genes=None):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._frame(np.nan_to_num(self.sums / self.sizes[:, None]), genes)
+
+    def count(self, threshold=0.0, genes=None):
+        """Cells per group with a value above `threshold`."""
+        return self._frame(self.counts[float(threshold)], genes)
+
+    def fraction(self, threshold=0.0, genes=None):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._frame(np.nan_to_num(self.counts[float(threshold)] / self.sizes[:, None]), genes)
+
+    def size(self):
+        return pd.Series(self.sizes, index=self.groups)
+
+
+def _indicator(codes, n_groups, dtype):
+    """groups x cells 0/1 matrix; cells without a group (code -1) are left out."""
+    cells = np.flatnonzero(codes >= 0)
+    return scipy.sparse.csr_matrix((np.ones(len(cells), dtype=dtype), (codes[cells], cells)),
+                                   shape=(n_groups, len(codes)))
+
+
+def _dense(product):
+    return np.asarray(product.toarray() if scipy.sparse.issparse(product) else product, dtype=np.float64)
+
+
+def _above(X, threshold, indicator, sizes):
+    """Cells per group with a value above `threshold`, stored zeros included."""
+    dtype = indicator.dtype
+    if not scipy.sparse.issparse(X):
+        return _dense(indicator @ (np.asarray(X) > threshold).astype(dtype))
+    X = X.tocsr() if not isinstance(X, (scipy.sparse.csr_matrix, scipy.sparse.csc_matrix)) else X
+    if threshold >= 0:
+        above = X.copy()
+        above.data = (above.data > threshold).astype(dtype)
+        return _dense(indicator @ above)
+    # every implicit zero is above a negative threshold: count the stored values at or below it
+    below = X.copy()
+    below.data = (below.data <= threshold).astype(dtype)
+    return sizes[:, None] - _dense(indicator @ below)
+
+
+def _matrix_cache(X):
+    cached = _cache.get(id(X))
+    if cached is None:
+        try:
+            weakref.finalize(X, _cache.pop, id(X), None)
+        except TypeError:
+            return {}  # matrices that cannot be weakly referenced are not cached
+        cached = _cache[id(X)] = {}
+    return cached
+
+
+def _checksum(X):
+    """CRC32 of the values (and sparse structure) of X."""
+    arrays = (X.data, X.indices, X.indptr) if scipy.sparse.issparse(X) else (np.asarray(X),)
+    crc = 0
+    for array in arrays:
+        crc = zlib.crc32(np.ascontiguousarray(array), crc)
+    return crc
+
+
+def _grouping(adata, groupby):
+    if groupby not in adata.obs.columns:
+        raise ValueError(f"'{groupby}' column not found in adata.obs")
+    groups = adata.obs[groupby].astype('category')
+    codes = groups.cat.codes.to_numpy()
+    categories = [str(c) for c in groups.cat.categories]
+    return codes, categories
+
+
+def pseudobulk(adata, groupby, use_raw=False, thresholds=(0.0,)):
+    """
+    Aggregates of `adata.X` (`adata.raw.X` with `use_raw` when there is a
+    raw) per category of `adata.obs[groupby]`, with expressing-cell counts
+    for every threshold of `thresholds`.
+    """
+    source = adata.raw if use_raw and adata.raw is not None else adata
+    X = source.X
+    codes, categories = _grouping(adata, groupby)
+    checksum = _checksum(X)
+    key = (groupby, tuple(categories), pd.util.hash_array(codes).sum(), X.shape, getattr(X, 'nnz', None), checksum)
+    cached = _matrix_cache(X)
+    for stale in [k for k in cached if k[-1] != checksum]:
+        del cached[stale]  # X was changed in place
+    result = cached.get(key)
+    missing = [float(t) for t in thresholds if result is None or float(t) not in result.counts]
+    if result is not None and not missing:
+        return result
+    # float32 matrices are aggregated in float32, as a float64 indicator would upcast a copy of X
+    indicator = _indicator(codes, len(categories), np.float64 if X.dtype == np.float64 else np.float32)
+    if result is None:
+        sizes = np.bincount(codes[codes >= 0], minlength=len(categories)).astype(np.float64)
+        result = Pseudobulk(categories, source.var_names, sizes, _dense(indicator @ X))
+        cached[key] = result
+    for threshold in missing:
+        result.counts[threshold] = _above(X, threshold, indicator, result.sizes)
+    return result
+
+
+@lru_cache(maxsize=16)
+def _read_pseudobulk(identity, path, groupby, use_raw, thresholds):
+    from .output import read_h5ad
+    return pseudobulk(read_h5ad(path), groupby, use_raw=use_raw, thresholds=thresholds)
+
+
+def read_pseudobulk(path, groupby, use_raw=False, thresholds=(0.0,)):
+    """`pseudobulk` of an h5ad file or Zarr store, cached per file identity (real path, size, mtime)."""
+    st = os.stat(path)
+    identity = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    return _read_pseudobulk(identity, path, groupby, bool(use_raw), tuple(float(t) for t in thresholds))
+
+
+def dotplot_frames(result, var_names, expression_cutoff=0.0, standard_scale='var'):
+    """
+    `dot_color_df` and `dot_size_df` for `sc.pl.dotplot` from a `pseudobulk`
+    result: mean expression (scaled as `standard_scale` does, which scanpy
+    skips for given frames) and fraction of cells above `expression_cutoff`.
+    """
+    # duplicated genes stay, as in the frames scanpy computes itself
+    genes = list(var_names)
+    color = result.mean(genes)
+    if standard_scale == 'group':
+        color = color.sub(color.min(1), axis=0)
+        color = color.div(color.max(1), axis=0).fillna(0)
+    elif standard_scale == 'var':
+        color -= color.min(0)
+        color = (color / color.max(0)).fillna(0)
+    return color, result.fraction(expression_cutoff, genes)
@@ -0,0 +1,182 @@
+"""
+SCSA cluster annotation on an in-memory marker index.
+
+Does what `ov.single.pySCSA` does for the pipeline (`cell_anno` on a scanpy
+ranking with gene symbols, all tissues, human markers, then `cell_auto_anno`
+and `cell_anno_print`) without its temp CSV files and per-cluster pandas
+work.  The marker tables are read once per process and turned into one
+sparse cell type x gene matrix per (target, celltype); the Wilcoxon ranking
+is computed once and shared by all targets.  A cluster is scored against a
+database with one sparse product of that matrix with the gene x cluster
+fold-change matrix, so labels and the annotation detail text are the ones
+SCSA produces.
+
+The database (`db/pySCSA_2024_v1_plus.db`) is a gzip stream of pickles:
+GO terms, human and mouse GO maps, CellMarker, CancerSEA, CancerSEA names,
+the two Ensembl maps and, in `plus` builds, PanglaoDB.  Only the marker
+tables are kept; SCSA's GO enrichment of the unmatched genes is not part of
+the annotation and is skipped.
+"""
+import gzip
+import os
+import pickle
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+DB_PATH = 'db/pySCSA_2024_v1_plus.db'
+TARGETS = ('cellmarker', 'panglaodb', 'cancersea')
+CELLMARKER_TYPES = {'normal': 'Normal cell', 'cancer': 'Cancer cell'}
+FOLDCHANGE = 1.5
+PVALUE = 0.01
+
+
+@lru_cache(maxsize=2)
+def _load_markers(db_path, mtime):
+    """Marker tables of an SCSA database, cached per (file, mtime)."""
+    with gzip.open(db_path, 'rb') as f:
+        tables = [pickle.load(f) for _ in range(8)]
+        panglaodb = pickle.load(f) if 'plus' in db_path else tables[4]
+    return {'cellmarker': tables[3], 'cancersea': tables[4], 'panglaodb': panglaodb}
+
+
+def _printable(value):
+    return ''.join(c for c in value if c.isprintable()) if isinstance(value, str) else value
+
+
+@lru_cache(maxsize=8)
+def _marker_matrix(db_path, mtime, target, celltype):
+    """Cell types, genes and the cell type x gene matrix of log2(summed marker weight + 0.05)."""
+    markers = _load_markers(db_path, mtime)[target]
+    if target == 'cellmarker':
+        markers = markers[(markers['cellType'] == CELLMARKER_TYPES[celltype])
+                          & (markers['speciesType'] == 'Human')]
+        table = pd.DataFrame({'cell': markers['cellName'], 'gene': markers['gene'], 'weight': markers['weight']})
+    else:
+        table = pd.DataFrame({'cell': markers['name'], 'gene': markers['GeneName'], 'weight': 1})
+    weights = table.groupby(['cell', 'gene'])['weight'].sum()
+    cell_types = pd.Index(sorted(set(weights.index.get_level_values('cell'))))
+    genes = pd.Index(sorted(set(weights.index.get_level_values('gene'))))
+    matrix = scipy.sparse.csr_matrix(
+        (np.log2(weights.values.astype(np.float64) + 0.05),
+         (cell_types.get_indexer(weights.index.get_level_values('cell')),
+          genes.get_indexer(weights.index.get_level_values('gene')))),
+        shape=(len(cell_types), len(genes)))
+    # SCSA writes its result table without non-printable characters
+    return np.array([_printable(c) for c in cell_types], dtype=object), genes, matrix
+
+
+def marker_matrix(target, celltype='normal', db_path=DB_PATH):
+    """
+    Indexed markers of one target database.
+
+    Returns:
+    --------
+    cell_types : np.ndarray
+        Sorted cell type names (rows)
+    genes : pd.Index
+        Sorted marker gene symbols (columns)
+    matrix : scipy.sparse.csr_matrix
+        log2 of the summed marker weight plus 0.05 per cell type and gene
+    """
+    if target not in TARGETS:
+        raise ValueError(f"Unknown SCSA target {target!r}. Available: {TARGETS}")
+    celltype = celltype.lower()
+    if celltype not in CELLMARKER_TYPES:
+        raise ValueError(f"Unknown SCSA celltype {celltype!r}. Available: {tuple(CELLMARKER_TYPES)}")
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"SCSA database not found: {db_path}")
+    # celltype only selects CellMarker rows; the other targets share one matrix
+    return _marker_matrix(db_path, os.path.getmtime(db_path), target,
+                          celltype if target == 'cellmarker' else 'normal')
+
+
+def rank_clusters(adata, clustertype='leiden'):
+    """
+    Wilcoxon ranking of the `clustertype` groups as SCSA runs it, as gene x
+    cluster matrices.  Leaves `uns['rank_genes_groups']` set like SCSA does.
+    """
+    import scanpy as sc
+
+    sc.tl.rank_genes_groups(adata, clustertype, method='wilcoxon')
+    result = adata.uns['rank_genes_groups']
+    # SCSA walks the clusters in string order
+    clusters = sorted(result['names'].dtype.names)
+    genes = pd.Index(result['names'][clusters[0]])
+    lfc = np.full((len(genes), len(clusters)), np.nan)
+    pvals = np.full((len(genes), len(clusters)), np.nan)
+    for j, group in enumerate(clusters):
+        rows = genes.get_indexer(result['names'][group])
+        lfc[rows, j] = result['logfoldchanges'][group]
+        pvals[rows, j] = result['pvals'][group]
+    return {'clusters': clusters, 'genes': genes, 'logfoldchanges': lfc, 'pvals': pvals}
+
+
+def score_clusters(ranking, target, celltype='normal', foldchange=FOLDCHANGE, pvalue=PVALUE, db_path=DB_PATH):
+    """
+    SCSA result table (Cell Type, Z-score, Cluster) for a `rank_clusters`
+    ranking: per cluster, the cell types with a marker among the genes with
+    log fold change >= `foldchange` and p-value <= `pvalue`, best first.
+
+    A cell type scores the sum of its marker weights times the gene fold
+    changes, scaled by the mean fold change of the matched genes; the
+    absolute scores are z-scored within the cluster.
+    """
+    cell_types, marker_genes, weights = marker_matrix(target, celltype, db_path)
+    rows = ranking['genes'].get_indexer(marker_genes)
+    found = rows >= 0
+    weights = weights[:, found]
+    lfc = ranking['logfoldchanges'][rows[found]]
+    with np.errstate(invalid='ignore'):
+        de = (lfc >= foldchange) & (ranking['pvals'][rows[found]] <= pvalue)
+    lfc = np.where(de, lfc, 0.0)
+    n_matched = de.sum(axis=0)
+    mean_lfc = np.divide(lfc.sum(axis=0), n_matched, out=np.zeros(lfc.shape[1]), where=n_matched > 0)
+
+    scores = np.asarray(weights @ (lfc * mean_lfc))
+    hits = np.asarray(weights.astype(bool).astype(np.float64) @ de.astype(np.float64))
+
+    frames = []
+    for j, cluster in enumerate(ranking['clusters']):
+        matched = np.flatnonzero(hits[:, j])
+        if not len(matched):
+            continue
+        out = pd.DataFrame({'Z-score': scores[matched, j]}, index=cell_types[matched])
+        out.sort_values(['Z-score'], inplace=True, ascending=False)
+        out['Z-score'] = abs(out['Z-score'])
+        if out.shape[0] > 1:
+            out['Z-score'] = (out['Z-score'] - np.mean(out['Z-score'])) / np.std(out['Z-score'], ddof=1)
+        result = pd.DataFrame({'Cell Type': out.index, 'Z-score': out['Z-score'].values})
+        result = result.sort_values(by='Z-score', ascending=False)
+        result['Cluster'] = cluster
+        frames.append(result)
+    if not frames:
+        return pd.DataFrame(columns=['Cell Type', 'Z-score', 'Cluster'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def cluster_labels(result, clusters):
+    """Best cell type per cluster, 'Unknown' for clusters without markers (`cell_auto_anno`)."""
+    best = result.drop_duplicates('Cluster').set_index('Cluster')['Cell Type']
+    return {str(c): best.get(c, 'Unknown') for c in clusters}
+
+
+def _cluster_order(cluster):
+    return (0, int(cluster), '') if str(cluster).isdigit() else (1, 0, str(cluster))
+
+
+def annotation_details(result):
+    """The two best cell types per cluster, in the text of `cell_anno_print`."""
+    lines = []
+    for cluster in sorted(set(result['Cluster']), key=_cluster_order):
+        top = result.loc[result['Cluster'] == cluster].iloc[:2]
+        if len(top) == 1 or top.iloc[0]['Z-score'] > top.iloc[1]['Z-score'] * 2:
+            lines.append('Nice:Cluster:{}\tCell_type:{}\tZ-score:{}'.format(
+                cluster, top.iloc[0]['Cell Type'], np.around(top.iloc[0]['Z-score'], 3)))
+        else:
+            lines.append('Cluster:{}\tCell_type:{}\tZ-score:{}'.format(
+                cluster, '|'.join(top['Cell Type'].values.tolist()),
+                '|'.join(np.around(top['Z-score'].values, 3).astype(str).tolist())))
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -0,0 +1,167 @@
+"""
+Sketch-based preprocessing for very large inputs.
+
+Rather than running QC, scrublet, Leiden, UMAP and SCSA on every cell, a
+representative subset (the sketch) goes through the full pipeline, and its
+results are carried back to all cells by nearest neighbors in a PCA space
+shared by both:
+
+1. `sketch_space` normalizes all cells (shiftlog), picks the most dispersed
+   genes and computes an implicit-scaling PCA of them,
+2. `geometric_sketch` (Hie et al., 2019) covers that space with equal-sized
+   boxes and samples boxes uniformly, so rare populations keep their share;
+   `leverage_sketch` samples cells in proportion to their leverage scores,
+3. `propagate` transfers obs labels (kNN vote) and obsm embeddings (weighted
+   mean of neighbor coordinates) from the sketch to every cell.
+"""
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from .incremental import membership_weights, shiftlog, transfer_labels
+from .neighbors import KnnIndex
+from .pca import mean_std, scaled_pca
+
+SKETCH_METHODS = ('geometric', 'leverage')
+SKETCH_REP = 'X_sketch_pca'
+
+
+def normalized_dispersion(X, n_bins=20):
+    """Seurat-style HVG score: log dispersion z-scored within bins of genes with similar mean."""
+    mean, std = mean_std(X)
+    expressed = mean > 0
+    dispersion = np.log(np.where(expressed, std ** 2 / np.maximum(mean, 1e-12), 1))
+    bins = pd.qcut(mean[expressed], n_bins, labels=False, duplicates='drop')
+    grouped = pd.Series(dispersion[expressed]).groupby(bins)
+    z = (dispersion[expressed] - grouped.transform('mean').values) / grouped.transform('std').fillna(1).replace(0, 1).values
+    score = np.full(len(mean), -np.inf)
+    score[expressed] = z
+    return score
+
+
+def sketch_space(adata, n_hvgs=2000, n_pcs=50, random_state=0):
+    """
+    PCA coordinates of every cell, computed without densifying: shiftlog
+    normalization, the `n_hvgs` genes with the highest normalized
+    dispersion, then implicit-scaling PCA.  Returns (coordinates, singular values).
+    """
+    X = shiftlog(adata.X)
+    genes = np.sort(np.argsort(normalized_dispersion(X))[::-1][:min(n_hvgs, X.shape[1])])
+    subset = ad.AnnData(X=X[:, genes])
+    scaled_pca(subset, n_pcs=n_pcs, solver='randomized', random_state=random_state)
+    coords = subset.obsm['scaled|original|X_pca']
+    return coords, np.linalg.norm(coords, axis=0)
+
+
+def geometric_sketch(coords, size, random_state=0, n_dims=10):
+    """
+    Indices of `size` cells sampled uniformly over occupied grid boxes.
+
+    The box side is found by bisection so that at least `size` boxes are
+    occupied; boxes are then drawn without replacement and one cell is taken
+    from each.  Only the first `n_dims` components span the grid, since in
+    many dimensions nearly every cell occupies a box of its own.
+    """
+    n = coords.shape[0]
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    X = np.asarray(coords[:, :n_dims] if n_dims else coords, dtype=np.float64)
+    X = X - X.min(axis=0)
+    X /= max(X.max(), 1e-12)
+
+    # hash each cell's grid coordinates to one integer, so that finding the
+    # occupied boxes is a 1-d unique
+    multipliers = rng.integers(1, 2**61, X.shape[1], dtype=np.int64) | 1
+
+    def boxes(side):
+        keys = np.floor(X / side).astype(np.int64)
+        with np.errstate(over='ignore'):
+            hashed = keys @ multipliers
+        _, box_of_cell = np.unique(hashed, return_inverse=True)
+        return box_of_cell.ravel()
+
+    low, high = 1e-6, 1.0
+    box_of_cell = boxes(high)
+    for _ in range(50):
+        side = (low + high) / 2
+        candidate = boxes(side)
+        n_boxes = candidate.max() + 1
+        if n_boxes >= size:
+            low, box_of_cell = side, candidate
+            if n_boxes <= size * 1.05:
+                break
+        else:
+            high = side
+    n_boxes = box_of_cell.max() + 1
+    if n_boxes < size:
+        box_of_cell = np.arange(n)
+        n_boxes = n
+
+    chosen_boxes = rng.choice(n_boxes, size, replace=False)
+    order = np.argsort(box_of_cell, kind='stable')
+    starts = np.searchsorted(box_of_cell[order], np.arange(n_boxes + 1))
+    counts = np.diff(starts)
+    pick = starts[chosen_boxes] + (rng.random(size) * counts[chosen_boxes]).astype(np.int64)
+    return np.sort(order[pick])
+
+
+def leverage_sketch(coords, size, random_state=0, uniform_mix=0.5):
+    """
+    Indices of `size` cells drawn without replacement with probability
+    proportional to their leverage scores in the PCA space, mixed with a
+    uniform distribution so that dense populations stay represented.
+    """
+    n = coords.shape[0]
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(random_state)
+    U = coords / np.maximum(np.linalg.norm(coords, axis=0), 1e-12)
+    leverage = np.einsum('ij,ij->i', U, U)
+    p = (1 - uniform_mix) * leverage / leverage.sum() + uniform_mix / n
+    return np.sort(rng.choice(n, size, replace=False, p=p / p.sum()))
+
+
+def sketch_indices(coords, size, method='geometric', random_state=0):
+    if method == 'geometric':
+        return geometric_sketch(coords, size, random_state=random_state)
+    if method == 'leverage':
+        return leverage_sketch(coords, size, random_state=random_state)
+    raise ValueError(f"Unknown sketch method {method!r}. Available: {SKETCH_METHODS}")
+
+
+def propagate(full, sketch, columns, embeddings, n_neighbors=15, rep=SKETCH_REP):
+    """
+    Copy obs `columns` and obsm `embeddings` from the processed `sketch` to
+    every cell of `full` by nearest neighbors in `full.obsm[rep]`.  Sketch cells
+    matched by name keep their own values.  Returns the mean vote confidence
+    per column.
+    """
+    full_rep = np.asarray(full.obsm[rep])
+    # sketch cells are looked up in `full`, so `rep` need not survive preprocessing of the sketch
+    index = KnnIndex('hnsw', n_neighbors=n_neighbors).build(
+        full_rep[pd.Index(full.obs_names).get_indexer(sketch.obs_names)])
+    indices, distances = index.query(full_rep, n_neighbors)
+    weights = membership_weights(distances, n_neighbors)
+    normalized_weights = weights / weights.sum(axis=1, keepdims=True)
+    own = pd.Index(sketch.obs_names).get_indexer(full.obs_names)
+    in_sketch = own >= 0
+
+    confidence = {}
+    for column in columns:
+        if column not in sketch.obs:
+            continue
+        labels, score = transfer_labels(sketch.obs[column].values, indices, weights)
+        values = pd.Series(np.asarray(labels, dtype=object), index=full.obs_names)
+        values[in_sketch] = np.asarray(sketch.obs[column].values, dtype=object)[own[in_sketch]]
+        full.obs[column] = pd.Categorical(values, categories=pd.Categorical(sketch.obs[column]).categories)
+        confidence[column] = round(float(score[~in_sketch].mean()) if (~in_sketch).any() else 1.0, 4)
+    for key in embeddings:
+        if key not in sketch.obsm:
+            continue
+        coords = np.asarray(sketch.obsm[key])
+        placed = np.einsum('ij,ijk->ik', normalized_weights, coords[indices]).astype(coords.dtype)
+        placed[in_sketch] = coords[own[in_sketch]]
+        full.obsm[key] = placed
+    full.obs['in_sketch'] = in_sketch
+    return confidence
@@ -0,0 +1,160 @@
+"""
+Chunked Zarr directory stores next to the h5ad files.
+
+A `.zarr` store holds the same AnnData layout as an h5ad, but every chunk
+is a separate file, so chunks can be read and written from several threads
+and single elements can be replaced without touching the rest:
+
+* `write_zarr` writes a store with row-chunked dense arrays and fixed-size
+  chunks for the 1-d arrays of sparse matrices,
+* `read_zarr` reads obs, var, the other elements and the chunks of X
+  concurrently from a thread pool (the Blosc decompressor releases the GIL),
+* `read_obs_var` reads only the annotations, for summaries,
+* `append_obs` replaces obs (and adds uns entries) in place, leaving X,
+  layers and raw untouched.
+
+Stores are emitted when `CELLPILOT_OUTPUT_FORMAT` is `both` (h5ad and a
+sibling `.zarr`); `.zarr` inputs are accepted wherever an h5ad is.  Zarr is
+an optional dependency (zarr 2.x, as supported by anndata 0.10).
+"""
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import anndata as ad
+import numpy as np
+import scipy.sparse
+
+CHUNK_ROWS = 4096
+CHUNK_VALUES = 2**20
+ELEMENTS = ('obs', 'var', 'obsm', 'varm', 'obsp', 'varp', 'layers', 'uns', 'raw')
+
+
+def _zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Zarr stores need the optional 'zarr' package (zarr<3)")
+    return zarr
+
+
+def output_format():
+    return os.environ.get('CELLPILOT_OUTPUT_FORMAT', 'h5ad')
+
+
+def is_zarr(path):
+    return str(path).rstrip('/').endswith('.zarr')
+
+
+def sibling_store(h5ad_path):
+    """`<name>.zarr` next to `<name>.h5ad`."""
+    return os.path.splitext(h5ad_path)[0] + '.zarr'
+
+
+def _threads(threads=None):
+    return threads or min(8, os.cpu_count() or 1)
+
+
+def write_zarr(adata, path, chunk_rows=CHUNK_ROWS, chunk_values=CHUNK_VALUES):
+    """Write `adata` as a Zarr directory store, replacing an existing one atomically."""
+    zarr = _zarr()
+    from anndata.experimental import write_dispatched
+
+    adata.strings_to_categoricals()
+
+    def callback(func, store, key, elem, dataset_kwargs, iospec):
+        if isinstance(elem, np.ndarray) and elem.ndim == 2:
+            dataset_kwargs = dict(dataset_kwargs, chunks=(min(chunk_rows, max(elem.shape[0], 1)), elem.shape[1]))
+        elif scipy.sparse.issparse(elem) or (isinstance(elem, np.ndarray) and elem.ndim == 1):
+            dataset_kwargs = dict(dataset_kwargs, chunks=(chunk_values,))
+        func(store, key, elem, dataset_kwargs=dataset_kwargs)
+
+    target = os.path.abspath(path.rstrip('/'))
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(target), prefix=f'{os.path.basename(target)}.', suffix='.tmp')
+    try:
+        root = zarr.open_group(tmp, mode='w')
+        write_dispatched(root, '/', adata, callback=callback)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+
+def _read_array(array, pool):
+    """A zarr array read as chunk-aligned slices in parallel."""
+    n = array.shape[0]
+    step = array.chunks[0]
+    if n <= step:
+        return array[...]
+    out = np.empty(array.shape, dtype=array.dtype)
+
+    def read(start):
+        out[start:start + step] = array[start:start + step]
+
+    list(pool.map(read, range(0, n, step)))
+    return out
+
+
+def _read_matrix(group, pool):
+    zarr = _zarr()
+    if isinstance(group, zarr.Array):
+        return _read_array(group, pool)
+    encoding = group.attrs.get('encoding-type')
+    if encoding not in ('csr_matrix', 'csc_matrix'):
+        from anndata.experimental import read_elem
+        return read_elem(group)
+    data, indices, indptr = (_read_array(group[k], pool) for k in ('data', 'indices', 'indptr'))
+    cls = scipy.sparse.csr_matrix if encoding == 'csr_matrix' else scipy.sparse.csc_matrix
+    return cls((data, indices, indptr), shape=tuple(group.attrs['shape']))
+
+
+def read_zarr(path, threads=None, elements=ELEMENTS):
+    """Read a store into memory, fetching elements and the chunks of X concurrently."""
+    zarr = _zarr()
+    from anndata.experimental import read_elem
+
+    root = zarr.open_group(path, mode='r')
+    with ThreadPoolExecutor(_threads(threads)) as pool:
+        # whole elements in their own tasks; X's chunks are spread over the pool as well
+        futures = {k: pool.submit(read_elem, root[k]) for k in elements if k in root}
+        X = _read_matrix(root['X'], pool) if 'X' in root else None
+        parts = {k: f.result() for k, f in futures.items()}
+    raw = parts.pop('raw', None)
+    adata = ad.AnnData(X=X, **parts)
+    if raw is not None:
+        adata.raw = raw
+    return adata
+
+
+def read_obs_var(path, threads=None):
+    """obs and var of a store, read concurrently, without touching X."""
+    zarr = _zarr()
+    from anndata.experimental import read_elem
+
+    root = zarr.open_group(path, mode='r')
+    with ThreadPoolExecutor(_threads(threads)) as pool:
+        obs, var = pool.map(lambda k: read_elem(root[k]), ('obs', 'var'))
+    return obs, var
+
+
+def append_obs(path, obs, uns=None):
+    """Replace obs of a store and add `uns` entries; X, layers and raw are not rewritten."""
+    zarr = _zarr()
+    from anndata.experimental import write_elem
+
+    root = zarr.open_group(path, mode='r+')
+    n_obs = root['obs'][root['obs'].attrs['_index']].shape[0]
+    if len(obs) != n_obs:
+        raise ValueError(f"obs has {len(obs)} rows but {path} holds {n_obs} cells")
+    obs = obs.copy()
+    for column in obs.columns:
+        if obs[column].dtype == object:
+            obs[column] = obs[column].astype('category')
+    write_elem(root, 'obs', obs)
+    for key, value in (uns or {}).items():
+        write_elem(root['uns'], key, value)
+    return path
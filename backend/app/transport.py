@@ -0,0 +1,319 @@
+"""
+Content negotiation and compression of API payloads.
+
+JSON stays the default.  Clients opt into a binary encoding through the
+Accept header:
+
+    application/vnd.apache.arrow.stream   Arrow IPC (needs pyarrow)
+    application/msgpack                   MessagePack (needs msgpack)
+
+MessagePack carries the same document as JSON.  The Arrow payload is a
+sequence of IPC streams: the first has no columns and holds the document as
+JSON in its schema metadata (`cellpilot.document`), with every table (a list
+of records such as `obs_preview`, or a DataFrame) replaced by
+`{"$table": i}`; stream i + 1 is table i, column-oriented.  Arrow readers that
+read concatenated streams (`RecordBatchReader.readAll` in Arrow JS) get them
+all in one pass.  A format whose package is not installed is not offered.
+
+`CompressionMiddleware` compresses response bodies of at least
+CELLPILOT_COMPRESS_MIN_BYTES (default 1024) with zstd (needs zstandard) or
+gzip, whichever the client accepts, streamed responses chunk by chunk.
+"""
+import gzip
+import json
+import math
+import os
+import zlib
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+JSON = 'application/json'
+ARROW = 'application/vnd.apache.arrow.stream'
+MSGPACK = 'application/msgpack'
+MEDIA_TYPES = {
+    JSON: JSON,
+    ARROW: ARROW,
+    MSGPACK: MSGPACK,
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.msgpack': MSGPACK,
+}
+DOCUMENT_KEY = b'cellpilot.document'
+TABLE_KEY = '$table'
+# bodies that are already compressed or must not be delayed
+UNCOMPRESSED_TYPES = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip', 'text/event-stream')
+
+
+def _available(media_type):
+    module = {ARROW: 'pyarrow', MSGPACK: 'msgpack'}.get(media_type)
+    if module is None:
+        return True
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def _accepted(header):
+    """(media type, quality) pairs of an Accept or Accept-Encoding header, best first."""
+    entries = []
+    for position, part in enumerate((header or '').split(',')):
+        fields = [f.strip() for f in part.split(';')]
+        if not fields[0]:
+            continue
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith('q='):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        entries.append((-quality, position, fields[0].lower()))
+    return [(name, -q) for q, _, name in sorted(entries)]
+
+
+def negotiate(accept):
+    """Media type to encode a payload with for an Accept header; JSON unless a binary type is preferred."""
+    for name, quality in _accepted(accept):
+        if quality <= 0:
+            continue
+        media_type = MEDIA_TYPES.get(name)
+        if media_type is None:
+            if name in ('*/*', 'application/*'):
+                return JSON
+            continue
+        if _available(media_type):
+            return media_type
+    return JSON
+
+
+def to_builtin(value):
+    """Python builtins for pydantic models, numpy and pandas values, paths and dates."""
+    if hasattr(value, 'model_dump'):
+        value = value.model_dump()
+    if isinstance(value, dict):
+        return {str(k): to_builtin(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_builtin(v) for v in value]
+    if isinstance(value, pd.DataFrame):
+        return [to_builtin(r) for r in value.to_dict(orient='records')]
+    if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+        return to_builtin(np.asarray(value).tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (Path, datetime, date)):
+        return str(value) if isinstance(value, Path) else value.isoformat()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def encode_msgpack(content):
+    import msgpack
+    return msgpack.packb(to_builtin(content), use_bin_type=True)
+
+
+def _is_table(value):
+    return isinstance(value, pd.DataFrame) or (
+        isinstance(value, list) and len(value) > 0 and all(isinstance(r, dict) for r in value))
+
+
+def _arrow_table(value):
+    import pyarrow as pa
+    if isinstance(value, pd.DataFrame):
+        return pa.Table.from_pandas(value, preserve_index=False)
+    return pa.Table.from_pylist(value)
+
+
+def _split_tables(value, tables):
+    """The document with every table that converts to Arrow moved into `tables`."""
+    import pyarrow as pa
+    if hasattr(value, 'model_dump'):
+        value = value.model_dump()
+    if _is_table(value):
+        try:
+            table = _arrow_table(value)
+        except (pa.ArrowException, TypeError, ValueError):
+            table = None  # mixed-type columns stay in the document
+        if table is not None:
+            tables.append(table)
+            return {TABLE_KEY: len(tables) - 1}
+    if isinstance(value, dict):
+        return {str(k): _split_tables(v, tables) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_split_tables(v, tables) for v in value]
+    return to_builtin(value)
+
+
+def encode_arrow(content):
+    import pyarrow as pa
+
+    tables = []
+    document = _split_tables(content, tables)
+    sink = pa.BufferOutputStream()
+    schema = pa.schema([], metadata={DOCUMENT_KEY: json.dumps(document).encode()})
+    with pa.ipc.new_stream(sink, schema):
+        pass
+    for table in tables:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_arrow(payload):
+    """The document of an Arrow payload with its tables as DataFrames (for Python clients and tests)."""
+    import pyarrow as pa
+
+    source = pa.BufferReader(payload)
+    reader = pa.ipc.open_stream(source)
+    reader.read_all()
+    document = json.loads(reader.schema.metadata[DOCUMENT_KEY])
+    tables = []
+    while source.tell() < source.size():
+        tables.append(pa.ipc.open_stream(source).read_all().to_pandas())
+
+    def restore(value):
+        if isinstance(value, dict):
+            if set(value) == {TABLE_KEY}:
+                return tables[value[TABLE_KEY]]
+            return {k: restore(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [restore(v) for v in value]
+        return value
+    return restore(document)
+
+
+ENCODERS = {ARROW: encode_arrow, MSGPACK: encode_msgpack}
+
+
+def negotiated(request, content):
+    """
+    `content` as the client asked for it: unchanged (serialized as JSON by
+    FastAPI) or an encoded binary response.
+    """
+    from fastapi.responses import Response
+
+    media_type = negotiate(request.headers.get('accept'))
+    if media_type == JSON:
+        return content
+    return Response(ENCODERS[media_type](content), media_type=media_type, headers={'Vary': 'Accept'})
+
+
+# ------------------------------ compression ------------------------------
+
+def compress_min_bytes():
+    return int(os.environ.get('CELLPILOT_COMPRESS_MIN_BYTES', 1024))
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def choose_encoding(accept_encoding):
+    """Content coding for an Accept-Encoding header: 'zstd', 'gzip' or None."""
+    for name, quality in _accepted(accept_encoding):
+        if quality <= 0:
+            continue
+        if name == 'zstd' and _zstd() is not None:
+            return 'zstd'
+        if name in ('gzip', '*'):
+            return 'gzip'
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding, level):
+        if encoding == 'zstd':
+            self._obj = _zstd().ZstdCompressor(level=level).compressobj()
+            self._flush_block = _zstd().COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+            self._flush_block = zlib.Z_SYNC_FLUSH
+
+    def chunk(self, data):
+        """Compressed `data`, flushed so the client can decode it right away."""
+        return self._obj.compress(data) + self._obj.flush(self._flush_block)
+
+    def finish(self, data=b''):
+        return self._obj.compress(data) + self._obj.flush()
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with zstd or gzip.  Bodies below
+    `minimum_size` (sent in one message), already encoded bodies and
+    already compressed media types pass through unchanged.
+    """
+
+    def __init__(self, app, minimum_size=None, zstd_level=3, gzip_level=6):
+        self.app = app
+        self.minimum_size = compress_min_bytes() if minimum_size is None else minimum_size
+        self.levels = {'zstd': zstd_level, 'gzip': gzip_level}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict((k.lower(), v) for k, v in scope.get('headers', []))
+        encoding = choose_encoding(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        state = {'start': None, 'compressor': None}
+
+        async def wrapped_send(message):
+            if message['type'] == 'http.response.start':
+                state['start'] = message
+                return
+            if message['type'] != 'http.response.body' or state['start'] is None:
+                return await send(message)
+            start, state['start'] = state['start'], None
+            body, more = message.get('body', b''), message.get('more_body', False)
+            response_headers = dict((k.lower(), v) for k, v in start.get('headers', []))
+            media_type = response_headers.get(b'content-type', b'').decode('latin-1')
+            if (b'content-encoding' in response_headers or media_type.startswith(UNCOMPRESSED_TYPES)
+                    or (not more and len(body) < self.minimum_size)):
+                await send(start)
+                return await send(message)
+
+            compressor = _Compressor(encoding, self.levels[encoding])
+            out_headers = [(k, v) for k, v in start.get('headers', []) if k.lower() != b'content-length']
+            out_headers.append((b'content-encoding', encoding.encode()))
+            vary = response_headers.get(b'vary')
+            if vary is None:
+                out_headers.append((b'vary', b'Accept-Encoding'))
+            elif b'accept-encoding' not in vary.lower():
+                out_headers = [(k, v + b', Accept-Encoding' if k.lower() == b'vary' else v) for k, v in out_headers]
+            if not more:
+                compressed = compressor.finish(body)
+                out_headers.append((b'content-length', str(len(compressed)).encode()))
+                await send(dict(start, headers=out_headers))
+                return await send({'type': 'http.response.body', 'body': compressed})
+            state['compressor'] = compressor
+            await send(dict(start, headers=out_headers))
+            await send({'type': 'http.response.body', 'body': compressor.chunk(body), 'more_body': True})
+
+        async def streaming_send(message):
+            compressor = state['compressor']
+            if compressor is None or message['type'] != 'http.response.body':
+                return await wrapped_send(message)
+            body, more = message.get('body', b''), message.get('more_body', False)
+            data = compressor.chunk(body) if more else compressor.finish(body)
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more})
+
+        await self.app(scope, receive, streaming_send)
+
+
+def decompress(body, encoding):
+    """Inverse of the middleware's coding (for Python clients and tests)."""
+    if encoding == 'zstd':
+        return _zstd().ZstdDecompressor().decompressobj().decompress(body)
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    return body
@@ -4,6 +4,9 @@ from typing import Any, Dict, List, Union
 import anndata as ad
 import pandas as pd
 
+from .output import read_h5ad
+from .store import is_zarr, read_obs_var
+
 def summarize_h5ad(path: Union[str, Path] = None, adata: ad.AnnData = None) -> Dict[str, Any]:
     if path is None and adata is None:
         raise ValueError("Either path or adata must be provided")
@@ -12,10 +15,16 @@ def summarize_h5ad(path: Union[str, Path] = None, adata: ad.AnnData = None) -> D
         if not path.exists():
             raise FileNotFoundError(path)
 
-    if adata is None:
-        A = ad.read_h5ad(path, backed="r")   # BackedAnnData
+    if adata is None and is_zarr(path):
+        obs, var = read_obs_var(str(path))   # annotations only; X stays on disk
+        A = ad.AnnData(obs=obs, var=var)
+        import zarr
+        root = zarr.open_group(str(path), mode="r")
+        uns_keys = list(root["uns"]) if "uns" in root else []
+        obsm_keys = list(root["obsm"]) if "obsm" in root else []
     else:
-        A = adata
+        A = adata if adata is not None else read_h5ad(str(path), backed="r")   # BackedAnnData; delta files resolve to their parent
+        uns_keys, obsm_keys = list(A.uns.keys()), list(A.obsm.keys())
     try:
         obs_preview = (
             A.obs.reset_index()
@@ -43,7 +52,7 @@ def summarize_h5ad(path: Union[str, Path] = None, adata: ad.AnnData = None) -> D
             "n_vars":      int(A.n_vars),
             "obs_columns": list(A.obs.columns),
             "var_columns": list(A.var.columns),
-            "preprocessed": ("neighbors" in A.uns) or ("X_pca" in A.obsm) or ("leiden" in A.obs.columns),
+            "preprocessed": ("neighbors" in uns_keys) or ("X_pca" in obsm_keys) or ("leiden" in A.obs.columns),
             "obs_preview": obs_preview,
             "var_preview": var_preview,
             "clusters": clusters if clusters else None,
@@ -0,0 +1,117 @@
+"""
+Benchmark of the run catalog (`app.catalog`) at tens of thousands of runs.
+
+Fills a fresh catalog with synthetic runs (a few pipelines, names, output
+directories and inputs, each run with a handful of artifacts), then times
+the queries the `/runs` endpoints make: the first page, a deep keyset page,
+filtered pages (pipeline, name, input fingerprint, artifact path) and a
+full-record lookup.  Query times are medians over repeats, in milliseconds.
+
+Run from the `backend/` directory:
+
+    python -m benchmarks.catalog --runs 50000 --output catalog.json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.catalog import connect, get_run, list_runs
+from benchmarks.run import machine_info
+
+PIPELINES = ('annotate', 'annotate_incremental', 'cellphonedb', 'inferCNV', 'drug_response_batch')
+
+
+def fill_catalog(path, n_runs, artifacts_per_run=6, seed=0):
+    """Insert `n_runs` synthetic runs in one transaction."""
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 1, 1)
+    conn = connect(path)
+    with conn:
+        for i in range(n_runs):
+            pipeline = PIPELINES[rng.integers(len(PIPELINES))]
+            name = f'sample{rng.integers(500)}'
+            output_dir = f'/data/out/project{rng.integers(50)}/{pipeline}'
+            run_id = conn.execute(
+                'INSERT INTO runs (pipeline, name, status, created_at, timestamp, input_path, output_dir, '
+                'wall_seconds, params, summary, timings) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (pipeline, name, 'ok' if rng.random() > 0.05 else 'error',
+                 (start + timedelta(minutes=i)).isoformat(timespec='seconds'), f'{i:08d}',
+                 f'/data/in/{name}.h5ad', output_dir, float(rng.gamma(2, 60)),
+                 json.dumps({'n_hvgs': 2000, 'resolution': 0.8}), json.dumps({'n_obs': int(rng.integers(1e5))}),
+                 json.dumps([{'stage': 'load', 'wall_seconds': 1.0}] * 20))).lastrowid
+            conn.execute('INSERT INTO inputs (run_id, path, fingerprint) VALUES (?, ?, ?)',
+                         (run_id, f'/data/in/{name}.h5ad', f'{rng.integers(2000):024x}'))
+            conn.executemany('INSERT INTO artifacts (run_id, path, kind, label, size_bytes) VALUES (?, ?, ?, ?, ?)',
+                             [(run_id, f'{output_dir}/{name}_{i}_{j}.png', 'figs', 'Plot', int(rng.integers(1e6)))
+                              for j in range(artifacts_per_run)])
+    conn.close()
+
+
+def _median_ms(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return round(statistics.median(times) * 1000, 3)
+
+
+def benchmark_queries(path, n_runs, repeats=20):
+    conn = sqlite3.connect(path)
+    fingerprint, artifact = conn.execute(
+        'SELECT inputs.fingerprint, artifacts.path FROM inputs JOIN artifacts USING (run_id) '
+        'WHERE run_id = ?', (n_runs // 2,)).fetchone()
+    conn.close()
+    deep = n_runs // 10
+    return {
+        'first_page_ms': _median_ms(lambda: list_runs(path=path), repeats),
+        'deep_page_ms': _median_ms(lambda: list_runs(before=deep, path=path), repeats),
+        'pipeline_page_ms': _median_ms(lambda: list_runs(pipeline='cellphonedb', path=path), repeats),
+        'name_page_ms': _median_ms(lambda: list_runs(name='sample7', path=path), repeats),
+        'fingerprint_page_ms': _median_ms(lambda: list_runs(fingerprint=fingerprint, path=path), repeats),
+        'artifact_lookup_ms': _median_ms(lambda: list_runs(artifact=artifact, path=path), repeats),
+        'since_page_ms': _median_ms(lambda: list_runs(since='2024-01-10', path=path), repeats),
+        'get_run_ms': _median_ms(lambda: get_run(n_runs // 2, path=path), repeats),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=50000)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--output', default='catalog_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'catalog.sqlite')
+        print(f"Filling a catalog with {args.runs} runs...")
+        start = time.perf_counter()
+        fill_catalog(path, args.runs, seed=args.seed)
+        fill_seconds = round(time.perf_counter() - start, 2)
+        print("Timing queries...")
+        queries = benchmark_queries(path, args.runs, args.repeats)
+        size_mb = round(os.path.getsize(path) / 2**20, 2)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': {'runs': args.runs, 'repeats': args.repeats, 'seed': args.seed},
+        'fill_seconds': fill_seconds,
+        'size_mb': size_mb,
+        'queries': queries,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark of the native doublet detection (`app.doublets`) against scrublet.
+
+A synthetic dataset (see `benchmarks.synthetic`) gets a known fraction of
+heterotypic doublets (the summed counts of two cells from different
+clusters).  scrublet runs as `ov.pp.qc` calls it (`sc.pp.scrublet` on the
+raw counts); the native scorer runs on the normalized, PCA-reduced data
+the way `run_preprocessing` hands it over, so the PCA it reuses is timed
+separately.  The report has wall times, the speedup, ROC AUC of both scores
+against the injected doublets, how many cells each calls, the rank
+correlation of the two scores and the fraction of cells called alike.
+
+Needs scanpy (and scikit-image for scrublet's threshold).  Run from the
+`backend/` directory:
+
+    python -m benchmarks.doublets --cells 50000 --doublet-rate 0.06 --output doublets.json
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from benchmarks.run import SCALES, machine_info
+from benchmarks.synthetic import make_adata
+
+
+def inject_doublets(adata, rate, seed=0):
+    """`adata` plus `rate * n_obs` doublets of cells from different clusters; obs['true_doublet'] marks them."""
+    rng = np.random.default_rng(seed)
+    n_doublets = int(rate * adata.n_obs)
+    cluster = adata.obs['true_cluster'].values.astype(int)
+    first, second = rng.integers(0, adata.n_obs, (2, n_doublets * 4))
+    heterotypic = cluster[first] != cluster[second]
+    first, second = first[heterotypic][:n_doublets], second[heterotypic][:n_doublets]
+    obs = pd.DataFrame({'sample': np.r_[adata.obs['sample'].values.astype(str),
+                                        adata.obs['sample'].values.astype(str)[first]],
+                        'true_doublet': np.r_[np.zeros(adata.n_obs, dtype=bool), np.ones(len(first), dtype=bool)]},
+                       index=[f'cell{i:07d}' for i in range(adata.n_obs + len(first))])
+    X = scipy.sparse.vstack([adata.X, adata.X[first] + adata.X[second]]).tocsr()
+    return ad.AnnData(X=X, obs=obs, var=adata.var.copy())
+
+
+def pipeline_input(adata, n_hvgs, n_pcs):
+    """What `run_preprocessing` passes to doublet detection: HVG subset, counts layer, implicit-scaling PCA."""
+    from app.incremental import shiftlog
+    from app.pca import scaled_pca
+    from app.sketch import normalized_dispersion
+
+    X = shiftlog(adata.X)
+    genes = np.sort(np.argsort(normalized_dispersion(X))[::-1][:min(n_hvgs, X.shape[1])])
+    out = ad.AnnData(X=X[:, genes], obs=adata.obs.copy(), var=adata.var.iloc[genes].copy())
+    out.obs['nUMIs'] = np.asarray(adata.X.sum(axis=1)).ravel()
+    out.layers['counts'] = scipy.sparse.csr_matrix(adata.X[:, genes], dtype=np.float32)
+    scaled_pca(out, n_pcs=n_pcs, solver='randomized')
+    return out
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 2)
+
+
+def benchmark_doublets(adata, n_hvgs=2000, n_pcs=50, batch_key=None, n_jobs=None):
+    import scanpy as sc
+    from scipy.stats import spearmanr
+    from sklearn.metrics import roc_auc_score
+
+    from app.doublets import detect_doublets
+
+    truth = adata.obs['true_doublet'].values
+    print("Running scrublet...")
+    scrubbed = adata.copy()
+    _, scrublet_seconds = _timed(lambda: sc.pp.scrublet(scrubbed, random_state=1234))
+
+    print("Computing the pipeline PCA...")
+    native, pca_seconds = _timed(lambda: pipeline_input(adata, n_hvgs, n_pcs))
+    # compile the numba kernel outside the timed region
+    detect_doublets(native[:500].copy(), batch_key=batch_key, n_jobs=1)
+    print("Running native doublet detection...")
+    _, native_seconds = _timed(lambda: detect_doublets(native, batch_key=batch_key, n_jobs=n_jobs))
+
+    def summary(obs, seconds):
+        return {
+            'seconds': seconds,
+            'roc_auc': round(float(roc_auc_score(truth, obs['doublet_score'])), 4),
+            'called': int(obs['predicted_doublet'].sum()),
+            'called_true': int((obs['predicted_doublet'].values & truth).sum()),
+        }
+
+    return {
+        'n_obs': int(adata.n_obs),
+        'n_true_doublets': int(truth.sum()),
+        'scrublet': summary(scrubbed.obs, scrublet_seconds),
+        'native': dict(summary(native.obs, native_seconds), pca_seconds=pca_seconds,
+                       batch_key=native.uns['scrublet']['parameters']['batch_key']),
+        'speedup': round(scrublet_seconds / max(native_seconds, 1e-9), 2),
+        'score_spearman': round(float(spearmanr(scrubbed.obs['doublet_score'], native.obs['doublet_score'])[0]), 4),
+        'call_agreement': round(float((scrubbed.obs['predicted_doublet'].values
+                                       == native.obs['predicted_doublet'].values).mean()), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--doublet-rate', type=float, default=0.06)
+    parser.add_argument('--batch-key', help="obs column to score per value of (default: 'sample' when present)")
+    parser.add_argument('--jobs', type=int, help='worker processes for per-sample scoring')
+    parser.add_argument('--output', default='doublets_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ctx = dict(SCALES[args.scale])
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+
+    print("Generating synthetic data...")
+    adata = make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=args.seed)
+    adata = inject_doublets(adata, args.doublet_rate, seed=args.seed)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': dict(ctx, doublet_rate=args.doublet_rate, seed=args.seed),
+        **benchmark_doublets(adata, batch_key=args.batch_key, n_jobs=args.jobs),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Check of batch CaDRReS-Sc scoring (`app.drug_response`) against the steps
+of `ov.single.Drug_Response`.
+
+One synthetic dataset (see `benchmarks.synthetic`) is log-normalized, kept
+as `raw` and clustered by its ground truth into `louvain`, then scored twice
+with the same synthetic reference and model: once as `Drug_Response` does it
+(a boolean slice of `adata.raw.X` per cluster, minus the mean over all
+cells, `calculate_kernel_feature` and `predict_from_model`) and once through
+`iter_batch_drug_response` on the written h5ad.  The report has both wall
+times and the largest absolute difference of the cluster profiles and of
+the predicted IC50s.
+
+Run from the `backend/` directory:
+
+    python -m benchmarks.drug_response --scale small --output drug_response.json
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.run import CADRRES_DIR, SCALES, machine_info
+from benchmarks.synthetic import make_adata, make_cadrres_inputs
+
+
+def make_inputs(ctx, workdir, seed=0):
+    """Clustered h5ad, reference expression table, pickled model and drug table in `workdir`."""
+    import scanpy as sc
+
+    adata = make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=seed)
+    sc.pp.normalize_total(adata, target_sum=1e4)
+    sc.pp.log1p(adata)
+    adata.raw = adata
+    adata.obs['louvain'] = adata.obs['true_cluster']
+    h5ad_path = os.path.join(workdir, 'sample.h5ad')
+    adata.write_h5ad(h5ad_path)
+
+    _, ref_df, _, model_dict, _ = make_cadrres_inputs(n_genes=ctx['genes'], n_ref_samples=ctx['ref_samples'],
+                                                      n_samples=1, n_drugs=ctx['drugs'], seed=seed)
+    ref_df.index = list(adata.var_names)
+    reference_path = os.path.join(workdir, 'reference_exp.tsv')
+    (ref_df + 8).to_csv(reference_path, sep='\t')
+    model_path = os.path.join(workdir, 'model.pickle')
+    with open(model_path, 'wb') as f:
+        pickle.dump(model_dict, f)
+    drug_info_path = os.path.join(workdir, 'drug_stat.csv')
+    pd.DataFrame({'Drug Name': [f'Drug{d}' for d in model_dict['drug_list']], 'log2_max_conc': 2.0},
+                 index=pd.Index(model_dict['drug_list'], name='Drug ID')).to_csv(drug_info_path)
+    return adata, h5ad_path, reference_path, model_path, drug_info_path
+
+
+def drug_response_baseline(adata, reference_path, model_path):
+    """Cluster profiles and IC50s computed as `ov.single.Drug_Response` does."""
+    from cadrres_sc import model, pp
+
+    gene_exp_df = pd.read_csv(reference_path, sep='\t', index_col=0)
+    gene_exp_df = gene_exp_df.groupby(gene_exp_df.index).mean()
+    clusters = sorted(adata.obs['louvain'].unique(), key=int)
+    cluster_norm_exp_df = pd.DataFrame(columns=clusters, index=adata.raw.var.index)
+    for cluster in clusters:
+        cluster_norm_exp_df[cluster] = adata.raw.X[adata.obs['louvain'] == cluster].mean(axis=0).T \
+            if np.sum(adata.raw.X[adata.obs['louvain'] == cluster]) else 0.0
+    cell_line_log2_mean_fc_exp_df, _ = pp.gexp.normalize_log2_mean_fc(gene_exp_df)
+    adata_exp_mean = pd.Series(adata.raw.X.mean(axis=0).tolist()[0], index=adata.raw.var.index)
+    cluster_norm_exp_df = cluster_norm_exp_df.sub(adata_exp_mean, axis=0).astype(float)
+    kernel_df = pp.gexp.calculate_kernel_feature(cluster_norm_exp_df, cell_line_log2_mean_fc_exp_df,
+                                                 gene_exp_df.index.dropna().tolist())
+    pred_df, _ = model.predict_from_model(model.load_model(model_path), kernel_df)
+    return cluster_norm_exp_df, pred_df
+
+
+def _max_diff(a, b):
+    return float(np.nanmax(np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float))))
+
+
+def compare(ctx, workdir, seed=0):
+    from app.drug_response import cluster_profiles_from_adata, iter_batch_drug_response
+
+    adata, h5ad_path, reference_path, model_path, drug_info_path = make_inputs(ctx, workdir, seed)
+
+    print("Scoring as ov.single.Drug_Response...")
+    start = time.perf_counter()
+    base_profiles, base_pred = drug_response_baseline(adata, reference_path, model_path)
+    baseline_seconds = time.perf_counter() - start
+
+    print("Scoring with iter_batch_drug_response...")
+    start = time.perf_counter()
+    events = list(iter_batch_drug_response(
+        [h5ad_path], os.path.join(workdir, 'out'), name='bench', model_paths={'GDSC': model_path},
+        reference_exp_path=reference_path, drug_info_path=drug_info_path))
+    batch_seconds = time.perf_counter() - start
+
+    clusters = list(base_profiles.columns)
+    profiles, _ = cluster_profiles_from_adata(adata, 'louvain')
+    ic50_df = pd.read_csv(events[-1]['files'][0][0], index_col=0)
+    ic50_df = ic50_df.drop(columns='model').loc[[f'sample|{c}' for c in clusters]]
+    return {
+        'baseline_seconds': round(baseline_seconds, 3),
+        'batch_seconds': round(batch_seconds, 3),
+        'profile_max_abs_diff': _max_diff(profiles.loc[base_profiles.index, clusters], base_profiles),
+        'ic50_max_abs_diff': _max_diff(ic50_df[[str(d) for d in base_pred.columns]], base_pred.loc[clusters]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--ref-samples', type=int, default=200)
+    parser.add_argument('--drugs', type=int, default=250)
+    parser.add_argument('--output', default='drug_response_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ctx = dict(SCALES[args.scale], ref_samples=args.ref_samples, drugs=args.drugs)
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+    if CADRRES_DIR not in sys.path:
+        sys.path.append(CADRRES_DIR)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = compare(ctx, workdir, args.seed)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': dict(ctx, seed=args.seed),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark of the kNN backends in `app.neighbors` against exact search.
+
+A synthetic dataset (see `benchmarks.synthetic`) is log-normalized and
+reduced with the implicit-scaling PCA; a held-out fraction of cells is kept
+aside as queries.  For each backend the report has the index build time,
+the time to reload the saved index, the time to query the held-out cells,
+and recall@k of both the all-points graph and the queries against exact kNN.
+
+Run from the `backend/` directory:
+
+    python -m benchmarks.neighbors --cells 50000 --genes 3000 --output knn.json
+    python -m benchmarks.neighbors --backends hnsw,nndescent --n-neighbors 30
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from app.neighbors import BACKENDS, KnnIndex, recall
+from app.pca import scaled_pca
+from benchmarks.run import SCALES, machine_info
+from benchmarks.synthetic import make_adata
+
+
+def pca_representation(ctx):
+    adata = make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=ctx['seed'])
+    X = adata.X
+    X = X.multiply(1e4 / np.asarray(X.sum(axis=1))).tocsr()
+    X.data = np.log1p(X.data)
+    adata.X = X
+    scaled_pca(adata, n_pcs=ctx['n_pcs'])
+    return adata.obsm['scaled|original|X_pca']
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 4)
+
+
+def benchmark_backends(rep, backends, k, query_fraction=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    is_query = rng.random(rep.shape[0]) < query_fraction
+    base, queries = rep[~is_query], rep[is_query]
+
+    # compile the numba kernels outside the timed region
+    KnnIndex('hnsw', k).build(base[:min(len(base), 500)]).query(queries[:10])
+
+    exact, exact_seconds = _timed(lambda: KnnIndex('exact', k).build(base))
+    exact_graph = exact.knn()[0]
+    exact_queries = exact.query(queries, k)[0]
+
+    results = []
+    with tempfile.TemporaryDirectory() as index_dir:
+        for backend in backends:
+            print(f"Benchmarking {backend}...")
+            if backend == 'exact':
+                index, build_seconds = exact, exact_seconds
+            else:
+                index, build_seconds = _timed(lambda: KnnIndex(backend, k).build(base))
+            path = index.save(index_dir)
+            index, load_seconds = _timed(lambda: KnnIndex.load(path, base))
+            (found, _), query_seconds = _timed(lambda: index.query(queries, k))
+            query_recall = np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(found, exact_queries)])
+            results.append({
+                'backend': backend,
+                'build_seconds': build_seconds,
+                'load_seconds': load_seconds,
+                'query_seconds': query_seconds,
+                'graph_recall': round(recall(index.knn()[0], exact_graph), 4),
+                'query_recall': round(float(query_recall), 4),
+                'index_mb': round(os.path.getsize(path) / 2**20, 2),
+            })
+    return {'n_index': int(len(base)), 'n_queries': int(len(queries)), 'backends': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--n-pcs', type=int, default=50)
+    parser.add_argument('--n-neighbors', type=int, default=15)
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    parser.add_argument('--output', default='knn_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+    unknown = [b for b in backends if b not in BACKENDS]
+    if unknown:
+        parser.error(f"Unknown backends {unknown}. Available: {list(BACKENDS)}")
+
+    ctx = dict(SCALES[args.scale])
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+    ctx.update(n_pcs=args.n_pcs, n_neighbors=args.n_neighbors, seed=args.seed)
+
+    print("Computing PCA of synthetic data...")
+    rep = pca_representation(ctx)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': ctx,
+        **benchmark_backends(rep, backends, args.n_neighbors, seed=args.seed),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+"""
+End-to-end benchmark harness for the backend pipelines.
+
+Generates synthetic inputs (see `benchmarks.synthetic`), runs each stage in
+its own spawned process and writes wall time, CPU time, peak RSS and a
+per-step breakdown to JSON.  Nothing is downloaded; stages whose local
+prerequisites are missing (the SCSA marker database, the CaDRReS model
+files) are skipped or run reduced, and the reason is recorded.
+
+Run from the `backend/` directory:
+
+    python -m benchmarks.run --cells 20000 --genes 3000 --clusters 10 --output results.json
+    python -m benchmarks.run --stages kernel_feature,predict_from_model
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import time
+import traceback
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(BACKEND_DIR)
+CADRRES_DIR = os.path.join(REPO_DIR, 'CaDRReS-Sc')
+SCSA_DB = 'db/pySCSA_2024_v1_plus.db'
+
+SCALES = {
+    'tiny':   dict(cells=1000, genes=1000, clusters=4, density=0.08),
+    'small':  dict(cells=5000, genes=2000, clusters=8, density=0.05),
+    'medium': dict(cells=50000, genes=3000, clusters=12, density=0.05),
+    'large':  dict(cells=250000, genes=3000, clusters=20, density=0.05),
+}
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _StepRecorder:
+    """
+    Wraps stdout and timestamps the pipelines' own progress messages
+    ("Performing PCA...", "Running cellmarker annotation...") to derive a
+    per-step breakdown for stages that do not report `timings` themselves.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.marks = [(0.0, 'start')]
+
+    def write(self, text):
+        for line in text.splitlines():
+            line = line.strip()
+            if line.endswith('...'):
+                self.marks.append((time.perf_counter() - self.start, line.rstrip('.')))
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def breakdown(self, end):
+        marks = self.marks + [(end, 'end')]
+        return [
+            {'step': label, 'seconds': round(marks[i + 1][0] - t, 4)}
+            for i, (t, label) in enumerate(marks[:-1])
+        ]
+
+
+# ----------------------------------------------------------------------------
+# Stages: each `setup` receives the shared context and returns a zero-argument
+# callable; only that callable is timed.
+# ----------------------------------------------------------------------------
+
+def _setup_annotate(ctx):
+    from app.annotate import annotate
+    use_scsa = os.path.exists(SCSA_DB)
+    ctx['notes'].append('SCSA annotation enabled' if use_scsa else f'{SCSA_DB} not found: preprocessing only')
+    params = {'n_hvgs': min(2000, ctx['genes'] // 2), 'n_pcs': 30, 'min_genes': 10, 'min_counts': 10}
+    return lambda: annotate(
+        'bench', ctx['raw_h5ad'], os.path.join(ctx['workdir'], 'annotate'),
+        preprocessed=False, preprocessing_params=params,
+        use_cellmarker=use_scsa, use_panglao=False, use_cancer_single_cell_atlas=False,
+    )
+
+
+def _setup_cellphonedb(ctx):
+    from app.analysis import run_cell_phone_db
+    return lambda: run_cell_phone_db(
+        ctx['norm_h5ad'], os.path.join(ctx['workdir'], 'cellphonedb'),
+        plot_column_names=[], column_name='cell_type', cpdb_file_path=ctx['cpdb_zip'], name='bench',
+    )
+
+
+def _setup_infercnv(ctx):
+    from app.analysis import run_inferncnv
+    from app.drug_response import DEFAULT_MODELS
+    missing = [p for p in DEFAULT_MODELS.values() if not os.path.exists(p)]
+    if missing:
+        raise _Skip(f'CaDRReS model files not available offline: {missing}')
+    return lambda: run_inferncnv(
+        ctx['norm_h5ad'], os.path.join(ctx['workdir'], 'infercnv'), 'bench',
+        reference_key='cell_type', gtf_path=ctx['gtf'], reference_cat=['Type0', 'Type1'], cnv_threshold=0.03,
+    )
+
+
+def _cadrres_inputs(ctx):
+    from benchmarks.synthetic import make_cadrres_inputs
+    if CADRRES_DIR not in sys.path:
+        sys.path.append(CADRRES_DIR)
+    return make_cadrres_inputs(n_genes=ctx['genes'], n_ref_samples=ctx['ref_samples'],
+                               n_samples=ctx['clusters'] * 10, n_drugs=ctx['drugs'], seed=ctx['seed'])
+
+
+def _setup_kernel_feature(ctx):
+    sample_df, ref_df, genes, _, _ = _cadrres_inputs(ctx)
+    from cadrres_sc.pp import gexp
+    return lambda: gexp.calculate_kernel_feature(sample_df, ref_df, genes)
+
+
+def _setup_predict_from_model(ctx):
+    sample_df, ref_df, genes, model_dict, _ = _cadrres_inputs(ctx)
+    from cadrres_sc.pp import gexp
+    from cadrres_sc import model
+    kernel_df = gexp.calculate_kernel_feature(sample_df, ref_df, genes)
+    return lambda: model.predict_from_model(model_dict, kernel_df)
+
+
+def _setup_calculate_combined_ic50(ctx):
+    sample_df, ref_df, genes, model_dict, frac_df = _cadrres_inputs(ctx)
+    from cadrres_sc.pp import gexp
+    from cadrres_sc import model, utility
+    kernel_df = gexp.calculate_kernel_feature(sample_df, ref_df, genes)
+    cluster_pred_df, _ = model.predict_from_model(model_dict, kernel_df)
+    cluster_pred_df = cluster_pred_df.iloc[:, :ctx['combined_drugs']]
+    return lambda: utility.calculate_combined_ic50(cluster_pred_df, frac_df)
+
+
+STAGES = {
+    'annotate': _setup_annotate,
+    'cellphonedb': _setup_cellphonedb,
+    'infercnv': _setup_infercnv,
+    'kernel_feature': _setup_kernel_feature,
+    'predict_from_model': _setup_predict_from_model,
+    'calculate_combined_ic50': _setup_calculate_combined_ic50,
+}
+
+
+class _Skip(Exception):
+    pass
+
+
+def _pipeline_timings(result):
+    """Stage records attached by the pipelines' own instrumentation, if any."""
+    if isinstance(result, tuple):  # annotate returns (outputs, params)
+        result = result[0].get('data', {})
+    if isinstance(result, dict):
+        return result.get('timings')
+    return None
+
+
+def _run_stage(name, ctx, conn):
+    """Child-process entry point: set up, time the stage, send the record back."""
+    sys.path.insert(0, BACKEND_DIR)
+    ctx = dict(ctx, notes=[])
+    record = {'stage': name, 'status': 'ok'}
+    try:
+        setup_start = time.perf_counter()
+        run = STAGES[name](ctx)
+        record['setup_seconds'] = round(time.perf_counter() - setup_start, 4)
+        rss_before = _peak_rss_mb()
+
+        recorder = _StepRecorder(sys.stdout)
+        sys.stdout = recorder
+        cpu_start = _cpu_seconds()
+        try:
+            result = run()
+        finally:
+            wall = time.perf_counter() - recorder.start
+            sys.stdout = recorder.stream
+        record.update({
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(_cpu_seconds() - cpu_start, 4),
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+            'peak_rss_before_mb': round(rss_before, 1),
+            'breakdown': _pipeline_timings(result) or recorder.breakdown(wall),
+        })
+    except _Skip as e:
+        record.update({'status': 'skipped', 'reason': str(e)})
+    except Exception as e:
+        record.update({'status': 'error', 'error': str(e), 'traceback': traceback.format_exc()})
+    record['notes'] = ctx['notes']
+    conn.send(record)
+    conn.close()
+
+
+def prepare_inputs(ctx):
+    """Write the synthetic h5ads, CellPhoneDB zip and GTF shared by the pipeline stages."""
+    import numpy as np
+    from benchmarks import synthetic
+
+    os.makedirs(ctx['workdir'], exist_ok=True)
+    adata = synthetic.make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=ctx['seed'])
+    ctx['raw_h5ad'] = synthetic.write_h5ad(adata, os.path.join(ctx['workdir'], 'synthetic_raw.h5ad'))
+
+    norm = adata.copy()
+    totals = np.asarray(norm.X.sum(axis=1)).ravel()
+    norm.X = norm.X.multiply(1e4 / np.maximum(totals, 1)[:, None]).tocsr()
+    norm.X.data = np.log1p(norm.X.data)
+    ctx['norm_h5ad'] = synthetic.write_h5ad(norm, os.path.join(ctx['workdir'], 'synthetic_norm.h5ad'))
+
+    genes = list(adata.var_names)
+    ctx['cpdb_zip'] = synthetic.make_cpdb_zip(os.path.join(ctx['workdir'], 'synthetic_cellphonedb.zip'), genes, seed=ctx['seed'])
+    ctx['gtf'] = synthetic.make_gtf(os.path.join(ctx['workdir'], 'synthetic.gtf.gz'), genes, seed=ctx['seed'])
+    return ctx
+
+
+def machine_info():
+    info = {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        import psutil
+        info['memory_gb'] = round(psutil.virtual_memory().total / 2**30, 1)
+    except ImportError:
+        pass
+    return info
+
+
+def run_benchmarks(ctx, stages, timeout=None):
+    """Run `stages` one after another, each in a fresh spawned process."""
+    spawn = mp.get_context('spawn')
+    results = []
+    for name in stages:
+        print(f"Benchmarking {name}...")
+        parent_conn, child_conn = spawn.Pipe(duplex=False)
+        proc = spawn.Process(target=_run_stage, args=(name, ctx, child_conn))
+        proc.start()
+        child_conn.close()
+        if parent_conn.poll(timeout):
+            try:
+                record = parent_conn.recv()
+            except EOFError:
+                proc.join()
+                # killed before reporting, e.g. by the OOM killer
+                record = {'stage': name, 'status': 'crashed', 'exitcode': proc.exitcode}
+        else:
+            proc.terminate()
+            record = {'stage': name, 'status': 'timeout', 'timeout_seconds': timeout}
+        proc.join()
+        print(json.dumps({k: v for k, v in record.items() if k not in ('breakdown', 'traceback')}))
+        results.append(record)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--ref-samples', type=int, default=1000, help='reference cell lines for the CaDRReS stages')
+    parser.add_argument('--drugs', type=int, default=250)
+    parser.add_argument('--combined-drugs', type=int, default=20, help='drugs passed to calculate_combined_ic50')
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--workdir', default=os.path.join('benchmark_runs', datetime.now().strftime('%Y%m%d_%H%M%S')))
+    parser.add_argument('--output', help='JSON output path (default: <workdir>/benchmark_results.json)')
+    parser.add_argument('--timeout', type=float, help='per-stage timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stages {unknown}. Available: {list(STAGES)}")
+
+    ctx = dict(SCALES[args.scale])
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+    ctx.update(ref_samples=args.ref_samples, drugs=args.drugs, combined_drugs=args.combined_drugs,
+               seed=args.seed, workdir=os.path.abspath(args.workdir))
+
+    print(f"Generating synthetic inputs in {ctx['workdir']}...")
+    start = time.perf_counter()
+    prepare_inputs(ctx)
+    generate_seconds = time.perf_counter() - start
+
+    results = run_benchmarks(ctx, stages, args.timeout)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': {k: v for k, v in ctx.items() if k != 'notes'},
+        'generate_seconds': round(generate_seconds, 4),
+        'stages': results,
+    }
+    output = args.output or os.path.join(ctx['workdir'], 'benchmark_results.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Benchmark results saved to {output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark of sketch-based preprocessing against a full run.
+
+Runs `run_preprocessing` once on all cells of a synthetic dataset (see
+`benchmarks.synthetic`) and once per sketch method/size on a sketch whose
+Leiden labels and embeddings are then propagated to every cell passing QC.  Reports
+wall time and the agreement of the propagated Leiden labels with the full
+run and with the ground truth (adjusted Rand index and NMI), over the cells
+that pass QC in the full run, and the number of cells each run outputs.
+
+Needs the pipeline environment (omicverse, scanpy).  Run from the
+`backend/` directory:
+
+    python -m benchmarks.sketch --cells 200000 --sizes 5000,20000 --output sketch.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmarks.run import SCALES, machine_info
+from benchmarks.synthetic import make_adata
+
+
+def _agreement(labels, reference):
+    from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+    labels, reference = np.asarray(labels, dtype=str), np.asarray(reference, dtype=str)
+    return {
+        'ari': round(float(adjusted_rand_score(reference, labels)), 4),
+        'nmi': round(float(normalized_mutual_info_score(reference, labels)), 4),
+    }
+
+
+def benchmark_sketches(adata, sizes, methods, params, workdir):
+    from app.annotate import qc_thresholds, run_preprocessing
+    from app.doublets import quality_filter
+    from app.sketch import SKETCH_REP, propagate, sketch_indices, sketch_space
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M')
+    print("Running full preprocessing...")
+    start = time.perf_counter()
+    os.makedirs(os.path.join(workdir, 'full'))
+    full_result, _ = run_preprocessing(adata.copy(), os.path.join(workdir, 'full'), params, timestamp, 'full')
+    full_seconds = time.perf_counter() - start
+    kept = full_result.obs_names
+    truth = adata.obs.loc[kept, 'true_cluster']
+    results = [{
+        'method': 'full',
+        'sketch_size': int(adata.n_obs),
+        'n_obs': int(full_result.n_obs),
+        'seconds': round(full_seconds, 2),
+        'vs_truth': _agreement(full_result.obs['leiden'], truth),
+    }]
+
+    # as `annotate` does: QC on all cells, then the sketch space of the cells that pass
+    start = time.perf_counter()
+    filtered = quality_filter(adata.copy(), qc_thresholds(params), mt_startswith=params['mito_prefix'])
+    space, _ = sketch_space(filtered, n_hvgs=params['n_hvgs'], n_pcs=params['n_pcs'])
+    space_seconds = time.perf_counter() - start
+    for method in methods:
+        for size in sizes:
+            print(f"Running {method} sketch of {size} cells...")
+            start = time.perf_counter()
+            full = filtered.copy()
+            full.obsm[SKETCH_REP] = space
+            sketch = full[sketch_indices(space, size, method=method)].copy()
+            run_dir = os.path.join(workdir, f'{method}_{size}')
+            os.makedirs(run_dir)
+            sketch, _ = run_preprocessing(sketch, run_dir, params, timestamp, 'sketch')
+            confidence = propagate(full, sketch, ['leiden'], ['X_umap', 'X_mde'])
+            seconds = time.perf_counter() - start + space_seconds
+            labels = full.obs.loc[kept, 'leiden']
+            results.append({
+                'method': method,
+                'sketch_size': size,
+                'n_obs': int(full.n_obs),
+                'seconds': round(seconds, 2),
+                'speedup': round(full_seconds / seconds, 2),
+                'transfer_confidence': confidence['leiden'],
+                'vs_full': _agreement(labels, full_result.obs['leiden']),
+                'vs_truth': _agreement(labels, truth),
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='medium')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--sizes', default='2000,10000', help='comma-separated sketch sizes')
+    parser.add_argument('--methods', default='geometric,leverage')
+    parser.add_argument('--output', default='sketch_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ctx = dict(SCALES[args.scale])
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    methods = [m.strip() for m in args.methods.split(',') if m.strip()]
+
+    from app.annotate import default_params
+    params = dict(default_params(), min_genes=10, min_counts=10, pca_mode='implicit')
+
+    print("Generating synthetic data...")
+    adata = make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        results = benchmark_sketches(adata, sizes, methods, params, workdir)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': dict(ctx, sizes=sizes, methods=methods, seed=args.seed),
+        'runs': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark of Zarr stores (`app.store`) against h5ad files (`app.output`).
+
+A synthetic dataset (see `benchmarks.synthetic`) with a few obs columns and
+an embedding is written once as an h5ad under the output policy and once as
+a Zarr store.  The report has write and full-load times and on-disk size of
+both formats, the load time of the store with 1 and N reader threads, and
+the time to store one new obs column: an in-place `append_obs` on the store
+against rewriting the whole h5ad.
+
+Needs the optional `zarr` package.  Run from the `backend/` directory:
+
+    python -m benchmarks.store --cells 200000 --threads 8 --output store.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import anndata as ad
+import numpy as np
+
+from app.output import write_h5ad
+from app.store import append_obs, read_zarr, write_zarr
+from benchmarks.run import SCALES, machine_info
+from benchmarks.synthetic import make_adata
+
+
+def _timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, round(time.perf_counter() - start, 4)
+
+
+def _size_mb(path):
+    if os.path.isfile(path):
+        return round(os.path.getsize(path) / 2**20, 2)
+    total = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return round(total / 2**20, 2)
+
+
+def benchmark_formats(adata, threads, workdir):
+    h5ad_path = os.path.join(workdir, 'bench.h5ad')
+    zarr_path = os.path.join(workdir, 'bench.zarr')
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 20, adata.n_obs).astype(str)
+
+    print("Writing h5ad...")
+    _, h5ad_write = _timed(lambda: write_h5ad(adata, h5ad_path))
+    _, h5ad_load = _timed(lambda: ad.read_h5ad(h5ad_path))
+    print("Writing Zarr store...")
+    _, zarr_write = _timed(lambda: write_zarr(adata, zarr_path))
+    _, zarr_load_1 = _timed(lambda: read_zarr(zarr_path, threads=1))
+    _, zarr_load_n = _timed(lambda: read_zarr(zarr_path, threads=threads))
+
+    print("Adding an obs column...")
+    annotated = adata.copy()
+    annotated.obs['new_label'] = labels
+    _, h5ad_rewrite = _timed(lambda: write_h5ad(annotated, h5ad_path))
+    _, zarr_append = _timed(lambda: append_obs(zarr_path, annotated.obs))
+    return {
+        'h5ad': {
+            'write_seconds': h5ad_write,
+            'load_seconds': h5ad_load,
+            'add_obs_column_seconds': h5ad_rewrite,
+            'size_mb': _size_mb(h5ad_path),
+        },
+        'zarr': {
+            'write_seconds': zarr_write,
+            'load_seconds_1_thread': zarr_load_1,
+            f'load_seconds_{threads}_threads': zarr_load_n,
+            'add_obs_column_seconds': zarr_append,
+            'size_mb': _size_mb(zarr_path),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='medium')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--clusters', type=int)
+    parser.add_argument('--density', type=float, help='fraction of non-zero genes per cell')
+    parser.add_argument('--threads', type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument('--output', default='store_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    ctx = dict(SCALES[args.scale])
+    for key in ('cells', 'genes', 'clusters', 'density'):
+        if getattr(args, key) is not None:
+            ctx[key] = getattr(args, key)
+
+    print("Generating synthetic data...")
+    adata = make_adata(ctx['cells'], ctx['genes'], ctx['clusters'], ctx['density'], seed=args.seed)
+    adata.obsm['X_umap'] = np.random.default_rng(args.seed).normal(size=(adata.n_obs, 2)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as workdir:
+        results = benchmark_formats(adata, args.threads, workdir)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': dict(ctx, threads=args.threads, seed=args.seed),
+        **results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
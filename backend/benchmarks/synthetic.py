@@ -0,0 +1,201 @@
+"""
+Synthetic inputs for the benchmark harness.
+
+Everything here is generated locally so the benchmarks run offline:
+
+* `make_adata`      – count matrix with cluster-specific gene programs
+* `make_cpdb_zip`   – a tiny CellPhoneDB database (same tables and columns as
+                      `db/cellphonedb.zip`) over the synthetic genes
+* `make_gtf`        – a gzipped GTF placing the synthetic genes on chromosomes
+* `make_cadrres_inputs` – reference/sample fold-change tables and a model dict
+                      with the structure `predict_from_model` expects
+"""
+import gzip
+import os
+import zipfile
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+MT_GENES = ['MT-ND1', 'MT-ND2', 'MT-CO1', 'MT-CO2', 'MT-ATP8', 'MT-ATP6', 'MT-CO3',
+            'MT-ND3', 'MT-ND4L', 'MT-ND4', 'MT-ND5', 'MT-ND6', 'MT-CYB']
+
+
+def gene_names(n_genes):
+    """Synthetic gene symbols; mitochondrial genes are included so QC has something to filter."""
+    n_mt = min(len(MT_GENES), max(n_genes // 100, 1))
+    return MT_GENES[:n_mt] + [f'SYN{i:05d}' for i in range(n_genes - n_mt)]
+
+
+def make_adata(n_cells=5000, n_genes=2000, n_clusters=8, density=0.05, markers_per_cluster=20, seed=0):
+    """
+    Synthetic raw-count AnnData.
+
+    Each cluster up-weights its own block of marker genes, so clustering and
+    marker detection have real structure to find.  Every cell has roughly
+    `density * n_genes` non-zero genes.  Ground truth is stored in
+    `obs['cell_type']` and `obs['true_cluster']`.
+    """
+    rng = np.random.default_rng(seed)
+    genes = gene_names(n_genes)
+    nnz_per_cell = max(int(density * n_genes), 1)
+
+    base = rng.gamma(0.6, 1.0, n_genes)
+    cluster_of_cell = np.sort(rng.integers(0, n_clusters, n_cells))
+    indices = np.empty(n_cells * nnz_per_cell, dtype=np.int32)
+    for c in range(n_clusters):
+        weights = base.copy()
+        start = len(MT_GENES) + c * markers_per_cluster
+        weights[start:start + markers_per_cluster] *= 25
+        # cells are sorted by cluster, so each cluster owns one contiguous block of `indices`
+        lo, hi = np.searchsorted(cluster_of_cell, [c, c + 1])
+        indices[lo * nnz_per_cell:hi * nnz_per_cell] = rng.choice(
+            n_genes, size=(hi - lo) * nnz_per_cell, p=weights / weights.sum())
+
+    data = (rng.geometric(0.4, n_cells * nnz_per_cell)).astype(np.float32)
+    indptr = np.arange(0, n_cells * nnz_per_cell + 1, nnz_per_cell, dtype=np.int64)
+    X = scipy.sparse.csr_matrix((data, indices, indptr), shape=(n_cells, n_genes))
+    X.sum_duplicates()
+
+    order = rng.permutation(n_cells)
+    X = X[order]
+    cluster_of_cell = cluster_of_cell[order]
+
+    obs = pd.DataFrame(index=[f'cell{i:07d}' for i in range(n_cells)])
+    obs['true_cluster'] = pd.Categorical(cluster_of_cell.astype(str))
+    obs['cell_type'] = pd.Categorical([f'Type{c}' for c in cluster_of_cell])
+    obs['sample'] = pd.Categorical([f'S{i}' for i in rng.integers(0, 4, n_cells)])
+    return ad.AnnData(X=X, obs=obs, var=pd.DataFrame(index=genes))
+
+
+def make_cpdb_zip(path, genes, n_interactions=200, seed=0):
+    """Write a CellPhoneDB-format zip with simple and complex ligand-receptor pairs over `genes`."""
+    rng = np.random.default_rng(seed)
+    genes = [g for g in genes if not g.startswith('MT-')]
+    n_proteins = min(len(genes), max(2 * n_interactions, 10))
+    protein_genes = list(rng.choice(genes, n_proteins, replace=False))
+
+    proteins = pd.DataFrame({
+        'id_protein': np.arange(n_proteins),
+        'protein_name': [f'{g}_HUMAN' for g in protein_genes],
+        'tags': np.nan, 'tags_reason': np.nan, 'tags_description': np.nan,
+        'protein_multidata_id': np.arange(n_proteins),
+    })
+    gene_table = pd.DataFrame({
+        'id_gene': np.arange(n_proteins),
+        'ensembl': [f'ENSG{i:011d}' for i in range(n_proteins)],
+        'gene_name': protein_genes,
+        'hgnc_symbol': protein_genes,
+        'protein_name': proteins['protein_name'],
+        'protein_id': proteins['id_protein'],
+    })
+
+    n_complexes = max(n_proteins // 20, 1)
+    receptor = rng.random(n_proteins + n_complexes) < 0.5
+    multidata = pd.DataFrame({
+        'id_multidata': np.arange(n_proteins + n_complexes),
+        'name': [f'P{i:05d}' for i in range(n_proteins)] + [f'SYNCOMPLEX{i}' for i in range(n_complexes)],
+        'receptor': receptor, 'receptor_desc': np.nan,
+        'other': False, 'other_desc': np.nan,
+        'secreted_highlight': ~receptor, 'secreted_desc': np.nan,
+        'transmembrane': receptor, 'secreted': ~receptor,
+        'peripheral': False, 'integrin': False,
+        'is_complex': np.arange(n_proteins + n_complexes) >= n_proteins,
+    })
+    complexes = pd.DataFrame({
+        'id_complex': np.arange(n_complexes),
+        'complex_multidata_id': np.arange(n_proteins, n_proteins + n_complexes),
+        'pdb_structure': False, 'pdb_id': np.nan, 'stoichiometry': np.nan, 'comments_complex': np.nan,
+        'reactome_reaction': np.nan, 'reactome_complex': np.nan, 'complexPortal_complex': np.nan,
+        'rhea_reaction': np.nan,
+    })
+    members = rng.choice(n_proteins, (n_complexes, 2), replace=True)
+    composition = pd.DataFrame({
+        'id_complex_composition': np.arange(2 * n_complexes),
+        'complex_multidata_id': np.repeat(complexes['complex_multidata_id'].values, 2),
+        'protein_multidata_id': members.ravel(),
+        'total_protein': 2,
+    })
+
+    ligands = np.flatnonzero(~receptor)
+    receptors = np.flatnonzero(receptor)
+    pairs = {(int(rng.choice(ligands)), int(rng.choice(receptors))) for _ in range(n_interactions)}
+    pairs = sorted(pairs)
+    interactions = pd.DataFrame({
+        'id_interaction': np.arange(len(pairs)),
+        'id_cp_interaction': [f'CPI-SYN{i:06d}' for i in range(len(pairs))],
+        'multidata_1_id': [a for a, _ in pairs],
+        'multidata_2_id': [b for _, b in pairs],
+        'source': 'synthetic', 'annotation_strategy': 'curated', 'is_ppi': True, 'curator': 'benchmark',
+        'directionality': 'Ligand-Receptor', 'classification': 'Signaling by Synthetic',
+    })
+
+    tables = {
+        'protein_table.csv': proteins,
+        'gene_table.csv': gene_table,
+        'complex_table.csv': complexes,
+        'complex_composition_table.csv': composition,
+        'multidata_table.csv': multidata,
+        'interaction_table.csv': interactions,
+        'gene_synonym_to_gene_name.csv': pd.DataFrame({'Gene Synonym': [], 'Gene Name': []}),
+        'receptor_to_transcription_factor.csv': pd.DataFrame({'Receptor': [], 'TF': []}),
+    }
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for fname, df in tables.items():
+            zf.writestr(fname, df.to_csv(index=False))
+    return path
+
+
+def make_gtf(path, genes, seed=0):
+    """Write a gzipped GTF with one `gene` record per synthetic gene, spread over chr1-22 (MT genes on chrM)."""
+    rng = np.random.default_rng(seed)
+    lines = []
+    position = {}
+    for i, g in enumerate(genes):
+        chrom = 'chrM' if g.startswith('MT-') else f'chr{rng.integers(1, 23)}'
+        start = position.get(chrom, 10000) + int(rng.integers(1000, 50000))
+        end = start + int(rng.integers(500, 20000))
+        position[chrom] = end
+        attrs = f'gene_id "ENSG{i:011d}.1"; gene_type "protein_coding"; gene_name "{g}"; level 2;'
+        lines.append('\t'.join([chrom, 'SYNTHETIC', 'gene', str(start), str(end), '.', '+', '.', attrs]))
+    with gzip.open(path, 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def make_cadrres_inputs(n_genes=2000, n_ref_samples=200, n_samples=50, n_drugs=100, n_dim=10, seed=0):
+    """
+    Inputs for the CaDRReS stages.
+
+    Returns sample and reference fold-change tables (gene x sample), the gene
+    list, a model dict shaped like a pickled CaDRReS model, and cluster
+    fractions (sample x cluster) for `calculate_combined_ic50`.
+    """
+    rng = np.random.default_rng(seed)
+    genes = gene_names(n_genes)
+    ref_samples = [f'CL{i}' for i in range(n_ref_samples)]
+    samples = [f'C{i}' for i in range(n_samples)]
+    drugs = [str(1000 + i) for i in range(n_drugs)]
+
+    ref_df = pd.DataFrame(rng.normal(size=(n_genes, n_ref_samples)), index=genes, columns=ref_samples)
+    sample_df = pd.DataFrame(rng.normal(size=(n_genes, n_samples)), index=genes, columns=samples)
+    model_dict = {
+        'drug_list': pd.Index(drugs),
+        'kernel_sample_list': ref_samples,
+        'b_Q': np.asmatrix(rng.normal(size=(n_drugs, 1))),
+        'W_P': np.asmatrix(rng.normal(scale=0.1, size=(n_ref_samples, n_dim))),
+        'W_Q': np.asmatrix(rng.normal(scale=0.1, size=(n_drugs, n_dim))),
+    }
+    n_patients = max(n_samples // 5, 1)
+    frac = rng.dirichlet(np.ones(n_samples), n_patients)
+    frac[frac < 0.05] = 0
+    frac_df = pd.DataFrame(frac, index=[f'P{i}' for i in range(n_patients)], columns=samples)
+    return sample_df, ref_df, genes, model_dict, frac_df
+
+
+def write_h5ad(adata, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    adata.write_h5ad(path)
+    return path
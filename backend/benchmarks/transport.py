@@ -0,0 +1,115 @@
+"""
+Benchmark of the API payload encodings (`app.transport`).
+
+Builds the payloads the endpoints return: a dataset summary
+(`summarize_h5ad`) whose obs and var previews are grown to `--rows` records,
+and a pipeline `Response` with the figure and file lists of a CellPhoneDB
+run.  Each is encoded the way FastAPI serializes a returned model today
+(`jsonable_encoder` + `JSONResponse`) and as msgpack and Arrow; the report
+has the median encode time in milliseconds and the payload size raw, gzip-
+and zstd-compressed (zstd only with the optional `zstandard` package).
+
+Needs pyarrow and msgpack.  Run from the `backend/` directory:
+
+    python -m benchmarks.transport --rows 100000 --output transport.json
+"""
+import argparse
+import gzip
+import json
+import statistics
+import time
+from datetime import datetime
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.models import AdataResponse, Response
+from app.transport import _zstd, encode_arrow, encode_msgpack
+from app.utils import summarize_h5ad
+from benchmarks.run import machine_info
+from benchmarks.synthetic import make_adata
+
+
+def summary_payload(rows, genes, seed=0):
+    adata = make_adata(rows, genes, seed=seed)
+    rng = np.random.default_rng(seed)
+    adata.obs['leiden'] = rng.integers(0, 20, adata.n_obs).astype(str)
+    adata.obs['cellmarker'] = rng.choice(['T cell', 'B cell', 'NK cell', 'Monocyte'], adata.n_obs)
+    adata.obs['n_counts'] = rng.gamma(2, 1000, adata.n_obs)
+    summary = summarize_h5ad(adata=adata)
+    summary['obs_preview'] = adata.obs.reset_index().to_dict(orient='records')
+    summary['var_preview'] = adata.var.reset_index().to_dict(orient='records')
+    return AdataResponse(input_path='/data/in/bench.h5ad', name='bench', status='success',
+                         message='Adata uploaded successfully', summary=summary)
+
+
+def pipeline_payload(n_figs):
+    figs = [(f'/data/out/bench/bench_dotplot_{i}_20240101_0000.png', 'Detailed Dot Plots') for i in range(n_figs)]
+    files = [(f'/data/out/bench/bench_results_{i}.csv', 'CellPhoneDB Results') for i in range(n_figs // 10 + 1)]
+    return Response(name='bench', type='cellphonedb', input_path='/data/in/bench.h5ad',
+                    output_dir='/data/out/bench', timestamp='20240101_0000',
+                    data={'figs': figs, 'files': files, 'timestamp': '20240101_0000'})
+
+
+def _json(model):
+    return JSONResponse(jsonable_encoder(model)).body
+
+
+ENCODINGS = {'json': _json, 'msgpack': encode_msgpack, 'arrow': encode_arrow}
+
+
+def _median_ms(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, round(statistics.median(times) * 1000, 3)
+
+
+def benchmark_payload(model, repeats):
+    zstd = _zstd()
+    results = {}
+    for name, encode in ENCODINGS.items():
+        body, encode_ms = _median_ms(lambda: encode(model), repeats)
+        results[name] = {
+            'encode_ms': encode_ms,
+            'bytes': len(body),
+            'gzip_bytes': len(gzip.compress(body, 6)),
+            'zstd_bytes': len(zstd.ZstdCompressor(level=3).compress(body)) if zstd is not None else None,
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='obs preview records in the summary payload')
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--figs', type=int, default=1000, help='figure entries in the pipeline payload')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default='transport_benchmark.json')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print("Building payloads...")
+    payloads = {'summary': summary_payload(args.rows, args.genes, args.seed), 'pipeline': pipeline_payload(args.figs)}
+    results = {}
+    for name, model in payloads.items():
+        print(f"Encoding the {name} payload...")
+        results[name] = benchmark_payload(model, args.repeats)
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': {'rows': args.rows, 'genes': args.genes, 'figs': args.figs, 'repeats': args.repeats,
+                   'seed': args.seed},
+        'payloads': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()